@@ -2,6 +2,8 @@ import pygame
 import time
 import numpy as np
 
+from core.render import MapGridToScreen, PrepareForRendering, Render, RenderQueue
+
 
 pygame.init()
 pygame.display.set_caption("Sandbox")
@@ -73,4 +75,59 @@ for i in range(30):
     pygame.display.flip()
 
 tTotal = time.time() - tStart
-print("tTotal surfarray", tTotal)
\ No newline at end of file
+print("tTotal surfarray", tTotal)
+
+
+# Draw the sprites of the example 13 buttons (9 buttons showing a 3x25 grid each), first one blit call at a time as
+# Render.on_screen used to, then with the blit commands a RenderQueue keeps between frames.
+sprites = {
+    tile: pygame.image.load(f"data/sprites/{name}.png").convert_alpha()
+    for tile, name in (
+        ("floor", "dummy_floor_sand_32x20"), ("wall", "dummy_wall_terracotta_32x12"), ("roof", "dummy_roof_blue_32x20")
+    )
+}
+grid = np.array([
+    [0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 1, 1, 1, 0, 0, 0, 0, 1, 0, 0],
+    [0, 0, 0, 1, 0, 0, 1, 0, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 1, 1, 1, 1, 0, 0, 1, 0, 0],
+])
+renderables = []
+for button in range(9):
+    for (irow, icol), cell in np.ndenumerate(grid):
+        top_left = MapGridToScreen.top_left_of_cell(
+            grid_cell=(irow, icol), cell_dimensions=(32, 20), top_left_position_of_grid=(20, 35 + 100 * button)
+        )
+        if cell == 0:
+            renderables += PrepareForRendering.floor_tile_renderables(
+                array_getter=None, top_left_of_tile=top_left, dimensions=(32, 20),
+                surface_getter=lambda: sprites["floor"],
+            )
+        else:
+            renderables += PrepareForRendering.wall_and_roof_tile_renderables(
+                wall_array_getter=None, roof_array_getter=None, top_left_of_tile=top_left,
+                cell_dimensions=(32, 20), wall_dimensions=(32, 12), roof_dimensions=(32, 20),
+                wall_surface_getter=lambda: sprites["wall"], roof_surface_getter=lambda: sprites["roof"],
+            )
+print(f"{len(renderables) = }")
+
+tStart = time.time()
+
+for i in range(30):
+    for (_, position, _, surface_getter) in Render.order_by_priority(renderables):
+        canvas.blit(surface_getter(), position)
+    pygame.display.flip()
+
+tTotal = time.time() - tStart
+print("tTotal blit loop", tTotal)
+loop_pixels = pygame.surfarray.array3d(canvas)
+
+tStart = time.time()
+
+render_queue = RenderQueue(renderables)
+for i in range(30):
+    Render.on_screen(canvas, render_queue)
+    pygame.display.flip()
+
+tTotal = time.time() - tStart
+print("tTotal blits    ", tTotal)
+print("same pixels", np.array_equal(loop_pixels, pygame.surfarray.array3d(canvas)))
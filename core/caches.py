@@ -0,0 +1,305 @@
+"""Caches that let rendered sprites, and the arrays used to render them, be reused between generations."""
+
+import hashlib
+import os
+import tempfile
+import types
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+import numpy as np
+import neat
+
+from core.neat_interfaces import NeatInterfaces
+
+
+class PrototypeCache:
+    """Bounded least recently used cache of rendered tile sprites keyed by genome content.
+
+    Entries hold the neural network and the dictionary of NN inputs to RGB and alpha arrays of a TilePrototype.  The
+    key combines a hash of the genome's nodes and enabled connections with everything else that affects the sprites,
+    so elites and exact clones carried over by reproduction are looked up instead of being rendered again.
+
+    Cached arrays are shared between prototypes and are made read-only.
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Hashable, Tuple[Any, Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def code_digest(code: types.CodeType) -> str:
+        """Hash the bytecode, constants and names of a code object, including those of the functions it defines.
+
+        Unlike hash() the result is the same in every session, so it can be part of a key of an on-disk cache.
+        """
+        digest = hashlib.sha1(code.co_code)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                digest.update(PrototypeCache.code_digest(const).encode())
+            elif isinstance(const, frozenset):
+                # The order of a set's members, and so its repr, can change between sessions.
+                digest.update(repr(sorted(repr(member) for member in const)).encode())
+            else:
+                digest.update(repr(const).encode())
+        digest.update(repr(code.co_names).encode())
+        return digest.hexdigest()
+
+    def function_name(function: Callable) -> str:
+        """Describe a function by its module, qualified name and a hash of its code and default arguments.
+
+        The description is the same in every session, but changes when the function or its defaults are edited, so
+        that sprites drawn by an earlier version of a function, or by a function of the same name in another script,
+        are not reused.  Only the function's own code is hashed, not that of the helpers it calls.
+        """
+        function = getattr(function, "__func__", function)
+        code = getattr(function, "__code__", None)
+        name = f"{function.__module__}.{function.__qualname__}"
+        if code is None:
+            return name
+        digest = hashlib.sha1(PrototypeCache.code_digest(code).encode())
+        digest.update(repr(getattr(function, "__defaults__", None)).encode())
+        digest.update(repr(sorted((getattr(function, "__kwdefaults__", None) or {}).items())).encode())
+        return f"{name}@{digest.hexdigest()}"
+
+    def key(
+        genome: neat.DefaultGenome,
+        tile_type: str,
+        image_function_name: str,
+        palette: Iterable[Tuple[int, ...]],
+        sprite_dimensions: Tuple[int, int],
+        nn_inputs: Iterable[Tuple[int, ...]],
+    ) -> Tuple:
+        """Make a cache key from a genome and the settings used to render its sprites.
+
+        Image generators are given the tile type, so it is part of the key even though tile types such as floors and
+        roofs may share dimensions, NN inputs and palettes.
+        """
+        return (
+            NeatInterfaces.genome_content_hash(genome),
+            tile_type,
+            image_function_name,
+            tuple(tuple(colour) for colour in palette),
+            tuple(sprite_dimensions),
+            tuple(tuple(nn_input) for nn_input in nn_inputs),
+        )
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, Dict]]:
+        """Return the cached entry for the key, or None, and count the lookup as a hit or a miss."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, entry: Tuple[Any, Dict]) -> None:
+        """Store an entry, evicting the least recently used entries when the cache is full."""
+        _, inputs_to_rgbs_and_alphas = entry
+        # Mappings that render lazily make their arrays read-only themselves and must not be rendered here.
+        if isinstance(inputs_to_rgbs_and_alphas, dict):
+            for arrays in inputs_to_rgbs_and_alphas.values():
+                for array in arrays:
+                    if isinstance(array, np.ndarray):
+                        array.flags.writeable = False
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class PrototypeDiskCache:
+    """Rendered sprite blocks kept on disk so that later sessions can reuse them, bounded by a size budget.
+
+    Takes the same keys as PrototypeCache and stores the RGBA block and NN input rows of a core.tiles.ContextRGBAs as
+    two .npy files named after a hash of the key.  Blocks are memory-mapped when read.  Files are written to a temporary
+    name and renamed into place, rows before blocks, so that sessions sharing the directory never read a partial
+    entry.  Reading an entry updates its modification time and the least recently used entries are deleted whenever
+    the directory grows beyond max_bytes.
+
+    Keys describe the image functions by PrototypeCache.function_name, which hashes their own code and defaults but
+    not the helpers they call, so the directory must be cleared by hand after editing such a helper.  format_version
+    is part of every file name and is increased whenever the way entries are stored changes.
+    """
+    format_version = 1
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 2 ** 20) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key: Hashable) -> Tuple[str, str]:
+        name = hashlib.sha1(repr((self.format_version, key)).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".npy"), os.path.join(self.directory, name + ".rows.npy")
+
+    def get(self, key: Hashable) -> Optional[Tuple[np.ndarray, Dict[Tuple[int, ...], int]]]:
+        """Return the stored RGBA block and NN input rows for the key, or None, and count the lookup."""
+        block_path, rows_path = self._paths(key)
+        try:
+            rgbas = np.load(block_path, mmap_mode="r")
+            rows = np.load(rows_path)
+            os.utime(block_path)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        nn_inputs = key[-1]
+        if len(rows) != len(nn_inputs):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rgbas, {nn_input: int(row) for nn_input, row in zip(nn_inputs, rows)}
+
+    def put(self, key: Hashable, rgbas: np.ndarray, rows: Dict[Tuple[int, ...], int]) -> None:
+        """Store an RGBA block and the rows of the NN inputs at the end of the key, then evict beyond the budget."""
+        block_path, rows_path = self._paths(key)
+        self._write_atomically(rows_path, np.array([rows[tuple(nn_input)] for nn_input in key[-1]], dtype=np.int32))
+        self._write_atomically(block_path, rgbas)
+        self.evict()
+
+    def _write_atomically(self, path: str, array: np.ndarray) -> None:
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as temporary_file:
+                np.save(temporary_file, array)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def evict(self) -> None:
+        """Delete the least recently read or written entries until the stored files fit into max_bytes."""
+        blocks = []
+        total_bytes = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                total_bytes += stat.st_size
+                if entry.name.endswith(".npy") and not entry.name.endswith(".rows.npy"):
+                    blocks.append((stat.st_mtime, entry.path, stat.st_size))
+        for _, block_path, block_bytes in sorted(blocks):
+            if total_bytes <= self.max_bytes:
+                break
+            rows_path = block_path[:-len(".npy")] + ".rows.npy"
+            for path in (block_path, rows_path):
+                try:
+                    total_bytes -= os.path.getsize(path)
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def __len__(self) -> int:
+        return sum(
+            1 for name in os.listdir(self.directory) if name.endswith(".npy") and not name.endswith(".rows.npy")
+        )
+
+
+class SpriteStore:
+    """A single shared, read-only copy of every distinct RGBA sprite, with a count of the owners referring to it.
+
+    Sprites are identified by a hash of their shape and pixel values, so pixel-identical sprites of clones, elites and
+    networks with saturated outputs are kept once, as are the Surfaces made from them.  Owners, such as a
+    core.tiles.ContextRGBAs, are tracked so that their references are released when they are garbage collected and
+    unreferenced sprites are dropped.
+    """
+
+    def __init__(self) -> None:
+        self.sprites: Dict[str, np.ndarray] = {}
+        self.references: Dict[str, int] = {}
+        # Objects made from a sprite, such as pygame Surfaces, shared by every owner of the sprite.
+        self.surfaces: Dict[str, Any] = {}
+
+    def digest(rgba: np.ndarray) -> str:
+        """Hash the shape, type and pixel values of a sprite."""
+        rgba = np.ascontiguousarray(rgba)
+        return hashlib.sha1(repr((rgba.shape, rgba.dtype.str)).encode() + rgba.tobytes()).hexdigest()
+
+    def intern(self, rgba: np.ndarray) -> Tuple[str, np.ndarray]:
+        """Return the digest and the shared copy of a sprite, adding a reference to it.
+
+        New sprites are copied so that the shared copy never keeps a larger array, such as a block, alive.
+        """
+        digest = SpriteStore.digest(rgba)
+        shared = self.sprites.get(digest)
+        if shared is None:
+            shared = np.array(rgba)
+            shared.flags.writeable = False
+            self.sprites[digest] = shared
+        self.references[digest] = self.references.get(digest, 0) + 1
+        return digest, shared
+
+    def release(self, digests: Iterable[str]) -> None:
+        """Remove a reference to each sprite, dropping sprites that are no longer referred to."""
+        for digest in digests:
+            self.references[digest] -= 1
+            if self.references[digest] == 0:
+                del self.references[digest]
+                del self.sprites[digest]
+                self.surfaces.pop(digest, None)
+
+    def surface(self, digest: str, make: Callable[[], Any]) -> Any:
+        """The Surface of a sprite, made by make the first time it is asked for and kept while the sprite is."""
+        surface = self.surfaces.get(digest)
+        if surface is None:
+            surface = self.surfaces[digest] = make()
+        return surface
+
+    def track(self, owner: Any, digests: Iterable[str]) -> None:
+        """Release the references to the sprites once the owner has been garbage collected."""
+        weakref.finalize(owner, self.release, tuple(digests))
+
+    def __len__(self) -> int:
+        return len(self.sprites)
+
+
+class FeatureGridCache:
+    """Per-pixel network inputs shared by every genome and every NN input that use the same feature function.
+
+    Feature grids are keyed by the function that makes them, the sprite dimensions and the tile type.  Network inputs
+    additionally have the NN input describing the tile's context tiled into their first columns.  Every array is built
+    once and returned read-only so that callers can not change the grid seen by others.
+    """
+
+    def __init__(self) -> None:
+        self.grids: Dict[Hashable, np.ndarray] = {}
+
+    def _get_or_make(self, key: Hashable, make: Callable[[], np.ndarray]) -> np.ndarray:
+        grid = self.grids.get(key)
+        if grid is None:
+            grid = np.array(make(), dtype=float)
+            grid.flags.writeable = False
+            self.grids[key] = grid
+        return grid
+
+    def features(
+        self, pixel_features: Callable[[Tuple[int, int], str], np.ndarray], sprite_dimensions: Tuple[int, int],
+        tile_type: str,
+    ) -> np.ndarray:
+        """The (width * height, F) array returned by pixel_features(sprite_dimensions, tile_type)."""
+        return self._get_or_make(
+            (pixel_features, tuple(sprite_dimensions), tile_type),
+            lambda: pixel_features(sprite_dimensions, tile_type),
+        )
+
+    def network_inputs(
+        self, pixel_features: Callable[[Tuple[int, int], str], np.ndarray], nn_input: Iterable[int],
+        sprite_dimensions: Tuple[int, int], tile_type: str,
+    ) -> np.ndarray:
+        """The features with the NN input prepended to every row, giving a (width * height, num_inputs) array."""
+        def _make() -> np.ndarray:
+            features = self.features(pixel_features, sprite_dimensions, tile_type)
+            return np.hstack([np.tile(np.array(nn_input, dtype=float), (np.shape(features)[0], 1)), features])
+
+        return self._get_or_make((pixel_features, tuple(sprite_dimensions), tile_type, tuple(nn_input)), _make)
+
+    def __len__(self) -> int:
+        return len(self.grids)
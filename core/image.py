@@ -1,6 +1,11 @@
+import functools
+import io
+import os
+import struct
+import zlib
 import numpy as np
 import pygame
-from typing import Iterable, Tuple, Dict
+from typing import Any, BinaryIO, Iterable, Iterator, Mapping, Tuple, Dict
 from PIL import Image
 
 
@@ -24,6 +29,111 @@ class ImageIO:
         """For now we are assuming all images come from PNG files."""
         return {path: ImageIO.load_png(path) for path in paths}
 
+    def _png_chunks(png_file: BinaryIO) -> Iterator[Tuple[bytes, bytes]]:
+        """Read the chunks of a PNG file one at a time, yielding their type and data."""
+        if png_file.read(8) != b"\x89PNG\r\n\x1a\n":
+            raise ValueError("Not a PNG file")
+        while True:
+            header = png_file.read(8)
+            if len(header) < 8:
+                raise ValueError("PNG file ended before the IEND chunk")
+            length, chunk_type = struct.unpack(">I4s", header)
+            data = png_file.read(length)
+            png_file.read(4)  # CRC, checked by zlib and PIL for the parts that matter.
+            yield chunk_type, data
+            if chunk_type == b"IEND":
+                return
+
+    def _png_from_scanlines(ihdr: bytes, height: int, extra_chunks: Iterable[Tuple[bytes, bytes]], scanlines) -> bytes:
+        """Make an uncompressed PNG from the header of another PNG and some of its filtered scanlines."""
+        def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+        header = ihdr[0: 4] + struct.pack(">I", height) + ihdr[8:]
+        chunks = [_chunk(b"IHDR", header)] + [_chunk(chunk_type, data) for chunk_type, data in extra_chunks]
+        chunks += [_chunk(b"IDAT", zlib.compress(bytes(scanlines), 0)), _chunk(b"IEND", b"")]
+        return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+    def level_grid_from_png(path_to_png: str, path_to_npy: str = None, rows_per_strip: int = 256) -> np.ndarray:
+        """Decode a level map PNG into a grid of cell types a horizontal strip at a time.
+
+        Gives the same int8 array as ImageConvert.grid_from_rgba(ImageIO.rgba_png_to_array(path_to_png)) without ever
+        holding more than one strip of pixels, so that very large maps can be loaded.  When path_to_npy is given the
+        grid is written to a memory mapped .npy file, which is returned, instead of an array in memory.
+
+        The compressed image data is inflated as it is read.  Each strip of filtered scanlines is decoded by PIL as a
+        small PNG of its own, preceded by the last decoded row of the previous strip as an unfiltered scanline so that
+        filters referring to the row above still work.  Only non-interlaced PNGs with 8 bits per channel, whose decoded
+        pixels have the same layout as their scanlines, are supported.
+
+        Unknown colours are reported at their rows in the whole image.  If decoding fails the .npy file is deleted.
+        """
+        channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+        with open(path_to_png, "rb") as png_file:
+            chunks = ImageIO._png_chunks(png_file)
+            chunk_type, ihdr = next(chunks)
+            if chunk_type != b"IHDR":
+                raise ValueError("PNG file does not start with an IHDR chunk")
+            width, height, bit_depth, colour_type, _, _, interlace = struct.unpack(">IIBBBBB", ihdr)
+            if interlace or bit_depth != 8:
+                raise ValueError(
+                    "Only non-interlaced PNG files with 8 bits per channel can be decoded in strips: {0}".format(
+                        path_to_png
+                    )
+                )
+            row_bytes = 1 + width * channels[colour_type]
+            if path_to_npy is None:
+                grid = np.empty((height, width), dtype=np.int8)
+            else:
+                grid = np.lib.format.open_memmap(path_to_npy, mode="w+", dtype=np.int8, shape=(height, width))
+
+            try:
+                extra_chunks = []
+                inflater = zlib.decompressobj()
+                pending = bytearray()
+                previous_row = b""
+                next_row = 0
+
+                def _decode_strip(rows: int) -> None:
+                    nonlocal previous_row, next_row
+                    scanlines = pending[0: rows * row_bytes]
+                    del pending[0: rows * row_bytes]
+                    png = ImageIO._png_from_scanlines(
+                        ihdr, rows + (1 if previous_row else 0), extra_chunks, previous_row + scanlines
+                    )
+                    with Image.open(io.BytesIO(png)) as strip_image:
+                        strip_image.load()
+                        rgba = np.asarray(strip_image.convert("RGBA"))[(1 if previous_row else 0):]
+                        grid[next_row: next_row + rows] = ImageConvert.grid_from_rgba(rgba, first_row=next_row)
+                        # With 8 bits per channel the decoded last row is also its unfiltered scanline.
+                        raw_rows = strip_image.tobytes()
+                    previous_row = b"\x00" + raw_rows[len(raw_rows) - (row_bytes - 1):]
+                    next_row += rows
+
+                strip_bytes = rows_per_strip * row_bytes
+                for chunk_type, data in chunks:
+                    if chunk_type == b"IDAT":
+                        # Inflate no more than a strip at a time so that highly compressed data can not pile up.
+                        while data:
+                            pending += inflater.decompress(data, strip_bytes)
+                            data = inflater.unconsumed_tail
+                            while len(pending) >= strip_bytes and next_row + rows_per_strip <= height:
+                                _decode_strip(rows_per_strip)
+                    elif chunk_type in (b"PLTE", b"tRNS"):
+                        extra_chunks.append((chunk_type, data))
+                pending += inflater.flush()
+                while next_row < height:
+                    _decode_strip(min(rows_per_strip, height - next_row))
+            except BaseException:
+                if path_to_npy is not None:
+                    # Release the memory map before deleting the partially written file.
+                    grid = None
+                    os.remove(path_to_npy)
+                raise
+        if path_to_npy is not None:
+            grid.flush()
+        return grid
+
 
 class ImageConvert:
 
@@ -39,22 +149,59 @@ class ImageConvert:
         rgba_tuples = tuple(map(lambda x: tuple(x), rgba_column))
         return rgba_tuples, np.shape(rgba_array)
 
-    def grid_from_rgba(rgba_array: np.ndarray) -> np.ndarray:
+    def grid_from_rgba(rgba_array: np.ndarray, first_row: int = 0) -> np.ndarray:
         """Map an array produced by reading an RGBA image to a 2D array of cell types.
 
         This is used to encode convert level maps stored as PNG files to a matrix of integers.  These can later be used
-        to generate terrain.
+        to generate terrain.  When the array is a strip of a larger image starting at first_row, the positions of
+        unknown colours are reported as rows of the larger image.
         """
         mapping = {
             tuple([0, 0, 0, 0]): -1,  # nothing -> -1
             tuple([0, 0, 0, 255]): 0,  # black -> 0
             tuple([255, 255, 255, 255]): 1,  # white -> 1
         }
-        flat, (rows, columns, colours) = ImageConvert.flat_hashable_from_rgba(rgba_array)
-        out = np.full(rows * columns, np.nan)
-        for i, v in enumerate(flat):
-            out[i] = mapping[v]
-        return np.reshape(out, (rows, columns))
+        # Each RGBA pixel is read as a single uint32 code, which is looked up in a sorted table of known codes.
+        known_codes = ImageConvert.packed_rgba_codes(np.array(list(mapping.keys())))
+        order = np.argsort(known_codes)
+        sorted_codes = known_codes[order]
+        sorted_cell_types = np.array(list(mapping.values()), dtype=np.int8)[order]
+        pixel_codes = ImageConvert.packed_rgba_codes(rgba_array)
+        table_positions = np.minimum(np.searchsorted(sorted_codes, pixel_codes), len(sorted_codes) - 1)
+        unknown = sorted_codes[table_positions] != pixel_codes
+        if np.any(unknown):
+            raise ValueError(ImageConvert._describe_unknown_colours(rgba_array, pixel_codes, unknown, first_row))
+        return sorted_cell_types[table_positions]
+
+    def packed_rgba_codes(rgba_array: np.ndarray) -> np.ndarray:
+        """View the four 8 bit channels of each pixel in an (..., 4) array as one uint32 code, giving an (...) array."""
+        rgba_array = np.asarray(rgba_array)
+        if np.shape(rgba_array)[-1] != 4:
+            raise ValueError(
+                "Expected RGBA values in the last axis, got an array of shape {0}".format(rgba_array.shape)
+            )
+        if rgba_array.dtype != np.uint8 and rgba_array.size and (rgba_array.min() < 0 or rgba_array.max() > 255):
+            raise ValueError("RGBA values must be between 0 and 255")
+        return np.ascontiguousarray(rgba_array, dtype=np.uint8).view(np.uint32)[..., 0]
+
+    def _describe_unknown_colours(
+        rgba_array: np.ndarray, pixel_codes: np.ndarray, unknown: np.ndarray, first_row: int = 0,
+        max_colours: int = 10, max_positions: int = 5,
+    ) -> str:
+        """List the colours that have no cell type and where they appear, as (row, column) positions."""
+        unknown_codes, counts = np.unique(pixel_codes[unknown], return_counts=True)
+        descriptions = []
+        for code, count in list(zip(unknown_codes, counts))[0: max_colours]:
+            rows, columns = np.nonzero(unknown & (pixel_codes == code))
+            rgba = tuple(int(value) for value in rgba_array[rows[0], columns[0]])
+            positions = ", ".join(
+                str((first_row + int(row), int(column))) for row, column in list(zip(rows, columns))[0: max_positions]
+            )
+            more = " and {0:n} more".format(count - max_positions) if count > max_positions else ""
+            descriptions.append("#{0:02X}{1:02X}{2:02X}{3:02X} at {4}{5}".format(*rgba, positions, more))
+        if len(unknown_codes) > max_colours:
+            descriptions.append("{0:n} more colours".format(len(unknown_codes) - max_colours))
+        return "Colours with no cell type: " + "; ".join(descriptions)
 
     def continuous_value_to_discrete_palette(
         value: float,
@@ -77,19 +224,93 @@ class ImageConvert:
         Also returns a 2D array of alpha values.
 
         The alpha values are separate because pygame.surfarray works with them separately.
+
+        The values are binned in the same way as continuous_value_to_discrete_palette, including values below the
+        first bin selecting the last colour, but for the whole matrix at once.  Both arrays are uint8.
+        """
+        bin_size = (value_range[1] - value_range[0]) / len(palette)
+        bins = tuple([i * bin_size for i in range(len(palette))])
+        indices = np.digitize(matrix, bins) - 1
+        rgba_palette = np.array(palette, dtype=np.uint8)
+        return rgba_palette[indices, 0: 3], rgba_palette[indices, 3]
+
+    def _vector_norms(vectors: np.ndarray) -> np.ndarray:
+        """Euclidean norms along the last axis, using the same dot product as np.linalg.norm of a single vector."""
+        return np.sqrt(np.matmul(vectors[..., np.newaxis, :], vectors[..., :, np.newaxis])[..., 0, 0])
+
+    @functools.lru_cache(maxsize=64)
+    def palette_lookup_table(rgb_palette: Tuple[Tuple[int, int, int], ...], levels: int = 64) -> np.ndarray:
+        """Make a flat table of the palette index nearest to every cell of an RGB cube quantised to levels ** 3 cells.
+
+        Cells that are not entirely on one palette colour's side of every boundary between palette colours hold 255
+        instead of an index.  Tables are cached by palette because palettes rarely change during a session.
+        """
+        cell_size = 256 / levels
+        centres = (np.arange(levels) + 0.5) * cell_size
+        grid = np.reshape(np.stack(np.meshgrid(centres, centres, centres, indexing="ij"), axis=-1), (-1, 3))
+        palette_array = np.array(rgb_palette, dtype=float)
+        projections = grid @ palette_array.T
+        squared_norms = np.sum(palette_array ** 2, axis=-1)
+        nearest = np.argmin(squared_norms - 2 * projections, axis=-1)
+        # A point x is closer to p than to q when 2 x.(q - p) + |p|^2 - |q|^2 is negative.  Over a cell this is
+        # largest at the corner furthest towards q, half a cell from the centre along every axis.
+        manhattan = np.sum(np.abs(palette_array[np.newaxis, :, :] - palette_array[:, np.newaxis, :]), axis=-1)
+        cells = np.arange(len(grid))
+        largest = (
+            2 * (projections - projections[cells, nearest][:, np.newaxis])
+            + squared_norms[nearest][:, np.newaxis] - squared_norms[np.newaxis, :]
+            + cell_size * manhattan[nearest]
+        )
+        largest[cells, nearest] = -np.inf
+        table = np.full(len(grid), 255, dtype=np.uint8)
+        if len(rgb_palette) < 255:
+            unambiguous = np.all(largest < -1e-6, axis=-1)
+            table[unambiguous] = nearest[unambiguous]
+        table.flags.writeable = False
+        return table
+
+    def nearest_palette_indices(rgbs: np.ndarray, palette: Iterable[Tuple[int, int, int, int]]) -> np.ndarray:
+        """Find the index of the palette colour nearest to each RGB value in an (..., 3) array of values 0 to 255.
+
+        Most values are looked up in the palette's cached lookup table.  Values in cells that are close to more than
+        one palette colour, or outside the RGB cube, are compared with every palette colour instead, so the result is
+        the same as an exhaustive search, including which of two equally distant colours is chosen.
+        """
+        rgb_palette = tuple(tuple(int(value) for value in rgba[0: 3]) for rgba in palette)
+        levels = 64
+        table = ImageConvert.palette_lookup_table(rgb_palette, levels)
+        rgbs = np.asarray(rgbs, dtype=float)
+        inside = np.all((rgbs >= 0) & (rgbs < 256), axis=-1)
+        # Truncation is flooring for values inside the cube; values outside are replaced before the conversion.
+        cells = np.where(inside[..., np.newaxis], rgbs * (levels / 256), 0).astype(np.intp)
+        indices = table[(cells[..., 0] * levels + cells[..., 1]) * levels + cells[..., 2]].astype(np.intp)
+        searched = ~inside | (indices == 255)
+        if np.any(searched):
+            distances = ImageConvert._vector_norms(np.array(rgb_palette) - rgbs[searched][:, np.newaxis, :])
+            indices[searched] = np.argmin(distances, axis=-1)
+        return indices
+
+    def nudged_nearest_palette_rgbs(
+        nn_outputs: np.ndarray,
+        palette: Iterable[Tuple[int, int, int, int]],
+        nudge_factor=0.2,
+    ) -> np.ndarray:
+        """Snap each colour to the nearest RGB value on the palette and then nudge it back towards the original colour.
+
+        The last axis of nn_outputs holds red, green and blue values between 0 and 1, so the array can be the (N, 3)
+        pixels of one sprite or the pixels of a whole batch of sprites.  Returns uint8 RGB values with the same shape.
+
+        Where a colour lies exactly on the palette the palette colour is returned, as the nudge has no direction.
         """
-        rgb_palette = tuple([v[0: 3] for v in palette])
-        alpha_palette = tuple([v[3] for v in palette])
-        rows, columns = np.shape(matrix)
-        rgb_out = np.empty((rows, columns, 3))
-        alpha_out = np.empty((rows, columns))
-        for irow in range(rows):
-            for icol in range(columns):
-                rgb_out[irow, icol] = ImageConvert.continuous_value_to_discrete_palette(
-                    matrix[irow, icol], rgb_palette)
-                alpha_out[irow, icol] = ImageConvert.continuous_value_to_discrete_palette(
-                    matrix[irow, icol], alpha_palette)
-        return rgb_out, alpha_out
+        rgb_from_nn = np.asarray(nn_outputs, dtype=float) * 255
+        rgb_palette = np.array([rgba[0: 3] for rgba in palette])
+        origins = rgb_palette[ImageConvert.nearest_palette_indices(rgb_from_nn, palette)]
+        direction_vectors = rgb_from_nn - origins
+        distances = ImageConvert._vector_norms(direction_vectors)[..., np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            unit_vectors = direction_vectors / distances
+        nudged = np.where(distances == 0, origins, origins + unit_vectors * distances * nudge_factor)
+        return np.clip(np.round(nudged), 0, 255).astype(np.uint8)
 
 
 class MutateSurface:
@@ -109,12 +330,67 @@ class MutateSurface:
 class MakeSurface:
     """Wraper for functions that make a Surfaces from arrays.
 
-    The surface needs to have the same dimensions as the array and applying alpha requires mutating the Surface object.
+    Arrays are indexed [x, y] like pygame.surfarray, whereas pygame.image.frombuffer reads rows of pixels, so each
+    pixel is moved once, as a single 32 bit word, into a row major buffer that the Surface uses without copying it.
     """
 
+    def from_rgba_array(rgba_array: np.ndarray) -> pygame.surface.Surface:
+        """Make a surface with per-pixel alpha from a (W, H, 4) array of uint8 RGBA values."""
+        width, height, _ = np.shape(rgba_array)
+        pixels = np.ascontiguousarray(rgba_array, dtype=np.uint8).view(np.uint32)[..., 0]
+        # The Surface keeps a reference to the buffer it shares.
+        return pygame.image.frombuffer(np.ascontiguousarray(pixels.T), (width, height), "RGBA")
+
     def from_rgb_and_alpha_arrays(rgb_array: np.ndarray, alpha_array: np.ndarray) -> pygame.surface.Surface:
         """Make a surface with an image from a 3D array of RGB values and a 2D array of alpha values."""
-        draw_surface = pygame.surface.Surface(np.shape(alpha_array))
-        pygame.surfarray.blit_array(draw_surface, rgb_array)
-        MutateSurface.set_alphas(draw_surface, alpha_array)
-        return draw_surface
+        rgba_array = np.empty(np.shape(alpha_array) + (4,), dtype=np.uint8)
+        with np.errstate(invalid="ignore"):
+            rgba_array[..., 0:3] = rgb_array
+            rgba_array[..., 3] = alpha_array
+        return MakeSurface.from_rgba_array(rgba_array)
+
+
+class SurfaceCache:
+    """Surfaces for the NN inputs of a tile prototype, made the first time each is drawn and then kept.
+
+    NN inputs whose arrays are the same tuple object, such as the rows of a ContextRGBAs or collapsed contexts, share
+    a Surface.  Given the core.caches.SpriteStore that the arrays were interned in, Surfaces are kept by the store
+    instead, so that pixel-identical sprites of every prototype share one.  Once a display exists Surfaces are
+    converted to its format with convert_alpha so that blitting them needs no conversion.  Pickling keeps the arrays
+    but not the Surfaces, which are made again when next drawn.
+    """
+
+    def __init__(self, inputs_to_rgbs_and_alphas: Mapping, sprite_store: Any = None) -> None:
+        self.inputs_to_rgbs_and_alphas = inputs_to_rgbs_and_alphas
+        self.sprite_store = sprite_store
+        # Keyed by the identity of the arrays, which are kept alongside the Surface so the identity stays unique.
+        self.surfaces: Dict[int, Tuple[Any, pygame.surface.Surface]] = {}
+
+    def __reduce__(self):
+        return (SurfaceCache, (self.inputs_to_rgbs_and_alphas,))
+
+    def _make_surface(self, nn_input: Tuple[int, ...]) -> pygame.surface.Surface:
+        if hasattr(self.inputs_to_rgbs_and_alphas, "rgba"):
+            # A ContextRGBAs already holds the RGBA values in a single array.
+            surface = MakeSurface.from_rgba_array(self.inputs_to_rgbs_and_alphas.rgba(nn_input))
+        else:
+            surface = MakeSurface.from_rgb_and_alpha_arrays(*self.inputs_to_rgbs_and_alphas[nn_input])
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert_alpha()
+        return surface
+
+    def surface(self, nn_input: Tuple[int, ...]) -> pygame.surface.Surface:
+        """The Surface showing the sprite of an NN input."""
+        if self.sprite_store is not None and hasattr(self.inputs_to_rgbs_and_alphas, "digest"):
+            digest = self.inputs_to_rgbs_and_alphas.digest(nn_input)
+            if digest is not None:
+                return self.sprite_store.surface(digest, lambda: self._make_surface(nn_input))
+        rgb_and_alpha = self.inputs_to_rgbs_and_alphas[nn_input]
+        cached = self.surfaces.get(id(rgb_and_alpha))
+        if cached is None:
+            cached = (rgb_and_alpha, self._make_surface(nn_input))
+            self.surfaces[id(rgb_and_alpha)] = cached
+        return cached[1]
+
+    def __len__(self) -> int:
+        return len(self.surfaces)
@@ -1,5 +1,6 @@
 """Helper functions for working with neat-python."""
 
+import hashlib
 import neat
 from typing import Dict
 
@@ -10,6 +11,18 @@ class NeatInterfaces:
         """Figure out where to put this."""
         pass
 
+    def genome_content_hash(genome: neat.DefaultGenome) -> str:
+        """Make a hash of everything about a genome that affects the output of its network.
+
+        Genome keys, fitness and disabled connections are ignored so that clones and elites carried over to a new
+        generation produce the same hash.
+        """
+        nodes = sorted(
+            (key, repr(ng.bias), repr(ng.response), ng.activation, ng.aggregation) for key, ng in genome.nodes.items()
+        )
+        connections = sorted((key, repr(cg.weight)) for key, cg in genome.connections.items() if cg.enabled)
+        return hashlib.sha1(repr((nodes, connections)).encode()).hexdigest()
+
     def gather_and_report_statistics(population: neat.Population) -> None:
         population.reporters.start_generation(population.generation)
         best = None
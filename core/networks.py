@@ -0,0 +1,596 @@
+"""Neural networks compiled from NEAT genomes that evaluate many input vectors at once."""
+
+import numpy as np
+import neat
+from typing import Callable, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+
+class NumpyActivations:
+    """Vectorised counterparts of the activation functions built into neat-python.
+
+    Each function mirrors the clamping done in neat.activations so that results agree with FeedForwardNetwork.
+    """
+
+    def sigmoid(z: np.ndarray) -> np.ndarray:
+        return 1.0 / (1.0 + np.exp(-np.clip(5.0 * z, -60.0, 60.0)))
+
+    def tanh(z: np.ndarray) -> np.ndarray:
+        return np.tanh(np.clip(2.5 * z, -60.0, 60.0))
+
+    def sin(z: np.ndarray) -> np.ndarray:
+        return np.sin(np.clip(5.0 * z, -60.0, 60.0))
+
+    def gauss(z: np.ndarray) -> np.ndarray:
+        return np.exp(-5.0 * np.clip(z, -3.4, 3.4) ** 2)
+
+    def relu(z: np.ndarray) -> np.ndarray:
+        return np.where(z > 0.0, z, 0.0)
+
+    def softplus(z: np.ndarray) -> np.ndarray:
+        return 0.2 * np.log(1 + np.exp(np.clip(5.0 * z, -60.0, 60.0)))
+
+    def identity(z: np.ndarray) -> np.ndarray:
+        return z
+
+    def clamped(z: np.ndarray) -> np.ndarray:
+        return np.clip(z, -1.0, 1.0)
+
+    def inv(z: np.ndarray) -> np.ndarray:
+        with np.errstate(divide="ignore", over="ignore"):
+            inverted = 1.0 / z
+        return np.where(np.isfinite(inverted), inverted, 0.0)
+
+    def log(z: np.ndarray) -> np.ndarray:
+        return np.log(np.maximum(z, 1e-7))
+
+    def exp(z: np.ndarray) -> np.ndarray:
+        return np.exp(np.clip(z, -60.0, 60.0))
+
+    def abs(z: np.ndarray) -> np.ndarray:
+        return np.abs(z)
+
+    def hat(z: np.ndarray) -> np.ndarray:
+        return np.maximum(0.0, 1 - np.abs(z))
+
+    def square(z: np.ndarray) -> np.ndarray:
+        return z ** 2
+
+    def cube(z: np.ndarray) -> np.ndarray:
+        return z ** 3
+
+    def get(name: str, fallback: Callable[[float], float] = None) -> Callable[[np.ndarray], np.ndarray]:
+        """Look up a vectorised activation by its neat-python name.
+
+        User-defined activations have no vectorised counterpart so the scalar fallback is applied element-wise.
+        """
+        function = getattr(NumpyActivations, name, None)
+        if name != "get" and function is not None:
+            return function
+        if fallback is None:
+            raise ValueError(f"No vectorised activation function called {name!r} and no fallback was given.")
+        return np.vectorize(fallback, otypes=[float])
+
+
+class NumpyAggregations:
+    """Vectorised counterparts of the aggregation functions built into neat-python.
+
+    Each function reduces an array of weighted node inputs along its last axis.
+    """
+
+    def sum(x: np.ndarray) -> np.ndarray:
+        return np.sum(x, axis=-1)
+
+    def product(x: np.ndarray) -> np.ndarray:
+        return np.prod(x, axis=-1)
+
+    def max(x: np.ndarray) -> np.ndarray:
+        return np.max(x, axis=-1)
+
+    def min(x: np.ndarray) -> np.ndarray:
+        return np.min(x, axis=-1)
+
+    def maxabs(x: np.ndarray) -> np.ndarray:
+        indices = np.argmax(np.abs(x), axis=-1)
+        return np.take_along_axis(x, indices[..., np.newaxis], axis=-1)[..., 0]
+
+    def median(x: np.ndarray) -> np.ndarray:
+        return np.median(x, axis=-1)
+
+    def mean(x: np.ndarray) -> np.ndarray:
+        return np.mean(x, axis=-1)
+
+    def get(name: str, fallback: Callable[[List[float]], float] = None) -> Callable[[np.ndarray], np.ndarray]:
+        """Look up a vectorised aggregation by its neat-python name, falling back to applying a scalar function."""
+        function = getattr(NumpyAggregations, name, None)
+        if name != "get" and function is not None:
+            return function
+        if fallback is None:
+            raise ValueError(f"No vectorised aggregation function called {name!r} and no fallback was given.")
+        return lambda x: np.apply_along_axis(lambda row: fallback(list(row)), -1, x)
+
+
+class NetworkAnalysis:
+    """Functions that inspect the structure of a genome's network without evaluating it."""
+
+    def inputs_affecting_outputs(genome: neat.DefaultGenome, config: neat.Config) -> Tuple[int, ...]:
+        """Find the positions of the network inputs that can change at least one output.
+
+        Follows enabled connections backwards from the outputs, through the nodes that neat-python actually evaluates
+        (those in neat.graphs.feed_forward_layers).  Inputs that are not found can take any value without changing the
+        network's outputs.
+        """
+        genome_config = config.genome_config
+        connections = [cg.key for cg in genome.connections.values() if cg.enabled]
+        layers = neat.graphs.feed_forward_layers(genome_config.input_keys, genome_config.output_keys, connections)
+        evaluated = set().union(*layers)
+        links = [(i, o) for (i, o) in connections if o in evaluated]
+        reached = {key for key in genome_config.output_keys if key in evaluated}
+        frontier = set(reached)
+        while frontier:
+            frontier = {i for (i, o) in links if o in frontier and i not in reached}
+            reached |= frontier
+        return tuple(position for position, key in enumerate(genome_config.input_keys) if key in reached)
+
+
+class CompiledLayer(NamedTuple):
+    """Nodes of a feed forward network whose inputs are all known once the previous layers have been evaluated.
+
+    The weights matrix maps the values held in source_slots to the nodes of this layer.  Node values are written to
+    consecutive slots starting at first_slot.
+    """
+    node_keys: Tuple[int, ...]
+    first_slot: int
+    source_slots: np.ndarray
+    weights: np.ndarray  # (len(source_slots), len(node_keys)), zero where there is no connection.
+    connected: np.ndarray  # Boolean mask with the same shape as weights.
+    biases: np.ndarray
+    responses: np.ndarray
+    activations: Tuple[str, ...]
+    aggregations: Tuple[str, ...]
+
+
+class CompiledNetwork:
+    """A feed forward network that evaluates a whole batch of input vectors layer by layer.
+
+    Built from the same genome information as neat.nn.FeedForwardNetwork and produces the same outputs, but instead of
+    walking the node graph once per input vector it evaluates each layer of nodes for every input vector using a
+    single matrix product.  Nodes that can not be reached from the inputs keep a value of 0.0 just as they do in
+    neat-python.
+    """
+
+    def __init__(
+        self,
+        input_nodes: List[int],
+        output_nodes: List[int],
+        layers: Tuple[CompiledLayer, ...],
+        custom_functions: Dict[str, Callable] = None,
+        constants: Dict[int, float] = None,
+    ) -> None:
+        self.input_nodes = input_nodes
+        self.output_nodes = output_nodes
+        self.layers = layers
+        self.custom_functions = {} if custom_functions is None else custom_functions
+        # Nodes whose value does not depend on the inputs occupy the slots straight after the inputs.
+        self.constants = {} if constants is None else constants
+        self.node_slots: Dict[int, int] = {key: i for i, key in enumerate(input_nodes)}
+        for i, key in enumerate(self.constants):
+            self.node_slots[key] = len(input_nodes) + i
+        for layer in layers:
+            for i, key in enumerate(layer.node_keys):
+                self.node_slots[key] = layer.first_slot + i
+        self.num_slots = len(self.node_slots) + 1
+        # Outputs that are never evaluated read from the last slot which is always zero.
+        self.output_slots = np.array([self.node_slots.get(key, self.num_slots - 1) for key in output_nodes])
+        # Networks returned by specialise, by their fixed inputs, so that each is only built once.
+        self.specialised: Dict[Tuple[Tuple[int, float], ...], CompiledNetwork] = {}
+
+    @staticmethod
+    def create(genome: neat.DefaultGenome, config: neat.Config) -> "CompiledNetwork":
+        """Receives a genome and returns its phenotype as a CompiledNetwork."""
+        genome_config = config.genome_config
+        connections = [cg.key for cg in genome.connections.values() if cg.enabled]
+        layers = neat.graphs.feed_forward_layers(genome_config.input_keys, genome_config.output_keys, connections)
+
+        node_slots = {key: i for i, key in enumerate(genome_config.input_keys)}
+        custom_functions = {}
+        compiled_layers = []
+        for layer in layers:
+            node_keys = tuple(sorted(layer))
+            links = [(i, o) for (i, o) in connections if o in layer]
+            source_slots = np.array(sorted({node_slots[i] for (i, _) in links}))
+            source_index = {slot: i for i, slot in enumerate(source_slots)}
+            node_index = {key: i for i, key in enumerate(node_keys)}
+            weights = np.zeros((len(source_slots), len(node_keys)))
+            connected = np.zeros((len(source_slots), len(node_keys)), dtype=bool)
+            for (i, o) in links:
+                weights[source_index[node_slots[i]], node_index[o]] = genome.connections[(i, o)].weight
+                connected[source_index[node_slots[i]], node_index[o]] = True
+            node_genes = [genome.nodes[key] for key in node_keys]
+            for ng in node_genes:
+                custom_functions.setdefault(ng.activation, genome_config.activation_defs.get(ng.activation))
+                custom_functions.setdefault(ng.aggregation, genome_config.aggregation_function_defs.get(ng.aggregation))
+            first_slot = len(node_slots)
+            compiled_layers.append(
+                CompiledLayer(
+                    node_keys=node_keys,
+                    first_slot=first_slot,
+                    source_slots=source_slots,
+                    weights=weights,
+                    connected=connected,
+                    biases=np.array([ng.bias for ng in node_genes]),
+                    responses=np.array([ng.response for ng in node_genes]),
+                    activations=tuple(ng.activation for ng in node_genes),
+                    aggregations=tuple(ng.aggregation for ng in node_genes),
+                )
+            )
+            for i, key in enumerate(node_keys):
+                node_slots[key] = first_slot + i
+
+        # Only keep scalar functions that have no vectorised counterpart.
+        custom_functions = {
+            name: function for name, function in custom_functions.items()
+            if not hasattr(NumpyActivations, name) and not hasattr(NumpyAggregations, name)
+        }
+        return CompiledNetwork(genome_config.input_keys, genome_config.output_keys, tuple(compiled_layers),
+                               custom_functions)
+
+    def _aggregate(self, layer: CompiledLayer, sources: np.ndarray) -> np.ndarray:
+        """Combine weighted inputs for every node in the layer, using a matrix product where aggregation is a sum."""
+        if all(name == "sum" for name in layer.aggregations):
+            return sources @ layer.weights
+        aggregated = np.empty((sources.shape[0], len(layer.node_keys)))
+        for i, name in enumerate(layer.aggregations):
+            mask = layer.connected[:, i]
+            weighted = sources[:, mask] * layer.weights[mask, i]
+            aggregated[:, i] = NumpyAggregations.get(name, self.custom_functions.get(name))(weighted)
+        return aggregated
+
+    def _activate(self, layer: CompiledLayer, pre_activation: np.ndarray) -> np.ndarray:
+        """Apply each node's activation function, grouping nodes that share the same function."""
+        names = set(layer.activations)
+        if len(names) == 1:
+            name = layer.activations[0]
+            return NumpyActivations.get(name, self.custom_functions.get(name))(pre_activation)
+        activated = np.empty_like(pre_activation)
+        for name in names:
+            mask = np.array([a == name for a in layer.activations])
+            activated[:, mask] = NumpyActivations.get(name, self.custom_functions.get(name))(pre_activation[:, mask])
+        return activated
+
+    def activate_batch(self, inputs: np.ndarray) -> np.ndarray:
+        """Evaluate the network for every row of an (N, num_inputs) array and return an (N, num_outputs) array."""
+        inputs = np.asarray(inputs, dtype=float)
+        if inputs.ndim != 2 or inputs.shape[1] != len(self.input_nodes):
+            raise RuntimeError(
+                "Expected an array of shape (N, {0:n}), got {1}".format(len(self.input_nodes), np.shape(inputs))
+            )
+        values = np.zeros((inputs.shape[0], self.num_slots))
+        values[:, 0: len(self.input_nodes)] = inputs
+        values[:, len(self.input_nodes): len(self.input_nodes) + len(self.constants)] = list(self.constants.values())
+        for layer in self.layers:
+            aggregated = self._aggregate(layer, values[:, layer.source_slots])
+            pre_activation = layer.biases + layer.responses * aggregated
+            values[:, layer.first_slot: layer.first_slot + len(layer.node_keys)] = self._activate(layer, pre_activation)
+        return values[:, self.output_slots]
+
+    def activate_separable(self, inputs: Sequence[np.ndarray]) -> np.ndarray:
+        """Evaluate the network on a grid whose inputs may each vary along only some of its axes.
+
+        Every input is an array that broadcasts to the grid, for example shape (W, 1) for an input that only depends
+        on x, (1, H) for one that only depends on y and () for a constant.  Each node is evaluated on the broadcast
+        shape of its own sources, so nodes that only depend on x cost W evaluations rather than W * H and are only
+        expanded where they meet a node that depends on both axes.  Returns an array of shape (*grid, num_outputs).
+        """
+        if len(inputs) != len(self.input_nodes):
+            raise RuntimeError("Expected {0:n} inputs, got {1:n}".format(len(self.input_nodes), len(inputs)))
+        slot_values = {slot: np.asarray(value, dtype=float) for slot, value in enumerate(inputs)}
+        grid_shape = np.broadcast_shapes(*(value.shape for value in slot_values.values()))
+        for i, value in enumerate(self.constants.values()):
+            slot_values[len(self.input_nodes) + i] = np.array(value)
+        for layer in self.layers:
+            source_shapes = [slot_values[slot].shape for slot in layer.source_slots]
+            node_shapes = [
+                np.broadcast_shapes(*(source_shapes[j] for j in np.flatnonzero(layer.connected[:, n])))
+                for n in range(len(layer.node_keys))
+            ]
+            # Nodes with the same dependence on the axes are evaluated together.
+            for shape in set(node_shapes):
+                nodes = np.array([node_shape == shape for node_shape in node_shapes])
+                sources = np.any(layer.connected[:, nodes], axis=1)
+                sub_layer = layer._replace(
+                    node_keys=tuple(key for key, selected in zip(layer.node_keys, nodes) if selected),
+                    source_slots=layer.source_slots[sources],
+                    weights=layer.weights[np.ix_(sources, nodes)],
+                    connected=layer.connected[np.ix_(sources, nodes)],
+                    biases=layer.biases[nodes],
+                    responses=layer.responses[nodes],
+                    activations=tuple(name for name, selected in zip(layer.activations, nodes) if selected),
+                    aggregations=tuple(name for name, selected in zip(layer.aggregations, nodes) if selected),
+                )
+                stacked = np.stack(
+                    [np.broadcast_to(slot_values[slot], shape).ravel() for slot in sub_layer.source_slots], axis=1
+                )
+                pre_activation = sub_layer.biases + sub_layer.responses * self._aggregate(sub_layer, stacked)
+                activated = self._activate(sub_layer, pre_activation)
+                for k, n in enumerate(np.flatnonzero(nodes)):
+                    slot_values[layer.first_slot + n] = np.reshape(activated[:, k], shape)
+        zero = np.zeros(())
+        return np.stack(
+            [np.broadcast_to(slot_values.get(slot, zero), grid_shape) for slot in self.output_slots], axis=-1
+        )
+
+    def activate(self, inputs: Iterable[float]) -> List[float]:
+        """Evaluate a single input vector, matching the interface of neat.nn.FeedForwardNetwork.activate."""
+        if len(self.input_nodes) != len(inputs):
+            raise RuntimeError("Expected {0:n} inputs, got {1:n}".format(len(self.input_nodes), len(inputs)))
+        return list(self.activate_batch(np.array([inputs], dtype=float))[0])
+
+    def specialise(self, fixed_inputs: Dict[int, float]) -> "CompiledNetwork":
+        """Fold inputs that keep the same value for every row into the network, returning a smaller network.
+
+        fixed_inputs maps positions in the input vector to their values.  The returned network takes the remaining
+        inputs, in their original order.  Nodes that only depend on fixed inputs become constants and, for sum
+        aggregation, the contribution of constant sources is added to the bias of the node they feed so that it no
+        longer costs a multiply-add per row.  Other aggregations keep reading constant sources from their slots.
+
+        Specialising costs roughly as much as evaluating a few thousand rows, so the result is kept and returned again
+        for the same fixed inputs.
+        """
+        key = tuple(sorted((position, float(value)) for position, value in fixed_inputs.items()))
+        if key not in self.specialised:
+            self.specialised[key] = self._specialise(fixed_inputs)
+        return self.specialised[key]
+
+    def _specialise(self, fixed_inputs: Dict[int, float]) -> "CompiledNetwork":
+        """Build the network returned by specialise."""
+        fixed_slots = {self.node_slots[self.input_nodes[position]]: value for position, value in fixed_inputs.items()}
+        free_nodes = [key for key in self.input_nodes if self.node_slots[key] not in fixed_slots]
+
+        # Work out the value of every slot that does not depend on the free inputs.
+        known = np.zeros(self.num_slots)
+        is_known = np.zeros(self.num_slots, dtype=bool)
+        for slot, value in fixed_slots.items():
+            known[slot], is_known[slot] = value, True
+        for key, value in self.constants.items():
+            known[self.node_slots[key]], is_known[self.node_slots[key]] = value, True
+        for layer in self.layers:
+            constant_nodes = ~np.any(layer.connected & ~is_known[layer.source_slots, np.newaxis], axis=0)
+            if np.any(constant_nodes):
+                aggregated = self._aggregate(layer, known[np.newaxis, layer.source_slots])
+                values = self._activate(layer, layer.biases + layer.responses * aggregated)[0]
+                slots = layer.first_slot + np.flatnonzero(constant_nodes)
+                known[slots], is_known[slots] = values[constant_nodes], True
+
+        # Constants are only kept where a remaining node or an output still reads them.
+        kept_constants = set()
+        for layer in self.layers:
+            variable_nodes = np.any(layer.connected & ~is_known[layer.source_slots, np.newaxis], axis=0)
+            for i in np.flatnonzero(variable_nodes):
+                if layer.aggregations[i] != "sum":
+                    kept_constants.update(layer.source_slots[layer.connected[:, i] & is_known[layer.source_slots]])
+        kept_constants.update(slot for slot in self.output_slots if is_known[slot] and slot != self.num_slots - 1)
+        slot_keys = {slot: key for key, slot in self.node_slots.items()}
+        constants = {slot_keys[slot]: float(known[slot]) for slot in sorted(kept_constants)}
+
+        remap = {self.node_slots[key]: i for i, key in enumerate(free_nodes)}
+        remap.update({self.node_slots[key]: len(free_nodes) + i for i, key in enumerate(constants)})
+        next_slot = len(remap)
+        layers = []
+        for layer in self.layers:
+            variable_nodes = np.flatnonzero(np.any(layer.connected & ~is_known[layer.source_slots, np.newaxis], axis=0))
+            if len(variable_nodes) == 0:
+                continue
+            sum_nodes = np.array([layer.aggregations[i] == "sum" for i in variable_nodes])
+            weights = layer.weights[:, variable_nodes]
+            connected = layer.connected[:, variable_nodes]
+            responses = layer.responses[variable_nodes]
+            folded = is_known[layer.source_slots, np.newaxis] & sum_nodes[np.newaxis, :]
+            biases = layer.biases[variable_nodes] + responses * np.sum(
+                np.where(folded, known[layer.source_slots, np.newaxis] * weights, 0.0), axis=0
+            )
+            # Sources kept for other aggregations in the layer must no longer feed the sum nodes they are folded into.
+            weights = np.where(folded, 0.0, weights)
+            connected = connected & ~folded
+            keep_sources = np.any(connected, axis=1)
+            layers.append(
+                CompiledLayer(
+                    node_keys=tuple(layer.node_keys[i] for i in variable_nodes),
+                    first_slot=next_slot,
+                    source_slots=np.array([remap[slot] for slot in layer.source_slots[keep_sources]], dtype=int),
+                    weights=weights[keep_sources],
+                    connected=connected[keep_sources],
+                    biases=biases,
+                    responses=responses,
+                    activations=tuple(layer.activations[i] for i in variable_nodes),
+                    aggregations=tuple(layer.aggregations[i] for i in variable_nodes),
+                )
+            )
+            for i, node in enumerate(variable_nodes):
+                remap[layer.first_slot + node] = next_slot + i
+            next_slot += len(variable_nodes)
+        return CompiledNetwork(free_nodes, self.output_nodes, tuple(layers), self.custom_functions, constants)
+
+
+class PackedNetworks:
+    """Sum-aggregated networks whose layers have the same widths, packed into tensors and evaluated together.
+
+    Layer l of every network is given the same block of value slots.  Per-layer weight tensors of shape (networks,
+    slots before layer l, width of layer l) then let one batched matrix product evaluate layer l for every network and
+    every input vector.  Networks need not share their connections, only their layer widths, so no padding nodes are
+    evaluated.
+
+    Inputs that are the same for every row, such as the tile context of a sprite, can be given as fixed_inputs.  Their
+    contribution is then added to the biases once instead of being multiplied in for every row.
+    """
+
+    def __init__(self, networks: Sequence[CompiledNetwork], num_inputs: int, num_outputs: int) -> None:
+        self.num_networks = len(networks)
+        self.num_inputs = num_inputs
+        self.num_outputs = num_outputs
+        widths = [len(layer.node_keys) for layer in networks[0].layers]
+        first_slots = list(np.cumsum([num_inputs] + widths[:-1])) if widths else []
+        self.num_slots = num_inputs + sum(widths) + 1
+        self.layer_slots = tuple(zip(first_slots, widths))
+
+        weights = tuple(np.zeros((self.num_networks, first, width)) for first, width in self.layer_slots)
+        self.biases = tuple(np.zeros((self.num_networks, width)) for _, width in self.layer_slots)
+        self.responses = tuple(np.zeros((self.num_networks, width)) for _, width in self.layer_slots)
+        self.activations = tuple(np.full((self.num_networks, width), "", dtype=object) for _, width in self.layer_slots)
+        self.output_slots = np.full((self.num_networks, num_outputs), self.num_slots - 1)
+        self.custom_functions = {}
+        for g, network in enumerate(networks):
+            self.custom_functions.update(network.custom_functions)
+            # Map the slots used by this network to the shared slots.
+            remap = np.full(network.num_slots, self.num_slots - 1)
+            remap[0: num_inputs] = np.arange(num_inputs)
+            for i, layer in enumerate(network.layers):
+                remap[layer.first_slot: layer.first_slot + widths[i]] = first_slots[i] + np.arange(widths[i])
+                weights[i][g, remap[layer.source_slots]] = layer.weights
+                self.biases[i][g] = layer.biases
+                self.responses[i][g] = layer.responses
+                self.activations[i][g] = layer.activations
+            self.output_slots[g] = remap[network.output_slots]
+
+        # Split each layer's weights into contiguous blocks, one for the inputs and one per earlier layer, dropping
+        # blocks without any connections.  Inputs shared by all networks are multiplied by a single wide matrix.
+        self.input_weights = tuple(np.ascontiguousarray(layer_weights[:, 0: num_inputs]) for layer_weights in weights)
+        self.shared_input_weights = tuple(
+            np.reshape(np.transpose(layer_weights, (1, 0, 2)), (num_inputs, -1)) for layer_weights in self.input_weights
+        )
+        self.hidden_weights = tuple(
+            tuple(
+                (j, np.ascontiguousarray(layer_weights[:, first: first + width]))
+                for j, (first, width) in enumerate(self.layer_slots[0: i])
+                if np.any(layer_weights[:, first: first + width])
+            )
+            for i, layer_weights in enumerate(weights)
+        )
+
+    def _activate_layer(self, i: int, pre_activation: np.ndarray) -> np.ndarray:
+        """Apply the activation functions of layer i, which may differ between networks and nodes."""
+        names = set(self.activations[i].flat)
+        if len(names) == 1:
+            name = names.pop()
+            return NumpyActivations.get(name, self.custom_functions.get(name))(pre_activation)
+        activated = np.zeros_like(pre_activation)
+        for name in names:
+            selected = (self.activations[i] == name)[:, np.newaxis, :]
+            function = NumpyActivations.get(name, self.custom_functions.get(name))
+            activated = np.where(selected, function(pre_activation), activated)
+        return activated
+
+    def activate_batch(self, inputs: np.ndarray, fixed_inputs: Dict[int, float]) -> np.ndarray:
+        """Evaluate the networks on (networks or 1, N, free inputs) inputs, returning (networks, N, outputs)."""
+        rows = inputs.shape[1]
+        free = [position for position in range(self.num_inputs) if position not in fixed_inputs]
+        fixed = list(fixed_inputs)
+        fixed_values = np.array(list(fixed_inputs.values()), dtype=float)
+        layer_values = []
+        for i, (first, width) in enumerate(self.layer_slots):
+            if len(free) == self.num_inputs:
+                input_weights, shared_input_weights = self.input_weights[i], self.shared_input_weights[i]
+            else:
+                input_weights = self.input_weights[i][:, free]
+                shared_input_weights = self.shared_input_weights[i][free]
+            if inputs.shape[0] == 1:
+                aggregated = np.transpose(
+                    np.reshape(inputs[0] @ shared_input_weights, (rows, self.num_networks, width)), (1, 0, 2)
+                )
+            else:
+                aggregated = inputs @ input_weights
+            for j, weights in self.hidden_weights[i]:
+                aggregated = aggregated + layer_values[j] @ weights
+            biases = self.biases[i]
+            if fixed:
+                fixed_contribution = np.einsum("f,gfw->gw", fixed_values, self.input_weights[i][:, fixed])
+                biases = biases + self.responses[i] * fixed_contribution
+            pre_activation = biases[:, np.newaxis, :] + self.responses[i][:, np.newaxis, :] * aggregated
+            layer_values.append(np.ascontiguousarray(self._activate_layer(i, pre_activation)))
+        # Node values without the input slots, followed by the slot that is always zero.
+        values = np.concatenate(layer_values + [np.zeros((self.num_networks, rows, 1))], axis=2)
+        # Indexing genomes and output slots together is far faster than np.take_along_axis on these shapes.
+        genomes = np.arange(self.num_networks)[:, np.newaxis]
+        return np.moveaxis(values[genomes, :, self.output_slots - self.num_inputs], 1, 2)
+
+
+class CompiledPopulation:
+    """Every genome of a population grouped into PackedNetworks so that many of them are evaluated together.
+
+    Sum-aggregated genomes are grouped by the widths of their layers and each group is evaluated with one batched
+    matrix product per layer.  Padding genomes of different shapes to a common shape was measured to cost more than
+    evaluating the genomes one at a time, since mutated populations differ mostly in depth, so genomes are only ever
+    packed with genomes of the same shape.
+
+    Only sum aggregation can be written as a matrix product.  Genomes using any other aggregation, or with constant
+    nodes, are evaluated one at a time with their CompiledNetwork and the results are merged with the batched ones.
+    """
+
+    def __init__(self, genome_ids: Tuple[int, ...], networks: Dict[int, CompiledNetwork]) -> None:
+        self.genome_ids = genome_ids
+        self.networks = networks
+        self.packed_ids = tuple(
+            genome_id for genome_id in genome_ids
+            if all(name == "sum" for layer in networks[genome_id].layers for name in layer.aggregations)
+            and not networks[genome_id].constants
+        )
+        self.unpacked_ids = tuple(genome_id for genome_id in genome_ids if genome_id not in self.packed_ids)
+        self.num_inputs = len(networks[genome_ids[0]].input_nodes) if genome_ids else 0
+        self.num_outputs = len(networks[genome_ids[0]].output_nodes) if genome_ids else 0
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for genome_id in self.packed_ids:
+            widths = tuple(len(layer.node_keys) for layer in networks[genome_id].layers)
+            groups.setdefault(widths, []).append(genome_id)
+        self.groups = tuple(tuple(group) for group in groups.values())
+        self.packs = tuple(
+            PackedNetworks([networks[genome_id] for genome_id in group], self.num_inputs, self.num_outputs)
+            for group in self.groups
+        )
+
+    @staticmethod
+    def create(genomes: Dict[int, neat.DefaultGenome], config: neat.Config) -> "CompiledPopulation":
+        """Compile every genome in a dictionary of genome ids to genomes, such as neat.Population.population."""
+        genome_ids = tuple(genomes.keys())
+        networks = {genome_id: CompiledNetwork.create(genome, config) for genome_id, genome in genomes.items()}
+        return CompiledPopulation(genome_ids, networks)
+
+    def activate_batch(
+        self, inputs: np.ndarray, max_values: int = 2 ** 20, fixed_inputs: Dict[int, float] = None,
+    ) -> np.ndarray:
+        """Evaluate every genome and return an array of shape (genomes, N, num_outputs).
+
+        The inputs are either an (N, num_inputs) array shared by all genomes or a (genomes, N, num_inputs) array
+        giving each genome its own inputs, with genomes in the order of genome_ids.  When fixed_inputs maps input
+        positions to values that are the same for every row, the inputs array only holds the remaining inputs.  Rows
+        are evaluated in chunks so that no more than roughly max_values intermediate node values are held at once.
+        """
+        fixed_inputs = {} if fixed_inputs is None else fixed_inputs
+        num_free_inputs = self.num_inputs - len(fixed_inputs)
+        inputs = np.asarray(inputs, dtype=float)
+        if inputs.ndim == 2:
+            inputs = inputs[np.newaxis, :, :]
+        if inputs.ndim != 3 or inputs.shape[2] != num_free_inputs or inputs.shape[0] not in (1, len(self.genome_ids)):
+            raise RuntimeError(
+                "Expected an array of shape (N, {0:n}) or ({1:n}, N, {0:n}), got {2}".format(
+                    num_free_inputs, len(self.genome_ids), np.shape(inputs)
+                )
+            )
+        rows = inputs.shape[1]
+        outputs = np.zeros((len(self.genome_ids), rows, self.num_outputs))
+        position = {genome_id: i for i, genome_id in enumerate(self.genome_ids)}
+
+        for group, pack in zip(self.groups, self.packs):
+            positions = [position[genome_id] for genome_id in group]
+            pack_inputs = inputs if inputs.shape[0] == 1 else inputs[positions]
+            chunk = max(1, max_values // max(1, len(group) * pack.num_slots))
+            for start in range(0, rows, chunk):
+                outputs[positions, start: start + chunk] = pack.activate_batch(
+                    pack_inputs[:, start: start + chunk], fixed_inputs
+                )
+
+        for genome_id in self.unpacked_ids:
+            genome_inputs = inputs[0] if inputs.shape[0] == 1 else inputs[position[genome_id]]
+            network = self.networks[genome_id]
+            if fixed_inputs:
+                network = network.specialise(fixed_inputs)
+            outputs[position[genome_id]] = network.activate_batch(genome_inputs)
+        return outputs
@@ -1,7 +1,9 @@
+import bisect
+import heapq
 import numpy as np
 from itertools import chain
 from typing import NamedTuple
-from typing import Iterable, Dict, Tuple, Callable
+from typing import Iterable, Iterator, Dict, List, Tuple, Callable, Optional, Set
 import pygame
 
 from core.image import MakeSurface
@@ -37,10 +39,74 @@ class MapGridToScreen:
 
 
 class Renderable(NamedTuple):
-    """Data describing an object to be rendered on screen."""
+    """Data describing an object to be rendered on screen.
+
+    A surface_getter, when given, returns a ready made Surface and is used instead of making one from the arrays.
+    """
     array_getter: Callable
     position: Tuple[int, int]
     priority: Tuple[int, int]
+    surface_getter: Callable = None
+
+
+class RenderQueue:
+    """Renderables held in drawing order, so that drawing them does not require sorting them every frame.
+
+    Renderables are kept in buckets keyed by their priority, i.e. (layer, bottom y), and the keys are kept sorted.
+    Renderables with the same priority are drawn in the order they were inserted, as with a stable sort.
+    The (surface, position) commands for drawing the queue are made once and reused until the queue changes.
+    """
+
+    def __init__(self, renderables: Iterable[Renderable] = ()) -> None:
+        self.buckets: Dict[Tuple[int, int], List[Renderable]] = {}
+        for renderable in renderables:
+            self.buckets.setdefault(renderable.priority, []).append(renderable)
+        self.priorities: List[Tuple[int, int]] = sorted(self.buckets)
+        self.count = sum(len(bucket) for bucket in self.buckets.values())
+        self.commands: Optional[List[Tuple[pygame.surface.Surface, Tuple[int, int]]]] = None
+
+    def __iter__(self) -> Iterator[Renderable]:
+        for priority in self.priorities:
+            yield from self.buckets[priority]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def insert(self, renderable: Renderable) -> None:
+        bucket = self.buckets.get(renderable.priority)
+        if bucket is None:
+            bucket = self.buckets[renderable.priority] = []
+            bisect.insort(self.priorities, renderable.priority)
+        bucket.append(renderable)
+        self.count += 1
+        self.invalidate()
+
+    def remove(self, renderable: Renderable) -> None:
+        """Remove a renderable, raising a ValueError if it is not in the queue."""
+        bucket = self.buckets.get(renderable.priority)
+        if bucket is None:
+            raise ValueError(f"{renderable} is not in the render queue")
+        bucket.remove(renderable)
+        if not bucket:
+            del self.buckets[renderable.priority]
+            del self.priorities[bisect.bisect_left(self.priorities, renderable.priority)]
+        self.count -= 1
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Forget the blit commands, e.g. after the surfaces the renderables return have changed."""
+        self.commands = None
+
+    def blit_commands(self) -> List[Tuple[pygame.surface.Surface, Tuple[int, int]]]:
+        """The (surface, position) pairs for drawing the queue with Surface.blits, made when first needed."""
+        if self.commands is None:
+            self.commands = Render.blit_commands(self)
+        return self.commands
+
+    @staticmethod
+    def merge(*sources: Iterable[Renderable]) -> Iterator[Renderable]:
+        """Combine sources that are each already in drawing order, e.g. RenderQueues, into a single drawing order."""
+        return heapq.merge(*sources, key=lambda renderable: renderable.priority)
 
 
 class Render:
@@ -55,20 +121,58 @@ class Render:
         """
         return sorted(image_info, key=lambda x: x[2][0] * 100000000000 + x[2][1])
 
+    def sprite(renderable: Renderable) -> pygame.surface.Surface:
+        """Get the Surface to draw for a Renderable, making one from its arrays if it has no surface_getter."""
+        if renderable.surface_getter is not None:
+            return renderable.surface_getter()
+        rgb_array, alphas_array = renderable.array_getter()
+        return MakeSurface.from_rgb_and_alpha_arrays(rgb_array, alphas_array)
+
+    def blit_commands(
+        ordered_renderables: Iterable[Renderable],
+    ) -> List[Tuple[pygame.surface.Surface, Tuple[int, int]]]:
+        """Make a flat list of (surface, position) pairs, in drawing order, that can be passed to Surface.blits."""
+        return [(Render.sprite(renderable), renderable.position) for renderable in ordered_renderables]
+
+    def composite(renderables: Iterable[Renderable]) -> Optional[Renderable]:
+        """Draw renderables onto one Surface just large enough to hold them and return it as a single Renderable.
+
+        The composite has the highest priority of the renderables it holds, so it is drawn after all of them would be.
+        """
+        ordered_renderables = Render.order_by_priority(renderables)
+        if not ordered_renderables:
+            return None
+        commands = Render.blit_commands(ordered_renderables)
+        bounds = pygame.Rect(commands[0][1], commands[0][0].get_size()).unionall(
+            [pygame.Rect(position, sprite.get_size()) for sprite, position in commands]
+        )
+        surface = pygame.surface.Surface(bounds.size, pygame.SRCALPHA)
+        surface.blits(
+            [(sprite, (position[0] - bounds.left, position[1] - bounds.top)) for sprite, position in commands],
+            doreturn=False,
+        )
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert_alpha()
+        return Renderable(None, bounds.topleft, ordered_renderables[-1].priority, lambda: surface)
+
     def on_screen(
         screen: pygame.surface.Surface,
-        renderables: Iterable[Renderable],
+        *sources: Iterable[Renderable],
     ) -> None:
         """Determine order that sprites should be drawn in and blit them onto the screen.
 
         Note: ordering is the last step before drawing so that sprites combined from different
         sources or generated by different processes can be ordered correctly relative to eachother.
+        Sources that are RenderQueues are already in order and are only merged rather than sorted.
+        A single RenderQueue is drawn with the blit commands it keeps between frames.
         """
-        ordered_sprites_info = Render.order_by_priority(renderables)
-        for (array_getter, position, _) in ordered_sprites_info:
-            rgb_array, alphas_array = array_getter()
-            sprite = MakeSurface.from_rgb_and_alpha_arrays(rgb_array, alphas_array)
-            screen.blit(sprite, position)
+        if len(sources) == 1 and isinstance(sources[0], RenderQueue):
+            commands = sources[0].blit_commands()
+        elif sources and all(isinstance(source, RenderQueue) for source in sources):
+            commands = Render.blit_commands(RenderQueue.merge(*sources))
+        else:
+            commands = Render.blit_commands(Render.order_by_priority(chain.from_iterable(sources)))
+        screen.blits(commands, doreturn=False)
 
 
 class PrepareForRendering:
@@ -86,11 +190,12 @@ class PrepareForRendering:
         *,
         array_getter: Callable,
         top_left_of_tile: Tuple[int, int],
-        dimensions: Tuple[int, int]
+        dimensions: Tuple[int, int],
+        surface_getter: Callable = None,
     ) -> Iterable[Tuple[str, np.array, Tuple[int, int]]]:
         """Make an iterable of tuples describing how to render a floor tile."""
         return (
-            Renderable(array_getter, top_left_of_tile, (0, top_left_of_tile[1] + dimensions[1])),
+            Renderable(array_getter, top_left_of_tile, (0, top_left_of_tile[1] + dimensions[1]), surface_getter),
         )
 
     def wall_and_roof_tile_renderables(
@@ -101,6 +206,8 @@ class PrepareForRendering:
         cell_dimensions: Tuple[int, int],
         wall_dimensions: Tuple[int, int],
         roof_dimensions: Tuple[int, int],
+        wall_surface_getter: Callable = None,
+        roof_surface_getter: Callable = None,
     ) -> Iterable[Renderable]:
         """Make an iterable of tuples describing how to render a block with a wall and a roof tile.
 
@@ -117,10 +224,61 @@ class PrepareForRendering:
         wall_bottom_left[1] += cell_dimensions[1]
         roof_bottom_left = wall_top_left
         return (
-            Renderable(wall_array_getter, tuple(wall_top_left), (1, wall_bottom_left[1])),
-            Renderable(roof_array_getter, tuple(roof_top_left), (1, roof_bottom_left[1])),
+            Renderable(wall_array_getter, tuple(wall_top_left), (1, wall_bottom_left[1]), wall_surface_getter),
+            Renderable(roof_array_getter, tuple(roof_top_left), (1, roof_bottom_left[1]), roof_surface_getter),
         )
 
+    def grid_context_3x3(grid: np.ndarray, i: int, j: int) -> np.ndarray:
+        """Make the 3x3 matrix of cells centered on cell (i, j) of a grid.
+
+        This may need optimising.
+        """
+
+        def _at(i, j) -> int:
+            """Get contentes of grid at (i, j) or return 0 if (i, j) is outside the grid."""
+            try:
+                return grid[i, j]
+            except(IndexError):
+                return 0
+
+        return np.array([
+            [_at(i - 1, j - 1), _at(i - 1, j), _at(i - 1, j + 1)],
+            [_at(i,     j - 1), _at(i,     j), _at(i,     j + 1)],
+            [_at(i + 1, j - 1), _at(i + 1, j), _at(i + 1, j + 1)],
+        ])
+
+    def nn_inputs_for_cell_tiles(grid_context_3x3: np.ndarray) -> Dict[str, Tuple[int, ...]]:
+        """Map the types of the tiles drawn for a cell to the NN inputs their sprites are looked up with."""
+        this_cell_in_grid = grid_context_3x3[1, 1]
+        if this_cell_in_grid == 0:
+            return {"floor": (grid_context_3x3[1, 0], grid_context_3x3[0, 1], grid_context_3x3[1, 2],)}
+        elif this_cell_in_grid == 1:
+            return {
+                "wall": (grid_context_3x3[1, 0], grid_context_3x3[1, 2],),
+                "roof": (grid_context_3x3[1, 0], grid_context_3x3[2, 1], grid_context_3x3[1, 2],),
+            }
+        else:
+            raise ValueError(f"Unexpected value in middle cell: {this_cell_in_grid =}")
+
+    def nn_inputs_for_grid(grid: np.ndarray) -> Dict[str, Set[Tuple[int, ...]]]:
+        """Collect the NN inputs of every tile type that drawing a grid looks up, e.g. to render them ahead of time."""
+        out = {}
+        rows, columns = np.shape(grid)
+        for irow in range(rows):
+            for icol in range(columns):
+                cell_nn_inputs = PrepareForRendering.nn_inputs_for_cell_tiles(
+                    PrepareForRendering.grid_context_3x3(grid, irow, icol)
+                )
+                for tile_type, nn_input in cell_nn_inputs.items():
+                    out.setdefault(tile_type, set()).add(tuple(int(value) for value in nn_input))
+        return out
+
+    def surface_getter(prototype: TilePrototype, nn_input: Tuple[int, ...]) -> Optional[Callable]:
+        """Make a function returning the prototype's cached Surface for an NN input, if the prototype caches them."""
+        if prototype.surfaces is None:
+            return None
+        return lambda: prototype.surfaces.surface(nn_input)
+
     def renderables_for_cell_tiles(
         *,
         tile_prototypes: Dict[str, TilePrototype],
@@ -131,20 +289,21 @@ class PrepareForRendering:
         roof_dimensions: Tuple[int, int],
     ) -> Iterable[Renderable]:
         """Make Rendrable for a cell based on its contents and context."""
-        this_cell_in_grid = grid_context_3x3[1, 1]
-        if this_cell_in_grid == 0:
+        cell_nn_inputs = PrepareForRendering.nn_inputs_for_cell_tiles(grid_context_3x3)
+        if "floor" in cell_nn_inputs:
             floor_prototype = tile_prototypes["floor"]
-            floor_inputs = (grid_context_3x3[1, 0], grid_context_3x3[0, 1], grid_context_3x3[1, 2],)
+            floor_inputs = cell_nn_inputs["floor"]
             return PrepareForRendering.floor_tile_renderables(
                 array_getter=(lambda: floor_prototype.inputs_to_rgbs_and_alphas[floor_inputs]),
                 top_left_of_tile=top_left_of_tile,
                 dimensions=cell_dimensions,
+                surface_getter=PrepareForRendering.surface_getter(floor_prototype, floor_inputs),
             )
-        elif this_cell_in_grid == 1:
+        else:
             wall_prototype = tile_prototypes["wall"]
             roof_prototype = tile_prototypes["roof"]
-            wall_inputs = (grid_context_3x3[1, 0], grid_context_3x3[1, 2],)
-            roof_inputs = (grid_context_3x3[1, 0], grid_context_3x3[2, 1], grid_context_3x3[1, 2],)
+            wall_inputs = cell_nn_inputs["wall"]
+            roof_inputs = cell_nn_inputs["roof"]
             return PrepareForRendering.wall_and_roof_tile_renderables(
                 wall_array_getter=(lambda: wall_prototype.inputs_to_rgbs_and_alphas[wall_inputs]),
                 roof_array_getter=(lambda: roof_prototype.inputs_to_rgbs_and_alphas[roof_inputs]),
@@ -152,9 +311,9 @@ class PrepareForRendering:
                 cell_dimensions=cell_dimensions,
                 wall_dimensions=wall_dimensions,
                 roof_dimensions=roof_dimensions,
+                wall_surface_getter=PrepareForRendering.surface_getter(wall_prototype, wall_inputs),
+                roof_surface_getter=PrepareForRendering.surface_getter(roof_prototype, roof_inputs),
             )
-        else:
-            raise ValueError(f"Unexpected value in middle cell: {this_cell_in_grid =}")
 
     def collect_renderables_for_grid(
         *,
@@ -169,22 +328,6 @@ class PrepareForRendering:
 
         Takes a 2D grid of integer contianing cells and use it to generate Renderable objects.
         """
-        def _create_grid_context_3x3(grid, i, j) -> np.ndarray:
-            """This may need optimising."""
-
-            def _at(i, j) -> int:
-                """Get contentes of grid at (i, j) or return 0 if (i, j) is outside the grid."""
-                try:
-                    return grid[i, j]
-                except(IndexError):
-                    return 0
-
-            return np.array([
-                [_at(i - 1, j - 1), _at(i - 1, j), _at(i - 1, j + 1)],
-                [_at(i,     j - 1), _at(i,     j), _at(i,     j + 1)],
-                [_at(i + 1, j - 1), _at(i + 1, j), _at(i + 1, j + 1)],
-            ])
-
         out = []
         rows, columns = np.shape(grid)
         for irow in range(rows):
@@ -196,7 +339,7 @@ class PrepareForRendering:
                 )
                 cell_renderables: Iterable[Renderable] = PrepareForRendering.renderables_for_cell_tiles(
                     tile_prototypes=tile_prototypes,
-                    grid_context_3x3=_create_grid_context_3x3(grid, irow, icol),
+                    grid_context_3x3=PrepareForRendering.grid_context_3x3(grid, irow, icol),
                     top_left_of_tile=top_left_of_cell,
                     cell_dimensions=cell_dimensions,
                     wall_dimensions=wall_dimensions,
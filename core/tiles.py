@@ -1,10 +1,15 @@
 # from collections import namedtuple
 import os
 import numpy as np
-from typing import Tuple, Any, Iterable, Dict, NamedTuple, List, Callable
+from concurrent.futures import Executor
+from collections.abc import Mapping
+from typing import Tuple, Any, Iterable, Iterator, Dict, NamedTuple, List, Callable, Optional, Sequence, Union
 import neat
 
-from core.image import ImageConvert
+from core.image import ImageConvert, SurfaceCache
+from core.networks import CompiledNetwork, CompiledPopulation, NetworkAnalysis
+from core.caches import FeatureGridCache, PrototypeCache, PrototypeDiskCache, SpriteStore
+from helpers.imports import ImportPaths
 
 
 class TilePrototype(NamedTuple):
@@ -14,14 +19,329 @@ class TilePrototype(NamedTuple):
     on the contents of adjacent grid cells.
 
     The tile prototype stores image arrays so that they don't need to be computed for every tile instance (or every
-    frame).
+    frame).  It may also hold a SurfaceCache so that the Surfaces made from those arrays are kept as well.
     """
     tile_type: str
     dimensions: Tuple[int, int]
     genome_id: int
     config: neat.genome.DefaultGenomeConfig  # Not sure if this should be config.Config or not.
     neural_network: Any
-    inputs_to_rgbs_and_alphas: Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]
+    inputs_to_rgbs_and_alphas: Mapping  # NN inputs to RGB and alpha arrays, e.g. a dict or a ContextRGBAs.
+    surfaces: SurfaceCache = None
+
+
+class ContextRGBAs(Mapping):
+    """The sprites of a genome for every NN input, stored in one contiguous uint8 block of shape (sprites, W, H, 4).
+
+    Looking up an NN input gives read-only views of its RGB and alpha values, so that a ContextRGBAs can stand in for
+    a dictionary of NN inputs to RGB and alpha arrays.  NN inputs that share a sprite share a row of the block.
+
+    Given a SpriteStore, rgbas becomes a tuple of the store's shared copies of each sprite instead of a block, so that
+    pixel-identical sprites of different genomes are kept once.
+    """
+
+    def __init__(
+        self, rgbas: np.ndarray, rows: Dict[Tuple[int, ...], int], sprite_store: SpriteStore = None,
+    ) -> None:
+        digests = None
+        if sprite_store is not None:
+            digests, rgbas = zip(*(sprite_store.intern(rgba) for rgba in rgbas)) if len(rgbas) else ((), ())
+            sprite_store.track(self, digests)
+        elif isinstance(rgbas, np.ndarray):
+            rgbas.flags.writeable = False
+        self.rgbas = rgbas
+        self.digests: Optional[Tuple[str, ...]] = digests
+        self.rows = rows
+        # Keep one pair of views per sprite so that lookups neither allocate nor break sharing between NN inputs.
+        self.rgbs_and_alphas = tuple((rgba[..., 0:3], rgba[..., 3]) for rgba in rgbas)
+
+    def __getitem__(self, nn_input: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        return self.rgbs_and_alphas[self.rows[nn_input]]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __reduce__(self):
+        return (ContextRGBAs, (np.array(self.rgbas), self.rows))
+
+    def rgba(self, nn_input: Tuple[int, ...]) -> np.ndarray:
+        """The (W, H, 4) RGBA view of the sprite of an NN input."""
+        return self.rgbas[self.rows[nn_input]]
+
+    def digest(self, nn_input: Tuple[int, ...]) -> Optional[str]:
+        """The SpriteStore digest of the sprite of an NN input, or None if the sprites are not in a SpriteStore."""
+        return None if self.digests is None else self.digests[self.rows[nn_input]]
+
+    def as_rgba(rgb: np.ndarray, alpha: np.ndarray) -> Union[np.ndarray, None]:
+        """Combine RGB and alpha arrays into a (W, H, 4) uint8 array, or None if uint8 can not hold them exactly."""
+        if np.shape(rgb) != (*np.shape(alpha), 3):
+            return None
+        rgba = np.empty((*np.shape(alpha), 4), dtype=np.uint8)
+        with np.errstate(invalid="ignore"):
+            rgba[..., 0:3] = rgb
+            rgba[..., 3] = alpha
+        if not (np.array_equal(rgba[..., 0:3], rgb) and np.array_equal(rgba[..., 3], alpha)):
+            return None
+        return rgba
+
+    def pack(
+        inputs_to_rgbs_and_alphas: Dict[Tuple[int, ...], Tuple[np.ndarray, np.ndarray]],
+        sprite_store: SpriteStore = None,
+    ) -> Union["ContextRGBAs", Dict[Tuple[int, ...], Tuple[np.ndarray, np.ndarray]]]:
+        """Pack a dictionary of NN inputs to RGB and alpha arrays into a ContextRGBAs.
+
+        NN inputs whose arrays are the same tuple object share a row.  The dictionary is returned unchanged if its
+        sprites differ in shape or hold values that uint8 can not represent exactly, such as NaN.
+        """
+        rows = {}
+        sprites = {}
+        for nn_input, rgb_and_alpha in inputs_to_rgbs_and_alphas.items():
+            rows[nn_input] = sprites.setdefault(id(rgb_and_alpha), (len(sprites), rgb_and_alpha))[0]
+        if not sprites:
+            return inputs_to_rgbs_and_alphas
+        shapes = {(np.shape(rgb), np.shape(alpha)) for _, (rgb, alpha) in sprites.values()}
+        if len(shapes) != 1:
+            return inputs_to_rgbs_and_alphas
+        rgb_shape, alpha_shape = shapes.pop()
+        if rgb_shape != (*alpha_shape, 3):
+            return inputs_to_rgbs_and_alphas
+        rgbas = np.empty((len(sprites), *alpha_shape, 4), dtype=np.uint8)
+        for row, (rgb, alpha) in sprites.values():
+            rgba = ContextRGBAs.as_rgba(rgb, alpha)
+            if rgba is None:
+                return inputs_to_rgbs_and_alphas
+            rgbas[row] = rgba
+        return ContextRGBAs(rgbas, rows, sprite_store)
+
+
+class LazyContextArrays(Mapping):
+    """A mapping of NN inputs to RGB and alpha arrays that renders the arrays of each NN input when first looked up.
+
+    render(nn_inputs) returns a dictionary of arrays for a tuple of NN inputs.  NN inputs known to give identical
+    arrays can be given as context_groups, keyed by the first member of each group, so that only the first member is
+    rendered.  Rendered arrays are kept and made read-only because every later lookup shares them.
+
+    Pickling renders every NN input and stores a plain dictionary.
+
+    Given a SpriteStore, rendered sprites that uint8 can represent exactly are replaced by views of the store's shared
+    copies.
+    """
+
+    def __init__(
+        self,
+        nn_inputs: Iterable[Tuple[int, ...]],
+        render: Callable[[Tuple[Tuple[int, ...], ...]], Dict[Tuple[int, ...], Tuple[np.ndarray, np.ndarray]]],
+        context_groups: Dict[Tuple[int, ...], Tuple[Tuple[int, ...], ...]] = None,
+        sprite_store: SpriteStore = None,
+    ) -> None:
+        self.nn_inputs = tuple(nn_inputs)
+        self.render = render
+        if context_groups is None:
+            context_groups = {nn_input: (nn_input,) for nn_input in self.nn_inputs}
+        self.context_groups = context_groups
+        self.first_members = {member: first for first, members in context_groups.items() for member in members}
+        self.rendered: Dict[Tuple[int, ...], Tuple[np.ndarray, np.ndarray]] = {}
+        self.sprite_store = sprite_store
+        self.digests: Dict[Tuple[int, ...], str] = {}
+
+    def __getitem__(self, nn_input: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        if nn_input not in self.rendered:
+            self.prewarm((nn_input,))
+        return self.rendered[nn_input]
+
+    def __contains__(self, nn_input: Any) -> bool:
+        return nn_input in self.first_members
+
+    def __iter__(self):
+        return iter(self.nn_inputs)
+
+    def __len__(self) -> int:
+        return len(self.nn_inputs)
+
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+    def digest(self, nn_input: Tuple[int, ...]) -> Optional[str]:
+        """The SpriteStore digest of the sprite of an NN input, or None if it is not in a SpriteStore."""
+        self.prewarm((nn_input,))
+        return self.digests.get(nn_input)
+
+    def missing(self, nn_inputs: Iterable[Tuple[int, ...]]) -> Tuple[Tuple[int, ...], ...]:
+        """The given NN inputs whose arrays have not been rendered yet."""
+        return tuple(nn_input for nn_input in nn_inputs if nn_input not in self.rendered)
+
+    def fill(self, arrays: Dict[Tuple[int, ...], Tuple[np.ndarray, np.ndarray]]) -> None:
+        """Keep arrays rendered elsewhere, sharing them with the rest of each NN input's group."""
+        for nn_input, rgb_and_alpha in arrays.items():
+            if nn_input in self.rendered:
+                continue
+            rgba = None if self.sprite_store is None else ContextRGBAs.as_rgba(*rgb_and_alpha)
+            digest = None
+            if rgba is not None:
+                digest, shared = self.sprite_store.intern(rgba)
+                self.sprite_store.track(self, (digest,))
+                rgb_and_alpha = (shared[..., 0:3], shared[..., 3])
+            for array in rgb_and_alpha:
+                if isinstance(array, np.ndarray):
+                    array.flags.writeable = False
+            for member in self.context_groups[self.first_members[nn_input]]:
+                if member not in self.rendered and digest is not None:
+                    self.digests[member] = digest
+                self.rendered.setdefault(member, rgb_and_alpha)
+
+    def prewarm(self, nn_inputs: Iterable[Tuple[int, ...]]) -> None:
+        """Render the arrays of every given NN input that has not been rendered yet, in a single call to render."""
+        # Raises KeyError for NN inputs that are not part of this mapping.
+        firsts = tuple(dict.fromkeys(self.first_members[nn_input] for nn_input in self.missing(nn_inputs)))
+        if firsts:
+            self.fill(self.render(firsts))
+
+
+class PixelImageGenerator(NamedTuple):
+    """An image generating function that evaluates the network once per pixel, split into two batchable halves.
+
+    pixel_features(sprite_dimensions, tile_type) returns a (width * height, F) array of the network inputs that vary
+    from pixel to pixel, ordered so that reshaping to (width, height) gives pixel [x, y].  The NN input describing the
+    tile's context is prepended to every row to make the full network input.
+
+    image_from_outputs(nn_outputs, palette, tile_type) turns a (width, height, num_outputs) array of network outputs
+    into the RGB and alpha arrays of a sprite.
+
+    The optional axis_features(sprite_dimensions, tile_type) returns the same features as a sequence of arrays that
+    broadcast to (width, height), such as (width, 1) for features that only depend on x.  Networks that support it
+    then evaluate nodes that only depend on one axis once per row or column instead of once per pixel.
+
+    With a FeatureGridCache the features and network inputs are built once per sprite size, tile type and NN input and
+    shared by every genome rather than rebuilt for every sprite.
+
+    Specialising a network to the NN input and evaluating it axis by axis only pays for itself on large sprites, so it
+    is only done for sprites with at least specialise_min_pixels pixels (about 128 * 128 when measured).  Smaller
+    sprites are evaluated with a single activate_batch on the full network inputs, or, when a TilePrototypeMaker
+    renders a whole population, with CompiledPopulation.activate_batch.
+    """
+    pixel_features: Callable[[Tuple[int, int], str], np.ndarray]
+    image_from_outputs: Callable[
+        [np.ndarray, Iterable[Tuple[int, int, int, int]], str], Tuple[np.ndarray, np.ndarray]
+    ]
+    axis_features: Callable[[Tuple[int, int], str], Sequence[np.ndarray]] = None
+    feature_grid_cache: FeatureGridCache = None
+    specialise_min_pixels: int = 128 * 128
+
+    def features(self, sprite_dimensions: Tuple[int, int], tile_type: str) -> np.ndarray:
+        """The (width * height, F) per-pixel features, read-only when they come from the feature grid cache."""
+        if self.feature_grid_cache is not None:
+            return self.feature_grid_cache.features(self.pixel_features, sprite_dimensions, tile_type)
+        return self.pixel_features(sprite_dimensions, tile_type)
+
+    def network_inputs(self, nn_input: Iterable[int], sprite_dimensions: Tuple[int, int], tile_type: str) -> np.ndarray:
+        """Combine the context input with the per-pixel features to give a (width * height, num_inputs) array."""
+        if self.feature_grid_cache is not None:
+            return self.feature_grid_cache.network_inputs(self.pixel_features, nn_input, sprite_dimensions, tile_type)
+        features = self.pixel_features(sprite_dimensions, tile_type)
+        context = np.tile(np.array(nn_input, dtype=float), (np.shape(features)[0], 1))
+        return np.hstack([context, features])
+
+    def image_from_network(
+        self,
+        neural_network: Any,
+        nn_input: Iterable[int],
+        sprite_dimensions: Tuple[int, int],
+        palette: Iterable[Tuple[int, int, int, int]],
+        tile_type=None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Generate a single sprite, with the same signature as TilePrototypeMaker.image_generating_function.
+
+        For sprites of at least specialise_min_pixels pixels, networks that can be specialised, such as a
+        CompiledNetwork, first fold the constant NN input into their biases so that only the per-pixel features are
+        evaluated for every pixel.
+        """
+        pixels = sprite_dimensions[0] * sprite_dimensions[1]
+        if hasattr(neural_network, "specialise") and pixels >= self.specialise_min_pixels:
+            specialised = neural_network.specialise(dict(enumerate(nn_input)))
+            if self.axis_features is not None:
+                nn_outputs = specialised.activate_separable(self.axis_features(sprite_dimensions, tile_type))
+            else:
+                nn_outputs = specialised.activate_batch(self.features(sprite_dimensions, tile_type))
+        else:
+            nn_outputs = neural_network.activate_batch(self.network_inputs(nn_input, sprite_dimensions, tile_type))
+        return self.image_from_outputs(np.reshape(nn_outputs, (*sprite_dimensions, -1)), palette, tile_type)
+
+
+class SequenceImageGenerator(NamedTuple):
+    """An image generating function that builds a sprite one row or column at a time, feeding each back to the network.
+
+    row_by_row(tile_type) is True when each step outputs a row of pixels (all x for one y) and False when it outputs a
+    column.  The network inputs of each step are the NN input describing the tile's context, then the outputs of the
+    previous step (zeros for the first step), then the values returned by the optional step_features(step,
+    sprite_dimensions, tile_type).  Each step's outputs hold one or more values per pixel, with the values of a pixel
+    next to each other.
+
+    image_from_outputs(nn_outputs, palette, tile_type) turns a (width, height, values per pixel) array of network
+    outputs into the RGB and alpha arrays of a sprite.
+    """
+    row_by_row: Callable[[str], bool]
+    image_from_outputs: Callable[
+        [np.ndarray, Iterable[Tuple[int, int, int, int]], str], Tuple[np.ndarray, np.ndarray]
+    ]
+    step_features: Callable[[int, Tuple[int, int], str], Sequence[float]] = None
+
+    def number_of_steps(self, sprite_dimensions: Tuple[int, int], tile_type: str) -> int:
+        """The number of rows or columns that make up a sprite."""
+        return sprite_dimensions[1] if self.row_by_row(tile_type) else sprite_dimensions[0]
+
+    def step_inputs(
+        self,
+        nn_inputs: np.ndarray,
+        previous_outputs: np.ndarray,
+        step: int,
+        sprite_dimensions: Tuple[int, int],
+        tile_type: str,
+    ) -> np.ndarray:
+        """Network inputs for one step of any number of sequences.
+
+        The NN inputs and previous outputs are arrays of shape (..., len(nn_input)) and (..., num_outputs).
+        """
+        parts = [nn_inputs, previous_outputs]
+        if self.step_features is not None:
+            features = np.array(self.step_features(step, sprite_dimensions, tile_type), dtype=float)
+            parts.append(np.broadcast_to(features, (*np.shape(nn_inputs)[0: -1], len(features))))
+        return np.concatenate(parts, axis=-1)
+
+    def image_from_steps(
+        self,
+        step_outputs: np.ndarray,
+        sprite_dimensions: Tuple[int, int],
+        palette: Iterable[Tuple[int, int, int, int]],
+        tile_type: str,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Arrange a (steps, num_outputs) array of network outputs as pixels and turn them into a sprite."""
+        if self.row_by_row(tile_type):
+            nn_outputs = np.transpose(np.reshape(step_outputs, (sprite_dimensions[1], sprite_dimensions[0], -1)),
+                                      (1, 0, 2))
+        else:
+            nn_outputs = np.reshape(step_outputs, (*sprite_dimensions, -1))
+        return self.image_from_outputs(nn_outputs, palette, tile_type)
+
+    def image_from_network(
+        self,
+        neural_network: Any,
+        nn_input: Iterable[int],
+        sprite_dimensions: Tuple[int, int],
+        palette: Iterable[Tuple[int, int, int, int]],
+        tile_type=None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Generate a single sprite, with the same signature as TilePrototypeMaker.image_generating_function."""
+        nn_input = np.array(nn_input, dtype=float)
+        step_outputs = []
+        previous_outputs = np.zeros(len(neural_network.output_nodes))
+        for step in range(self.number_of_steps(sprite_dimensions, tile_type)):
+            inputs = self.step_inputs(nn_input, previous_outputs, step, sprite_dimensions, tile_type)
+            previous_outputs = np.array(neural_network.activate(tuple(inputs)))
+            step_outputs.append(previous_outputs)
+        return self.image_from_steps(np.array(step_outputs), sprite_dimensions, palette, tile_type)
 
 
 class TilePrototypeMaker:
@@ -35,6 +355,36 @@ class TilePrototypeMaker:
     Wall: [West, East]
     Floor: [West, North, East]
     Roof: [West, South, East]
+
+    Networks are built with neat.nn.FeedForwardNetwork.create unless another neural_network_factory is given.  Image
+    generating functions that evaluate the network for every pixel can use core.networks.CompiledNetwork.create to
+    evaluate all pixels of a sprite in one call to activate_batch.
+
+    When a PixelImageGenerator is given instead of an image generating function every genome of a population is
+    compiled into a single CompiledPopulation, so that one batched evaluation produces the network outputs for every
+    genome, every NN input and every pixel of a tile type.
+
+    Similarly, a SequenceImageGenerator makes every genome build the sprites for every NN input at the same time, so
+    that each row or column of every sprite of a tile type is a single batched evaluation.
+
+    An optional PrototypeCache, kept between calls, lets genomes whose content has already been rendered with the
+    same settings (such as elites carried over to the next generation) reuse the existing arrays.  An optional
+    PrototypeDiskCache does the same across sessions for sprites packed into a ContextRGBAs.  An optional SpriteStore
+    keeps a single copy of pixel-identical sprites across genomes, NN inputs and generations.
+
+    With collapse_duplicate_contexts, NN inputs that only differ in network inputs a genome never connects to its
+    outputs are rendered once and share the same arrays.  This assumes that the NN input only affects the image
+    through the first network inputs, which is always the case for a PixelImageGenerator.
+
+    With lazy_contexts, prototypes hold a LazyContextArrays and only render the sprites of NN inputs that are looked
+    up.  The prewarm method renders the NN inputs a grid needs ahead of time, batched across genomes where possible.
+
+    Given an executor, such as a concurrent.futures.ProcessPoolExecutor kept for the whole session, genomes that need
+    rendering are split into chunks of executor_chunk_size genomes and each chunk is rendered by a worker with the
+    same method used without an executor, so the arrays are identical.  Workers receive a copy of the maker without
+    its populations, cache or executor; an image generating function given as an import path such as
+    "package.module:function" is imported again by each worker, so it need not be picklable.  Lazily rendered
+    prototypes are always rendered in this process.
     """
 
     def __init__(
@@ -86,23 +436,69 @@ class TilePrototypeMaker:
             "wall": os.path.join("data", "sprites", "dummy_wall_terracotta_32x12.png"),
             "roof": os.path.join("data", "sprites", "dummy_roof_blue_32x20.png"),
         },
-        image_generating_function: Callable[
-            [Any, Iterable[float], Tuple[int, int], Iterable[Tuple[int, int, int, int]]],
-            Tuple[np.ndarray, np.ndarray]
-        ] = None
+        image_generating_function: Union[
+            str, Callable[[Any, Iterable[float], Tuple[int, int], Iterable[Tuple[int, int, int, int]]],
+                          Tuple[np.ndarray, np.ndarray]]
+        ] = None,
+        neural_network_factory: Callable[[neat.DefaultGenome, neat.Config], Any] = None,
+        pixel_image_generator: PixelImageGenerator = None,
+        sequence_image_generator: SequenceImageGenerator = None,
+        prototype_cache: PrototypeCache = None,
+        disk_cache: PrototypeDiskCache = None,
+        sprite_store: SpriteStore = None,
+        collapse_duplicate_contexts: bool = False,
+        lazy_contexts: bool = False,
+        executor: Executor = None,
+        executor_chunk_size: int = 4,
     ) -> None:
         self.tiles_types_to_populations_configs = tiles_types_to_populations_configs
         self.sprite_dimensions = sprite_dimensions
         self.sprite_palettes = sprite_palettes
         self.nn_inputs = nn_inputs
         self.paths_to_default_pngs = paths_to_default_pngs
+        self.image_generating_function_path = None
         if image_generating_function is None:
             self.image_generating_function = TilePrototypeMaker.rgb_and_alpha
+        elif isinstance(image_generating_function, str):
+            self.image_generating_function_path = image_generating_function
+            self.image_generating_function = ImportPaths.resolve(image_generating_function)
         else:
             self.image_generating_function = image_generating_function
+        if neural_network_factory is None:
+            self.neural_network_factory = neat.nn.FeedForwardNetwork.create
+        else:
+            self.neural_network_factory = neural_network_factory
+        self.pixel_image_generator = pixel_image_generator
+        self.sequence_image_generator = sequence_image_generator
+        self.prototype_cache = prototype_cache
+        self.disk_cache = disk_cache
+        self.sprite_store = sprite_store
+        self.collapse_duplicate_contexts = collapse_duplicate_contexts
+        self.lazy_contexts = lazy_contexts
+        self.executor = executor
+        self.executor_chunk_size = executor_chunk_size
         # TODO: Validate given data.
         # Make sure set of sprite types (keys) matches for all dictionaries.
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """Leave out everything a worker process does not need to render a chunk of genomes."""
+        state = dict(self.__dict__)
+        state.update(
+            tiles_types_to_populations_configs={},
+            prototype_cache=None,
+            disk_cache=None,
+            sprite_store=None,
+            executor=None,
+        )
+        if self.image_generating_function_path is not None:
+            state["image_generating_function"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        if self.image_generating_function_path is not None:
+            self.image_generating_function = ImportPaths.resolve(self.image_generating_function_path)
+
     def rgb_and_alpha(
         neural_network: Any,
         nn_input: Iterable[int],
@@ -114,10 +510,26 @@ class TilePrototypeMaker:
         reshaped_output = np.reshape(np.array(nn_output), sprite_dimensions)
         return ImageConvert.matrix_to_rgb_palette_and_alphas(reshaped_output, palette)
 
-    def prototype_populations(self) -> Dict[str, Dict[int, TilePrototype]]:
-        """Make a dictionary of tile types to dictionaries of genome ids to TilePrototype instances."""
+    def _context_groups(
+        self, genome: neat.DefaultGenome, config: neat.Config, nn_inputs: Iterable[Tuple[int, ...]],
+    ) -> Dict[Tuple[int, ...], Tuple[Tuple[int, ...], ...]]:
+        """Group NN inputs that produce identical images, keyed by the first member of each group."""
+        if not self.collapse_duplicate_contexts:
+            return {nn_input: (nn_input,) for nn_input in nn_inputs}
+        used_positions = NetworkAnalysis.inputs_affecting_outputs(genome, config)
+        groups = {}
+        for nn_input in nn_inputs:
+            projected = tuple(value if i in used_positions else None for i, value in enumerate(nn_input))
+            groups.setdefault(projected, []).append(nn_input)
+        return {members[0]: tuple(members) for members in groups.values()}
+
+    def _render_genomes(
+        self, tile_type: str, genomes: Dict[int, neat.DefaultGenome], config: neat.Config,
+        nn_inputs: Iterable[Tuple[int, ...]] = None,
+    ) -> Dict[int, Tuple[Any, Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]]]:
+        """Make a network and sprite arrays one genome at a time using the image generating function."""
         def _inputs_to_arrays(
-            neural_network, nn_inputs: Iterable[Tuple], tile_type: str,
+            neural_network, context_groups: Dict[Tuple, Tuple[Tuple, ...]], tile_type: str,
         ) -> Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]:
             return {
                 nn_input: self.image_generating_function(
@@ -127,21 +539,402 @@ class TilePrototypeMaker:
                         self.sprite_palettes[tile_type],
                         tile_type=tile_type,
                     )
-                for nn_input in nn_inputs
+                for nn_input in context_groups
+            }
+
+        nn_inputs = self.nn_inputs[tile_type] if nn_inputs is None else nn_inputs
+        rendered = {}
+        for genome_id, genome in genomes.items():
+            neural_network = self.neural_network_factory(genome, config)
+            context_groups = self._context_groups(genome, config, nn_inputs)
+            arrays = _inputs_to_arrays(neural_network, context_groups, tile_type)
+            rendered[genome_id] = (
+                neural_network,
+                TilePrototypeMaker._alias_context_groups(arrays, context_groups, nn_inputs),
+            )
+        return rendered
+
+    def _population_context_groups(
+        self, genomes: Dict[int, neat.DefaultGenome], config: neat.Config, nn_inputs: Iterable[Tuple[int, ...]],
+    ) -> Tuple[Dict[int, Dict[Tuple[int, ...], Tuple[Tuple[int, ...], ...]]], Tuple[Tuple[int, ...], ...]]:
+        """Group the NN inputs of every genome and list the NN inputs that at least one genome needs evaluated."""
+        context_groups = {
+            genome_id: self._context_groups(genome, config, nn_inputs) for genome_id, genome in genomes.items()
+        }
+        evaluated = tuple(
+            nn_input for nn_input in nn_inputs if any(nn_input in groups for groups in context_groups.values())
+        )
+        return context_groups, evaluated
+
+    def _render_genomes_batched(
+        self, tile_type: str, genomes: Dict[int, neat.DefaultGenome], config: neat.Config,
+        nn_inputs: Iterable[Tuple[int, ...]] = None,
+    ) -> Dict[int, Tuple[Any, Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]]]:
+        """Make networks and sprite arrays for every genome by evaluating all of them in one pass."""
+        if not genomes:
+            return {}
+        sprite_dimensions = self.sprite_dimensions[tile_type]
+        nn_inputs = self.nn_inputs[tile_type] if nn_inputs is None else nn_inputs
+        compiled_population = CompiledPopulation.create(genomes, config)
+        context_groups, evaluated = self._population_context_groups(genomes, config, nn_inputs)
+        generator = self.pixel_image_generator
+        # The NN input is folded into the biases, so only the per-pixel features are evaluated for every pixel.
+        if generator.axis_features is not None and np.prod(sprite_dimensions) >= generator.specialise_min_pixels:
+            # Large sprites are cheaper to evaluate axis by axis, a genome at a time, than as one batch of pixels.
+            axis_features = generator.axis_features(sprite_dimensions, tile_type)
+            networks = [compiled_population.networks[genome_id] for genome_id in compiled_population.genome_ids]
+            # Shape (genomes, evaluated NN inputs, width, height, outputs).
+            nn_outputs = np.stack([
+                np.stack([
+                    network.specialise(dict(enumerate(nn_input))).activate_separable(axis_features)
+                    for nn_input in evaluated
+                ])
+                for network in networks
+            ])
+        else:
+            features = generator.features(sprite_dimensions, tile_type)
+            nn_outputs = np.stack([
+                np.reshape(
+                    compiled_population.activate_batch(features, fixed_inputs=dict(enumerate(nn_input))),
+                    (len(compiled_population.genome_ids), *sprite_dimensions, -1),
+                )
+                for nn_input in evaluated
+            ], axis=1)
+        rendered = {}
+        for g, genome_id in enumerate(compiled_population.genome_ids):
+            arrays = {
+                nn_input: self.pixel_image_generator.image_from_outputs(
+                    nn_outputs[g, evaluated.index(nn_input)], self.sprite_palettes[tile_type], tile_type
+                )
+                for nn_input in context_groups[genome_id]
+            }
+            rendered[genome_id] = (
+                compiled_population.networks[genome_id],
+                TilePrototypeMaker._alias_context_groups(arrays, context_groups[genome_id], nn_inputs),
+            )
+        return rendered
+
+    def _render_genomes_sequences(
+        self, tile_type: str, genomes: Dict[int, neat.DefaultGenome], config: neat.Config,
+        nn_inputs: Iterable[Tuple[int, ...]] = None,
+    ) -> Dict[int, Tuple[Any, Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]]]:
+        """Make networks and sprite arrays for every genome by advancing all of their sequences together."""
+        if not genomes:
+            return {}
+        generator = self.sequence_image_generator
+        sprite_dimensions = self.sprite_dimensions[tile_type]
+        nn_inputs = self.nn_inputs[tile_type] if nn_inputs is None else nn_inputs
+        compiled_population = CompiledPopulation.create(genomes, config)
+        context_groups, evaluated = self._population_context_groups(genomes, config, nn_inputs)
+        num_genomes = len(compiled_population.genome_ids)
+        contexts = np.broadcast_to(np.array(evaluated, dtype=float), (num_genomes, *np.shape(evaluated)))
+        previous_outputs = np.zeros((num_genomes, len(evaluated), compiled_population.num_outputs))
+        step_outputs = []
+        for step in range(generator.number_of_steps(sprite_dimensions, tile_type)):
+            inputs = generator.step_inputs(contexts, previous_outputs, step, sprite_dimensions, tile_type)
+            previous_outputs = compiled_population.activate_batch(inputs)
+            step_outputs.append(previous_outputs)
+        # Shape (genomes, evaluated NN inputs, steps, outputs).
+        step_outputs = np.stack(step_outputs, axis=2)
+        rendered = {}
+        for g, genome_id in enumerate(compiled_population.genome_ids):
+            arrays = {
+                nn_input: generator.image_from_steps(
+                    step_outputs[g, evaluated.index(nn_input)], sprite_dimensions, self.sprite_palettes[tile_type],
+                    tile_type,
+                )
+                for nn_input in context_groups[genome_id]
+            }
+            rendered[genome_id] = (
+                compiled_population.networks[genome_id],
+                TilePrototypeMaker._alias_context_groups(arrays, context_groups[genome_id], nn_inputs),
+            )
+        return rendered
+
+    def _image_from_network(
+        self, neural_network: Any, nn_input: Tuple[int, ...], tile_type: str,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Render a single sprite with whichever generator or image generating function this maker uses."""
+        if self.pixel_image_generator is not None:
+            image_function = self.pixel_image_generator.image_from_network
+        elif self.sequence_image_generator is not None:
+            image_function = self.sequence_image_generator.image_from_network
+        else:
+            image_function = self.image_generating_function
+        return image_function(
+            neural_network,
+            nn_input,
+            self.sprite_dimensions[tile_type],
+            self.sprite_palettes[tile_type],
+            tile_type=tile_type,
+        )
+
+    def _neural_network(self, genome: neat.DefaultGenome, config: neat.Config) -> Any:
+        """Make the kind of network this maker renders with, for genomes whose sprites are not rendered now."""
+        if self.pixel_image_generator is None and self.sequence_image_generator is None:
+            return self.neural_network_factory(genome, config)
+        return CompiledNetwork.create(genome, config)
+
+    def _cache_key(self, tile_type: str, genome: neat.DefaultGenome) -> Tuple:
+        return PrototypeCache.key(
+            genome,
+            tile_type,
+            self._image_function_name(),
+            self.sprite_palettes[tile_type],
+            self.sprite_dimensions[tile_type],
+            self.nn_inputs[tile_type],
+        )
+
+    def _store_on_disk(self, cache_key: Tuple, inputs_to_rgbs_and_alphas: Mapping) -> None:
+        if isinstance(inputs_to_rgbs_and_alphas, ContextRGBAs):
+            self.disk_cache.put(cache_key, inputs_to_rgbs_and_alphas.rgbas, inputs_to_rgbs_and_alphas.rows)
+
+    def _lazy_genomes(
+        self, tile_type: str, genomes: Dict[int, neat.DefaultGenome], config: neat.Config,
+    ) -> Dict[int, Tuple[Any, LazyContextArrays]]:
+        """Make a network for every genome and a LazyContextArrays that renders its sprites when they are looked up."""
+        rendered = {}
+        for genome_id, genome in genomes.items():
+            neural_network = self._neural_network(genome, config)
+
+            def _render(nn_inputs, neural_network=neural_network):
+                return {
+                    nn_input: self._image_from_network(neural_network, nn_input, tile_type) for nn_input in nn_inputs
+                }
+
+            rendered[genome_id] = (
+                neural_network,
+                LazyContextArrays(
+                    self.nn_inputs[tile_type],
+                    _render,
+                    self._context_groups(genome, config, self.nn_inputs[tile_type]),
+                    self.sprite_store,
+                ),
+            )
+        return rendered
+
+    def _alias_context_groups(
+        arrays: Dict[Tuple[int, ...], Tuple[np.ndarray, np.ndarray]],
+        context_groups: Dict[Tuple[int, ...], Tuple[Tuple[int, ...], ...]],
+        nn_inputs: Iterable[Tuple[int, ...]],
+    ) -> Dict[Tuple[int, ...], Tuple[np.ndarray, np.ndarray]]:
+        """Give every member of a group of NN inputs the arrays rendered for the first member, in nn_inputs order."""
+        aliased = {}
+        for first, members in context_groups.items():
+            for nn_input in members:
+                aliased[nn_input] = arrays[first]
+        return {nn_input: aliased[nn_input] for nn_input in nn_inputs}
+
+    def _image_function_name(self) -> str:
+        """Describe whichever function turns networks into sprites, for use in cache keys."""
+        if self.pixel_image_generator is not None:
+            generator = self.pixel_image_generator
+            functions = [generator.pixel_features, generator.image_from_outputs]
+            if generator.axis_features is not None:
+                functions.append(generator.axis_features)
+        elif self.sequence_image_generator is not None:
+            functions = [function for function in self.sequence_image_generator if function is not None]
+        else:
+            functions = [self.image_generating_function]
+        return "+".join(PrototypeCache.function_name(function) for function in functions)
+
+    def _render_uncached(
+        self, tile_type: str, genomes: Dict[int, neat.DefaultGenome], config: neat.Config,
+    ) -> Dict[int, Tuple[Any, Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]]]:
+        """Render every NN input of the given genomes with the generator or image generating function of this maker.
+
+        The sprites of each genome are packed into a ContextRGBAs where possible.
+        """
+        if self.pixel_image_generator is not None:
+            rendered = self._render_genomes_batched(tile_type, genomes, config)
+        elif self.sequence_image_generator is not None:
+            rendered = self._render_genomes_sequences(tile_type, genomes, config)
+        else:
+            rendered = self._render_genomes(tile_type, genomes, config)
+        return {
+            genome_id: (neural_network, ContextRGBAs.pack(inputs_to_rgbs_and_alphas))
+            for genome_id, (neural_network, inputs_to_rgbs_and_alphas) in rendered.items()
+        }
+
+    def _render_genomes_in_executor(
+        self, tile_type: str, genomes: Dict[int, neat.DefaultGenome], config: neat.Config,
+    ) -> Dict[int, Tuple[Any, Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]]]:
+        """Render chunks of genomes in the executor's workers and gather the results in the order of the genomes."""
+        genome_ids = list(genomes)
+        futures = [
+            self.executor.submit(
+                _render_uncached_in_worker,
+                self,
+                tile_type,
+                {genome_id: genomes[genome_id] for genome_id in genome_ids[first:first + self.executor_chunk_size]},
+                config,
+            )
+            for first in range(0, len(genome_ids), self.executor_chunk_size)
+        ]
+        rendered = {}
+        for future in futures:
+            rendered.update(future.result())
+        return rendered
+
+    def _prototype_population(
+        self, tile_type: str, genomes: Dict[int, neat.DefaultGenome], config: neat.Config,
+    ) -> Dict[int, TilePrototype]:
+        """Make TilePrototype instances for every genome, rendering only those that are not in the cache."""
+        cache_keys = {}
+        rendered = {}
+        if self.prototype_cache is not None or self.disk_cache is not None:
+            for genome_id, genome in genomes.items():
+                cache_keys[genome_id] = self._cache_key(tile_type, genome)
+        if self.prototype_cache is not None:
+            for genome_id, cache_key in cache_keys.items():
+                entry = self.prototype_cache.get(cache_key)
+                if entry is not None:
+                    rendered[genome_id] = entry
+        if self.disk_cache is not None:
+            for genome_id, cache_key in cache_keys.items():
+                stored = None if genome_id in rendered else self.disk_cache.get(cache_key)
+                if stored is not None:
+                    rendered[genome_id] = (
+                        self._neural_network(genomes[genome_id], config), ContextRGBAs(*stored, self.sprite_store)
+                    )
+                    if self.prototype_cache is not None:
+                        self.prototype_cache.put(cache_key, rendered[genome_id])
+
+        uncached = {
+            genome_id: genome for genome_id, genome in genomes.items() if genome_id not in rendered
+        }
+        if self.lazy_contexts:
+            newly_rendered = self._lazy_genomes(tile_type, uncached, config)
+        elif self.executor is not None and uncached:
+            newly_rendered = self._render_genomes_in_executor(tile_type, uncached, config)
+        else:
+            newly_rendered = self._render_uncached(tile_type, uncached, config)
+        if self.sprite_store is not None:
+            newly_rendered = {
+                genome_id: (neural_network, ContextRGBAs(arrays.rgbas, arrays.rows, self.sprite_store))
+                if isinstance(arrays, ContextRGBAs) else (neural_network, arrays)
+                for genome_id, (neural_network, arrays) in newly_rendered.items()
             }
+        if self.prototype_cache is not None:
+            for genome_id, entry in newly_rendered.items():
+                self.prototype_cache.put(cache_keys[genome_id], entry)
+        if self.disk_cache is not None:
+            for genome_id, (_, inputs_to_rgbs_and_alphas) in newly_rendered.items():
+                self._store_on_disk(cache_keys[genome_id], inputs_to_rgbs_and_alphas)
+        rendered.update(newly_rendered)
+
+        genomes_dict = {}
+        for genome_id in genomes:
+            neural_network, inputs_to_rgbs_and_alphas = rendered[genome_id]
+            genomes_dict[genome_id] = TilePrototype(
+                tile_type=tile_type,
+                dimensions=self.sprite_dimensions[tile_type],
+                genome_id=genome_id,
+                config=config,
+                neural_network=neural_network,
+                inputs_to_rgbs_and_alphas=inputs_to_rgbs_and_alphas,
+                surfaces=SurfaceCache(inputs_to_rgbs_and_alphas, self.sprite_store),
+            )
+        return genomes_dict
 
+    def prototype_populations(self) -> Dict[str, Dict[int, TilePrototype]]:
+        """Make a dictionary of tile types to dictionaries of genome ids to TilePrototype instances."""
         tile_types_dict = {}
         for tile_type, (population, config) in self.tiles_types_to_populations_configs.items():
-            genomes_dict = {}
-            for genome_id, genome in population.population.items():
-                neural_network = neat.nn.FeedForwardNetwork.create(genome, config)
-                genomes_dict[genome_id] = TilePrototype(
-                    tile_type=tile_type,
-                    dimensions=self.sprite_dimensions[tile_type],
-                    genome_id=genome_id,
-                    config=config,
-                    neural_network=neural_network,
-                    inputs_to_rgbs_and_alphas=_inputs_to_arrays(neural_network, self.nn_inputs[tile_type], tile_type)
-                )
-            tile_types_dict[tile_type] = genomes_dict
+            tile_types_dict[tile_type] = self._prototype_population(tile_type, population.population, config)
         return tile_types_dict
+
+    def iter_prototypes(
+        self,
+        order: Iterable[Tuple[str, int]] = None,
+        chunk_size: int = 1,
+        prewarm_nn_inputs: Dict[str, Iterable[Tuple[int, ...]]] = None,
+    ) -> Iterator[Tuple[str, int, TilePrototype]]:
+        """Yield (tile_type, genome_id, TilePrototype) for every genome as soon as its prototype is made.
+
+        Genomes are made in the given order of (tile_type, genome_id) pairs, such as the genomes of the buttons on
+        screen first, followed by any genomes the order leaves out.  By default the n-th genome of every tile type, by
+        genome id, comes before the (n + 1)-th.  Consecutive genomes of the same tile type are made together in chunks
+        of up to chunk_size genomes, which trades time to the first prototype for the benefits of batching.  With
+        lazy_contexts the NN inputs in prewarm_nn_inputs are rendered before a chunk is yielded.
+        """
+        order = [] if order is None else list(order)
+        listed = set(order)
+        ranks = {
+            (tile_type, genome_id): rank
+            for tile_type, (population, _) in self.tiles_types_to_populations_configs.items()
+            for rank, genome_id in enumerate(sorted(population.population))
+        }
+        order += sorted((pair for pair in ranks if pair not in listed), key=ranks.get)
+        chunks: List[Tuple[str, List[int]]] = []
+        for tile_type, genome_id in order:
+            if chunks and chunks[-1][0] == tile_type and len(chunks[-1][1]) < chunk_size:
+                chunks[-1][1].append(genome_id)
+            else:
+                chunks.append((tile_type, [genome_id]))
+        for tile_type, genome_ids in chunks:
+            population, config = self.tiles_types_to_populations_configs[tile_type]
+            prototypes = self._prototype_population(
+                tile_type, {genome_id: population.population[genome_id] for genome_id in genome_ids}, config
+            )
+            if prewarm_nn_inputs is not None and tile_type in prewarm_nn_inputs:
+                self.prewarm({tile_type: prototypes}, {tile_type: prewarm_nn_inputs[tile_type]})
+            for genome_id in genome_ids:
+                yield tile_type, genome_id, prototypes[genome_id]
+
+    def prewarm(
+        self,
+        tiles_genomes_prototypes: Dict[str, Dict[int, TilePrototype]],
+        tile_types_to_nn_inputs: Dict[str, Iterable[Tuple[int, ...]]],
+    ) -> None:
+        """Render the given NN inputs of lazily rendered prototypes, such as the NN inputs a grid of tiles needs.
+
+        With a PixelImageGenerator or a SequenceImageGenerator the missing sprites of every genome still in the
+        population are rendered in one batched pass per tile type.  Anything else is rendered one genome at a time.
+        Prototypes that end up with every NN input rendered are stored in the disk cache, if there is one.
+        """
+        for tile_type, wanted in tile_types_to_nn_inputs.items():
+            wanted = {tuple(int(value) for value in nn_input) for nn_input in wanted}
+            lazy_arrays = {
+                genome_id: prototype.inputs_to_rgbs_and_alphas
+                for genome_id, prototype in tiles_genomes_prototypes.get(tile_type, {}).items()
+                if isinstance(prototype.inputs_to_rgbs_and_alphas, LazyContextArrays)
+            }
+            missing = {genome_id: arrays.missing(wanted) for genome_id, arrays in lazy_arrays.items()}
+            nn_inputs = tuple(
+                nn_input for nn_input in self.nn_inputs[tile_type] if any(nn_input in m for m in missing.values())
+            )
+            if not nn_inputs:
+                continue
+            population, config = self.tiles_types_to_populations_configs[tile_type]
+            genomes = {
+                genome_id: population.population[genome_id] for genome_id in lazy_arrays
+                if missing[genome_id] and genome_id in population.population
+            }
+            if self.pixel_image_generator is not None:
+                rendered = self._render_genomes_batched(tile_type, genomes, config, nn_inputs)
+            elif self.sequence_image_generator is not None:
+                rendered = self._render_genomes_sequences(tile_type, genomes, config, nn_inputs)
+            else:
+                rendered = {}
+            for genome_id, arrays in lazy_arrays.items():
+                if genome_id in rendered:
+                    arrays.fill(rendered[genome_id][1])
+                arrays.prewarm(missing[genome_id])
+                if (
+                    self.disk_cache is not None and missing[genome_id] and genome_id in population.population
+                    and not arrays.missing(arrays.nn_inputs)
+                ):
+                    self._store_on_disk(
+                        self._cache_key(tile_type, population.population[genome_id]), ContextRGBAs.pack(dict(arrays))
+                    )
+
+
+def _render_uncached_in_worker(
+    tile_prototype_maker: TilePrototypeMaker,
+    tile_type: str,
+    genomes: Dict[int, neat.DefaultGenome],
+    config: neat.Config,
+) -> Dict[int, Tuple[Any, Dict[Iterable[int], Tuple[np.ndarray, np.ndarray]]]]:
+    """Render a chunk of genomes in a worker process, defined at module level so that executors can pickle it."""
+    return tile_prototype_maker._render_uncached(tile_type, genomes, config)
@@ -7,6 +7,7 @@ import neat
 from typing import Dict, Tuple, Iterable, Any, List
 
 from core.tiles import TilePrototypeMaker, TilePrototype
+from core.networks import CompiledNetwork
 from core.render import Render
 from ui.buttons import ToggleableIllustratedButtonArray
 from core.neat_interfaces import NeatInterfaces
@@ -47,12 +48,14 @@ def alt_rgb_and_alpha(
     def _normalise(value, maximum):
         return (value + 1) / maximum
 
-    nn_2d_output = np.full((sprite_dimensions), np.nan)
+    pixel_inputs = []
     for irow in range(sprite_dimensions[0]):
         for icol in range(sprite_dimensions[1]):
             x = _normalise(irow, sprite_dimensions[0])
             y = _normalise(icol, sprite_dimensions[1])
-            nn_2d_output[irow, icol] = neural_network.activate(tuple(list(nn_input) + [x, y]))[0]
+            pixel_inputs.append(list(nn_input) + [x, y])
+    # Evaluate the network for every pixel at once.
+    nn_2d_output = np.reshape(neural_network.activate_batch(np.array(pixel_inputs))[:, 0], sprite_dimensions)
     return ImageConvert.matrix_to_rgb_palette_and_alphas(nn_2d_output, palette)
 
 
@@ -77,6 +80,7 @@ def prototype_tiles_from_genomes(
         tiles_types_to_populations_configs=tile_types_to_populations_configs,
         sprite_palettes=sprite_palettes,
         image_generating_function=alt_rgb_and_alpha,
+        neural_network_factory=CompiledNetwork.create,
     )
     return tile_prototype_maker.prototype_populations()
 
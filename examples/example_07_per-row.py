@@ -4,9 +4,9 @@ import os
 import numpy as np
 import pygame
 import neat
-from typing import Dict, Tuple, Iterable, Any, List
+from typing import Dict, Tuple, Iterable, List
 
-from core.tiles import TilePrototypeMaker, TilePrototype
+from core.tiles import TilePrototypeMaker, TilePrototype, SequenceImageGenerator
 from core.render import Render
 from ui.buttons import ToggleableIllustratedButtonArray
 from core.neat_interfaces import NeatInterfaces
@@ -36,26 +36,21 @@ sprite_palettes = {
 }
 
 
-def row_by_row(
-    neural_network: Any,
-    nn_input: Iterable[int],
-    sprite_dimensions: Tuple[int, int],
-    palette: Iterable[Tuple[int, int, int, int]],
-    tile_type=None,
-) -> Tuple[np.ndarray, np.ndarray]:
-    """Generate an image by giving a NN the previous row as an input and using its output as the new row."""
+def every_tile_row_by_row(tile_type=None) -> bool:
+    return True
+
 
-    def _normalise(value, maximum):
-        return (value + 1) / maximum
+def palette_image_from_outputs(
+    nn_outputs: np.ndarray, palette: Iterable[Tuple[int, int, int, int]], tile_type=None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    return ImageConvert.matrix_to_rgb_palette_and_alphas(nn_outputs[:, :, 0], palette)
 
-    nn_2d_output = np.full((sprite_dimensions[0], sprite_dimensions[1]), np.nan)
-    previous_row_output = [0] * sprite_dimensions[0]
-    for irow in range(sprite_dimensions[1]):
-        row_output = neural_network.activate(tuple(list(nn_input) + previous_row_output))
-        nn_2d_output[:, irow] = row_output
-        previous_row_output = row_output
 
-    return ImageConvert.matrix_to_rgb_palette_and_alphas(nn_2d_output, palette)
+# Each image is built a row at a time, giving the network the previous row as an input, with every genome and NN input
+# of a tile type advancing together.
+sequence_image_generator = SequenceImageGenerator(
+    row_by_row=every_tile_row_by_row, image_from_outputs=palette_image_from_outputs
+)
 
 
 def config_for_this_example(path_to_config_file: str) -> neat.Config:
@@ -78,7 +73,7 @@ def prototype_tiles_from_genomes(
     tile_prototype_maker = TilePrototypeMaker(
         tiles_types_to_populations_configs=tile_types_to_populations_configs,
         sprite_palettes=sprite_palettes,
-        image_generating_function=row_by_row,
+        sequence_image_generator=sequence_image_generator,
     )
     return tile_prototype_maker.prototype_populations()
 
@@ -7,6 +7,7 @@ import neat
 from typing import Dict, Tuple, Iterable, Any, List
 
 from core.tiles import TilePrototypeMaker, TilePrototype
+from core.networks import CompiledNetwork
 from core.render import Render
 from ui.buttons import ToggleableIllustratedButtonArray
 from core.neat_interfaces import NeatInterfaces
@@ -55,11 +56,15 @@ def rgb_from_nn(
 
     alphas = np.full(sprite_dimensions, 255)
     nn_3d_output = np.full((*sprite_dimensions, 3), np.nan)
+    pixel_inputs = []
     for irow in range(sprite_dimensions[0]):
         for icol in range(sprite_dimensions[1]):
             x = _normalise(irow, sprite_dimensions[0])
             y = _normalise(icol, sprite_dimensions[1])
-            nn_3d_output[irow, icol, :] = neural_network.activate(tuple(list(nn_input) + [x, y]))[0]
+            pixel_inputs.append(list(nn_input) + [x, y])
+    # Evaluate the network for every pixel at once.
+    nn_outputs = neural_network.activate_batch(np.array(pixel_inputs))
+    nn_3d_output[:, :, :] = np.reshape(nn_outputs[:, 0], sprite_dimensions)[:, :, np.newaxis]
     return _0_1_to_255(nn_3d_output), alphas
 
 
@@ -84,6 +89,7 @@ def prototype_tiles_from_genomes(
         tiles_types_to_populations_configs=tile_types_to_populations_configs,
         sprite_palettes=sprite_palettes,
         image_generating_function=rgb_from_nn,
+        neural_network_factory=CompiledNetwork.create,
     )
     return tile_prototype_maker.prototype_populations()
 
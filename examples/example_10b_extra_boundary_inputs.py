@@ -7,6 +7,7 @@ import neat
 from typing import Dict, Tuple, Iterable, Any, List
 
 from core.tiles import TilePrototypeMaker, TilePrototype
+from core.networks import CompiledNetwork
 from core.render import Render
 from ui.buttons import ToggleableIllustratedButtonArray
 from core.neat_interfaces import NeatInterfaces
@@ -63,16 +64,16 @@ def rgb_from_nn(
             return [0, 0, 0, 0]
 
     alphas = np.full(sprite_dimensions, 255)
-    nn_3d_output = np.full((*sprite_dimensions, 3), np.nan)
+    pixel_inputs = []
     for irow in range(sprite_dimensions[0]):
         for icol in range(sprite_dimensions[1]):
             x = _normalise(irow, sprite_dimensions[0])
             y = _normalise(icol, sprite_dimensions[1])
             near_x_edge = _near_edge(irow, sprite_dimensions[0])
             near_y_edge = _near_edge(icol, sprite_dimensions[1])
-            nn_3d_output[irow, icol, :] = neural_network.activate(
-                tuple(list(nn_input) + [x, y] + near_x_edge + near_y_edge)
-            )
+            pixel_inputs.append(list(nn_input) + [x, y] + near_x_edge + near_y_edge)
+    # Evaluate the network for every pixel at once.
+    nn_3d_output = np.reshape(neural_network.activate_batch(np.array(pixel_inputs)), (*sprite_dimensions, 3))
     return np.round(nn_3d_output * 255), alphas
 
 
@@ -97,6 +98,7 @@ def prototype_tiles_from_genomes(
         tiles_types_to_populations_configs=tile_types_to_populations_configs,
         sprite_palettes=sprite_palettes,
         image_generating_function=rgb_from_nn,
+        neural_network_factory=CompiledNetwork.create,
     )
     return tile_prototype_maker.prototype_populations()
 
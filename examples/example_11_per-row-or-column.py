@@ -4,9 +4,9 @@ import os
 import numpy as np
 import pygame
 import neat
-from typing import Dict, Tuple, Iterable, Any, List
+from typing import Dict, Tuple, Iterable, List
 
-from core.tiles import TilePrototypeMaker, TilePrototype
+from core.tiles import TilePrototypeMaker, TilePrototype, SequenceImageGenerator
 from core.render import Render
 from ui.buttons import ToggleableIllustratedButtonArray
 from core.neat_interfaces import NeatInterfaces
@@ -39,39 +39,19 @@ sprite_palettes = {
 }
 
 
-def by_rows_or_columns(
-    neural_network: Any,
-    nn_input: Iterable[int],
-    sprite_dimensions: Tuple[int, int],
-    palette: Iterable[Tuple[int, int, int, int]],
-    tile_type=None,
+def wall_row_by_row(tile_type=None) -> bool:
+    return tile_type == "wall"
+
+
+def rgb_image_from_outputs(
+    nn_outputs: np.ndarray, palette: Iterable[Tuple[int, int, int, int]], tile_type=None,
 ) -> Tuple[np.ndarray, np.ndarray]:
+    return np.round(nn_outputs * 255), np.full(np.shape(nn_outputs)[0: 2], 255)
+
 
-    def _collect_nn_output_row_by_row():
-        nn_3d_output = np.full((*sprite_dimensions, 3), np.nan)
-        previous_row_output = [0] * sprite_dimensions[0] * 3
-        for irow in range(sprite_dimensions[1]):
-            row_output = neural_network.activate(tuple(list(nn_input) + previous_row_output))
-            nn_3d_output[:, irow, :] = np.reshape(row_output, (32, 3))
-            previous_row_output = row_output
-        return nn_3d_output
-
-    def _collect_nn_output_column_by_column():
-        nn_3d_output = np.full((*sprite_dimensions, 3), np.nan)
-        previous_column_output = [0] * sprite_dimensions[1] * 3
-        for icol in range(sprite_dimensions[0]):
-            column_output = neural_network.activate(tuple(list(nn_input) + previous_column_output))
-            nn_3d_output[icol, :, :] = np.reshape(column_output, (20, 3))
-            previous_column_output = column_output
-        return nn_3d_output
-
-    alphas = np.full(sprite_dimensions, 255)
-    if tile_type == "wall":
-        nn_3d_output = _collect_nn_output_row_by_row()
-    else:
-        nn_3d_output = _collect_nn_output_column_by_column()
-
-    return np.round(nn_3d_output * 255), alphas
+# Walls are built a row at a time and other tiles a column at a time, giving the network the previous row or column as
+# an input, with every genome and NN input of a tile type advancing together.
+sequence_image_generator = SequenceImageGenerator(row_by_row=wall_row_by_row, image_from_outputs=rgb_image_from_outputs)
 
 
 def config_for_this_example(path_to_config_file: str) -> neat.Config:
@@ -94,7 +74,7 @@ def prototype_tiles_from_genomes(
     tile_prototype_maker = TilePrototypeMaker(
         tiles_types_to_populations_configs=tile_types_to_populations_configs,
         sprite_palettes=sprite_palettes,
-        image_generating_function=by_rows_or_columns,
+        sequence_image_generator=sequence_image_generator,
     )
     return tile_prototype_maker.prototype_populations()
 
@@ -5,9 +5,11 @@ import numpy as np
 import pygame
 import neat
 import itertools
+from concurrent.futures import Executor, ProcessPoolExecutor
 from typing import Dict, Tuple, Iterable, Any, List
 
 from core.tiles import TilePrototypeMaker, TilePrototype
+from core.networks import CompiledNetwork
 from core.render import Render
 from ui.buttons import ToggleableIllustratedButtonArray
 from core.neat_interfaces import NeatInterfaces
@@ -56,43 +58,19 @@ def rgb_from_nn(
         else:
             return [0, 0, 0, 0]
 
-    def _index_of_nearest_on_palette(palette: Iterable[Tuple[int, int, int, int]], nn_3_floats: List[float]) -> int:
-        rgb_from_nn = np.array(nn_3_floats) * 255
-        rgb_distances = [np.linalg.norm(np.array(rgba[0: 3]) - rgb_from_nn) for rgba in palette]
-        return np.argmin(rgb_distances)
-
-    def _select_rgb(palette: Iterable[Tuple[int, int, int, int]], index: int):
-        return palette[index][0: 3]
-
-    def _average_rgbs(rgb_1, rgb_2):
-        return tuple((np.round([np.mean(x) for x in zip(rgb_1, rgb_2)])).astype(int))
-
-    def _nudge_rgbs(origin: np.ndarray, destination: np.ndarray, nudge_factor=0.2) -> np.ndarray:
-        direction_vector = destination - origin
-        distance = np.linalg.norm(direction_vector)
-        unit_vector = direction_vector / distance
-        # nudge_magnitude = np.sqrt(distance)
-        nudge_magnitude = distance
-        return origin + unit_vector * nudge_magnitude * nudge_factor
-
     alphas = np.full(sprite_dimensions, alpha_default)
-    rgb_out = np.full((*sprite_dimensions, 3), np.nan)
+    pixel_inputs = []
     for irow in range(sprite_dimensions[0]):
         for icol in range(sprite_dimensions[1]):
             x = _normalise(irow, sprite_dimensions[0])
             y = _normalise(icol, sprite_dimensions[1])
             near_x_edge = _near_edge(irow, sprite_dimensions[0], tile_type)
             near_y_edge = _near_edge(icol, sprite_dimensions[1], tile_type)
-            nn_out_3d: List = neural_network.activate(
-                tuple(list(nn_input) + [x, y] + near_x_edge + near_y_edge)
-            )
-            index = _index_of_nearest_on_palette(palette, nn_out_3d)
-            rgb_from_palette = _select_rgb(palette, index)
-            # resulting_rgb = _average_rgbs(rgb_from_palette, tuple(np.array(nn_out_3d) * 255))
-            resulting_rgb = _nudge_rgbs(np.array(rgb_from_palette), np.array(nn_out_3d) * 255)
-            rgb_out[irow, icol, :] = resulting_rgb
-
-    return np.round(rgb_out).astype(int), alphas
+            pixel_inputs.append(list(nn_input) + [x, y] + near_x_edge + near_y_edge)
+    # Evaluate the network for every pixel at once.
+    nn_outputs = np.reshape(neural_network.activate_batch(np.array(pixel_inputs)), (*sprite_dimensions, 3))
+    # Snap every pixel to the palette and nudge it back towards the network's colour in one go.
+    return ImageConvert.nudged_nearest_palette_rgbs(nn_outputs, palette), alphas
 
 
 def config_for_this_example(path_to_config_file: str) -> neat.Config:
@@ -106,16 +84,20 @@ def config_for_this_example(path_to_config_file: str) -> neat.Config:
 
 
 def prototype_tiles_from_genomes(
-    tile_types_to_populations_configs: Dict[str, Tuple[neat.Population, neat.Config]]
+    tile_types_to_populations_configs: Dict[str, Tuple[neat.Population, neat.Config]],
+    executor: Executor = None,
 ) -> Dict[str, Dict[int, TilePrototype]]:
-    """Make tile prototypes for each genome in each population.
+    """Make tile prototypes for each genome in each population, rendering genomes in the executor's worker processes.
 
     Returns a dictionary of tile types to dictionaries of genome ids to TilePrototype objects.
     """
     tile_prototype_maker = TilePrototypeMaker(
         tiles_types_to_populations_configs=tile_types_to_populations_configs,
         sprite_palettes=sprite_palettes,
-        image_generating_function=rgb_from_nn,
+        # Workers import the image generating function by name rather than unpickling it from this script.
+        image_generating_function="example_12_pastel_palettes:rgb_from_nn",
+        neural_network_factory=CompiledNetwork.create,
+        executor=executor,
     )
     return tile_prototype_maker.prototype_populations()
 
@@ -153,7 +135,9 @@ def main():
         tile: (neat.Population(tile_types_to_configs[tile]), config) for tile, config in tile_types_to_configs.items()
     }
 
-    tiles_genomes_prototypes = prototype_tiles_from_genomes(tile_types_to_populations_configs)
+    # Keep one pool of worker processes for the whole session so that every generation is rendered by warm workers.
+    executor = ProcessPoolExecutor()
+    tiles_genomes_prototypes = prototype_tiles_from_genomes(tile_types_to_populations_configs, executor)
 
     # Render buttons and check that they are toggleable.
     grid = np.array([
@@ -212,7 +196,7 @@ def main():
                     # Update genome fitnesses and generate new genomes within each population (mutate populations).
                     _set_genome_fitnesses(tile_types_to_populations_configs, buttons_array)
                     _advance_populations(tile_types_to_populations_configs)
-                    tiles_genomes_prototypes = prototype_tiles_from_genomes(tile_types_to_populations_configs)
+                    tiles_genomes_prototypes = prototype_tiles_from_genomes(tile_types_to_populations_configs, executor)
                     # Create a new array of buttons using the new populations of genonmes.
                     buttons_array = ToggleableIllustratedButtonArray(
                         tile_grid=grid,
@@ -241,6 +225,8 @@ def main():
 
             pygame.display.flip()
 
+    executor.shutdown()
+
 
 if __name__ == "__main__":
     main()
@@ -1,25 +1,37 @@
 """Try an image generating function that produces per-pixel outputs from the NN."""
 
 import os
+import shutil
 import numpy as np
+import itertools
 from functools import reduce
 import pygame
 import neat
-from typing import Dict, Tuple, Iterable, Any, List
+from typing import Dict, Tuple, Iterable, List
 from pathlib import Path
 
-from core.tiles import TilePrototypeMaker, TilePrototype
-from core.render import Render
+from core.tiles import TilePrototypeMaker, TilePrototype, PixelImageGenerator
+from core.render import Render, PrepareForRendering
 from ui.buttons import ToggleableIllustratedButtonArray, TextButton
+from ui.dirty_rects import DirtyRects
 from core.neat_interfaces import NeatInterfaces
 from helpers.conversions import Convert
 from helpers.timestamps import Timestamps
 from helpers.io import Pickler
-from core.image import MakeSurface
+from core.image import ImageConvert, MakeSurface
+from core.caches import FeatureGridCache, PrototypeCache, PrototypeDiskCache, SpriteStore
 
 
 PATH_TO_CONFIG_FILE_DIRECTORY = os.path.join("genome_configurations", "example_13_configs")
 EXPORT_DIRECTORY = os.path.join("generated_tile_sets", "pngs_from_example_13", "")
+PROTOTYPE_DISK_CACHE_DIRECTORY = os.path.join("generated_tile_sets", "prototype_cache_example_13")
+
+# Sprites of genomes that survive unchanged into the next generation are reused rather than rendered again.
+prototype_cache = PrototypeCache()
+# Pixel-identical sprites of different genomes and NN inputs are kept once.
+sprite_store = SpriteStore()
+# Pixel features depend only on the sprite size and tile type, so they are built once and shared by every genome.
+feature_grid_cache = FeatureGridCache()
 
 
 sprite_palettes = {
@@ -29,55 +41,29 @@ sprite_palettes = {
 }
 
 
-def rgb_from_nn(
-    neural_network: Any,
-    nn_input: Iterable[int],
-    sprite_dimensions: Tuple[int, int],
-    palette: Iterable[Tuple[int, int, int, int]],
-    tile_type=None,
-    brightness=255,
-    alpha_default=255,
-) -> Tuple[np.ndarray, np.ndarray]:
-    """Directly obtain RGB values from neural network without using the colour palette supplied."""
-
-    def _normalise(value, maximum):
-        return (value + 1) / maximum
-
-    def _near_edge(index, maximum_length, tile_type) -> List[int]:
-        if tile_type == "floor":
-            return [0, 0, 0, 0]
-
-        if index == 0:
-            return [1, 1, 0, 0]
-        elif index == 1:
-            return [1, 0, 0, 0]
-        elif index == maximum_length - 1:
-            return [0, 0, 1, 1]
-        elif index == maximum_length - 2:
-            return [0, 0, 0, 1]
-        else:
-            return [0, 0, 0, 0]
-
-    def _index_of_nearest_on_palette(palette: Iterable[Tuple[int, int, int, int]], nn_3_floats: List[float]) -> int:
-        rgb_from_nn = np.array(nn_3_floats) * 255
-        rgb_distances = [np.linalg.norm(np.array(rgba[0: 3]) - rgb_from_nn) for rgba in palette]
-        return np.argmin(rgb_distances)
-
-    def _select_rgb(palette: Iterable[Tuple[int, int, int, int]], index: int):
-        return palette[index][0: 3]
-
-    def _average_rgbs(rgb_1, rgb_2):
-        return tuple((np.round([np.mean(x) for x in zip(rgb_1, rgb_2)])).astype(int))
-
-    def _nudge_rgbs(origin: np.ndarray, destination: np.ndarray, nudge_factor=0.2) -> np.ndarray:
-        direction_vector = destination - origin
-        distance = np.linalg.norm(direction_vector)
-        unit_vector = direction_vector / distance
-        nudge_magnitude = distance
-        return origin + unit_vector * nudge_magnitude * nudge_factor
-
-    alphas = np.full(sprite_dimensions, alpha_default)
-    rgb_out = np.full((*sprite_dimensions, 3), np.nan)
+def _normalise(value, maximum):
+    return (value + 1) / maximum
+
+
+def _near_edge(index, maximum_length, tile_type) -> List[int]:
+    if tile_type == "floor":
+        return [0, 0, 0, 0]
+
+    if index == 0:
+        return [1, 1, 0, 0]
+    elif index == 1:
+        return [1, 0, 0, 0]
+    elif index == maximum_length - 1:
+        return [0, 0, 1, 1]
+    elif index == maximum_length - 2:
+        return [0, 0, 0, 1]
+    else:
+        return [0, 0, 0, 0]
+
+
+def pixel_features(sprite_dimensions: Tuple[int, int], tile_type=None) -> np.ndarray:
+    """Network inputs for every pixel: normalised coordinates, their complements and flags marking nearby edges."""
+    features = []
     for irow in range(sprite_dimensions[0]):
         for icol in range(sprite_dimensions[1]):
             x = _normalise(irow, sprite_dimensions[0])
@@ -86,15 +72,41 @@ def rgb_from_nn(
             my = 1 - y
             near_x_edge = _near_edge(irow, sprite_dimensions[0], tile_type)
             near_y_edge = _near_edge(icol, sprite_dimensions[1], tile_type)
-            nn_out_3d: List = neural_network.activate(
-                tuple(list(nn_input) + [x, y, mx, my] + near_x_edge + near_y_edge)
-            )
-            index = _index_of_nearest_on_palette(palette, nn_out_3d)
-            rgb_from_palette = _select_rgb(palette, index)
-            resulting_rgb = _nudge_rgbs(np.array(rgb_from_palette), np.array(nn_out_3d) * 255)
-            rgb_out[irow, icol, :] = resulting_rgb
+            features.append([x, y, mx, my] + near_x_edge + near_y_edge)
+    return np.array(features)
+
+
+def pixel_axis_features(sprite_dimensions: Tuple[int, int], tile_type=None) -> Tuple[np.ndarray, ...]:
+    """The features of pixel_features, each shaped (width, 1) or (1, height) depending on the axis it varies along."""
+    width, height = sprite_dimensions
+    x = np.array([_normalise(irow, width) for irow in range(width)])[:, np.newaxis]
+    y = np.array([_normalise(icol, height) for icol in range(height)])[np.newaxis, :]
+    near_x_edge = np.array([_near_edge(irow, width, tile_type) for irow in range(width)], dtype=float)
+    near_y_edge = np.array([_near_edge(icol, height, tile_type) for icol in range(height)], dtype=float)
+    return (
+        x, y, 1 - x, 1 - y,
+        *(near_x_edge[:, [i]] for i in range(4)),
+        *(near_y_edge[np.newaxis, :, i] for i in range(4)),
+    )
 
-    return np.round(rgb_out).astype(int), alphas
+
+def rgb_from_nn_outputs(
+    nn_outputs: np.ndarray,
+    palette: Iterable[Tuple[int, int, int, int]],
+    tile_type=None,
+    alpha_default=255,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Nudge the colour on the palette nearest to each pixel's network output towards that output."""
+    alphas = np.full(np.shape(nn_outputs)[0: 2], alpha_default)
+    return ImageConvert.nudged_nearest_palette_rgbs(nn_outputs, palette), alphas
+
+
+pixel_image_generator = PixelImageGenerator(
+    pixel_features=pixel_features,
+    image_from_outputs=rgb_from_nn_outputs,
+    axis_features=pixel_axis_features,
+    feature_grid_cache=feature_grid_cache,
+)
 
 
 def config_for_this_example(path_to_config_file: str) -> neat.Config:
@@ -107,19 +119,37 @@ def config_for_this_example(path_to_config_file: str) -> neat.Config:
     )
 
 
+def make_tile_prototype_maker(
+    tile_types_to_populations_configs: Dict[str, Tuple[neat.Population, neat.Config]],
+    prototype_disk_cache: PrototypeDiskCache = None,
+) -> TilePrototypeMaker:
+    return TilePrototypeMaker(
+        tiles_types_to_populations_configs=tile_types_to_populations_configs,
+        sprite_palettes=sprite_palettes,
+        pixel_image_generator=pixel_image_generator,
+        prototype_cache=prototype_cache,
+        disk_cache=prototype_disk_cache,
+        sprite_store=sprite_store,
+        collapse_duplicate_contexts=True,
+        lazy_contexts=True,
+    )
+
+
 def prototype_tiles_from_genomes(
-    tile_types_to_populations_configs: Dict[str, Tuple[neat.Population, neat.Config]]
+    tile_types_to_populations_configs: Dict[str, Tuple[neat.Population, neat.Config]],
+    grid: np.ndarray,
+    prototype_disk_cache: PrototypeDiskCache = None,
 ) -> Dict[str, Dict[int, TilePrototype]]:
     """Make tile prototypes for each genome in each population.
 
+    Only the sprites needed to draw the grid are rendered up front, the rest are rendered if they are ever looked up.
+
     Returns a dictionary of tile types to dictionaries of genome ids to TilePrototype objects.
     """
-    tile_prototype_maker = TilePrototypeMaker(
-        tiles_types_to_populations_configs=tile_types_to_populations_configs,
-        sprite_palettes=sprite_palettes,
-        image_generating_function=rgb_from_nn,
-    )
-    return tile_prototype_maker.prototype_populations()
+    tile_prototype_maker = make_tile_prototype_maker(tile_types_to_populations_configs, prototype_disk_cache)
+    tiles_genomes_prototypes = tile_prototype_maker.prototype_populations()
+    tile_prototype_maker.prewarm(tiles_genomes_prototypes, PrepareForRendering.nn_inputs_for_grid(grid))
+    return tiles_genomes_prototypes
 
 
 def _set_genome_fitnesses(
@@ -149,6 +179,8 @@ def _export_selection(toggleable_buttons: ToggleableIllustratedButtonArray):
     export_directory: str = os.path.join(EXPORT_DIRECTORY, Timestamps.iso_now_seconds())
     print(export_directory + "\n")
     Path(export_directory).mkdir(parents=True, exist_ok=True)
+    # Each distinct sprite is encoded once, later copies are links to the first file.
+    digests_to_file_paths: Dict[str, str] = {}
     for button in toggleable_buttons.buttons:
         if button.state:
             for tile_type in button.prototypes.keys():
@@ -162,8 +194,24 @@ def _export_selection(toggleable_buttons: ToggleableIllustratedButtonArray):
                     file_name: str = tile_type + '_' + _concatenate_ints(inputs_key) + '.png'
                     file_path: str = os.path.join(export_directory, file_name)
                     rgb_array, alphas_array = prototype.inputs_to_rgbs_and_alphas[inputs_key]
+                    digest = SpriteStore.digest(np.dstack([rgb_array, alphas_array]))
+                    # Files of an earlier selected button may be links, so replace them rather than write into them.
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                        # The sprite that was in the file may no longer be, so stop linking to the file for it.
+                        digests_to_file_paths = {
+                            other_digest: other_path for other_digest, other_path in digests_to_file_paths.items()
+                            if other_path != file_path
+                        }
+                    if digest in digests_to_file_paths:
+                        try:
+                            os.link(digests_to_file_paths[digest], file_path)
+                        except OSError:
+                            shutil.copyfile(digests_to_file_paths[digest], file_path)
+                        continue
                     sprite = MakeSurface.from_rgb_and_alpha_arrays(rgb_array, alphas_array)
                     pygame.image.save(sprite, file_path)
+                    digests_to_file_paths[digest] = file_path
 
             # TODO: Save genomes.
 
@@ -185,16 +233,28 @@ def main():
         tile: (neat.Population(tile_types_to_configs[tile]), config) for tile, config in tile_types_to_configs.items()
     }
 
-    tiles_genomes_prototypes = prototype_tiles_from_genomes(tile_types_to_populations_configs)
-
-    # Create array of buttons containing tiles
+    # Grid of tiles drawn on each button.
     grid = np.array([
         [0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 1, 1, 1, 0, 0, 0, 0, 1, 0, 0],
         [0, 0, 0, 1, 0, 0, 1, 0, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1, 0, 0],
         [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 1, 1, 1, 1, 0, 0, 1, 0, 0],
     ])
+
+    # Sprites rendered by earlier sessions, such as the initial population of a run with the same seed, are read from
+    # disk.  The cache is made here rather than on import since it creates its directory.
+    prototype_disk_cache = PrototypeDiskCache(PROTOTYPE_DISK_CACHE_DIRECTORY)
+    tiles_genomes_prototypes = prototype_tiles_from_genomes(
+        tile_types_to_populations_configs, grid, prototype_disk_cache
+    )
+
+    # Create array of buttons containing tiles
     button_width = np.shape(grid)[1] * 32 + 10
     button_height = np.shape(grid)[0] * 20 + 30
+    # The display is created first so that the Surfaces of the buttons can be converted to its pixel format.
+    screen = pygame.display.set_mode((button_width + 30 + 260, button_height * 9 + 50))
+    # Only regions of the screen that have changed are redrawn and sent to the display.
+    dirty_rects = DirtyRects()
+    dirty_rects.mark_everything()
     toggleable_buttons = ToggleableIllustratedButtonArray(
         tile_grid=grid,
         rows_columns=(9, 1),
@@ -208,6 +268,7 @@ def main():
         },
         button_inner_boarder=(5, 20),  # Used to create space between the image in the button boarder.
         tiles_genomes_prototypes=tiles_genomes_prototypes,
+        dirty_rects=dirty_rects,
     )
 
     # Create export PNG button.
@@ -218,11 +279,24 @@ def main():
         top_left_of_text=(8, 7)
     )
 
-    screen = pygame.display.set_mode((button_width + 30 + 260, button_height * 9 + 50))
     maximum_frames = None
     running = True
     frame_counter = 0
     generation_counter = 1
+    # Prototypes of a new generation are made a button at a time between frames so that buttons fill in as they are
+    # ready rather than after the whole generation has been rendered.
+    prototype_stream = iter(())
+    # Sprites are blitted from Surfaces cached by their prototypes, so there is no need to redraw faster than this.
+    clock = pygame.time.Clock()
+
+    def draw(screen: pygame.surface.Surface) -> None:
+        # Draw toggleable button contents
+        Render.on_screen(screen, toggleable_buttons.collect_renderables())
+        # Draw toggleable button boarders.
+        toggleable_buttons.draw_button_boarders(screen)
+        # Draw other butotns.
+        export_pngs_button.draw_button(screen)
+
     while running:
         if maximum_frames is not None:
             frame_counter += 1
@@ -236,11 +310,15 @@ def main():
                 running = False
                 break
 
+            # Redraw everything when the window has been uncovered or otherwise needs repainting.
+            if event.type == pygame.VIDEOEXPOSE:
+                dirty_rects.mark_everything()
+
             if event.type == pygame.MOUSEBUTTONDOWN:
                 # Toggle buttons in response to click.
                 for button in toggleable_buttons.buttons:
                     if button.rect.collidepoint(pygame.mouse.get_pos()):
-                        button.state = not button.state
+                        toggleable_buttons.toggle(button)
 
                 # Export PNG files containing selected sprites.
                 if export_pngs_button.rect.collidepoint(pygame.mouse.get_pos()):
@@ -254,8 +332,7 @@ def main():
                     # Update genome fitnesses and generate new genomes within each population (mutate populations).
                     _set_genome_fitnesses(tile_types_to_populations_configs, toggleable_buttons)
                     _advance_populations(tile_types_to_populations_configs)
-                    tiles_genomes_prototypes = prototype_tiles_from_genomes(tile_types_to_populations_configs)
-                    # Create a new array of buttons using the new populations of genonmes.
+                    # Create a new array of empty buttons for the new populations of genonmes.
                     toggleable_buttons = ToggleableIllustratedButtonArray(
                         tile_grid=grid,
                         rows_columns=(9, 1),
@@ -268,23 +345,30 @@ def main():
                             "roof": (32, 20),
                         },
                         button_inner_boarder=(5, 20),  # Used to create space between the image in the button boarder.
-                        tiles_genomes_prototypes=tiles_genomes_prototypes,
+                        tiles_genomes_prototypes={},
+                        tiles_genome_ids={
+                            tile: population.population for tile, (population, _) in
+                            tile_types_to_populations_configs.items()
+                        },
+                        dirty_rects=dirty_rects,
+                    )
+                    # The new buttons replace everything drawn for the previous generation.
+                    dirty_rects.mark_everything()
+                    prototype_stream = make_tile_prototype_maker(
+                        tile_types_to_populations_configs, prototype_disk_cache
+                    ).iter_prototypes(
+                        order=toggleable_buttons.prototype_order(),
+                        prewarm_nn_inputs=PrepareForRendering.nn_inputs_for_grid(grid),
                     )
 
-        if running:  # This if statement prevents a segfault from occuring when closing the pygame window.
-            screen.fill((50, 50, 50))
-
-            # Draw toggleable button contents
-            renderables = toggleable_buttons.collect_renderables()
-            Render.on_screen(screen, renderables)
-
-            # Draw toggleable button boarders.
-            toggleable_buttons.draw_button_boarders(screen)
-
-            # Draw other butotns.
-            export_pngs_button.draw_button(screen)
+        # Fill in one button per frame.
+        for tile_type, genome_id, prototype in itertools.islice(prototype_stream, len(tile_types_to_configs)):
+            toggleable_buttons.add_prototype(tile_type, genome_id, prototype)
 
-            pygame.display.flip()
+        if running:  # This if statement prevents a segfault from occuring when closing the pygame window.
+            if dirty_rects:
+                dirty_rects.redraw(screen, (50, 50, 50), draw)
+            clock.tick(60)
 
 
 if __name__ == "__main__":
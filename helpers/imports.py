@@ -0,0 +1,18 @@
+import importlib
+from typing import Any
+
+
+class ImportPaths:
+
+    def resolve(import_path: str) -> Any:
+        """Import the object described by a path such as "package.module:function" or "package.module:Class.method".
+
+        Objects described this way can be handed to other processes, which import them again by the same path.
+        """
+        module_name, separator, qualified_name = import_path.partition(":")
+        if not separator or not module_name or not qualified_name:
+            raise ValueError(f"Expected an import path of the form 'package.module:name', got {import_path!r}")
+        found = importlib.import_module(module_name)
+        for name in qualified_name.split("."):
+            found = getattr(found, name)
+        return found
@@ -0,0 +1,50 @@
+import random
+import time
+import numpy as np
+import neat
+
+from core.networks import CompiledNetwork, CompiledPopulation
+
+
+config = neat.Config(
+    neat.DefaultGenome,
+    neat.DefaultReproduction,
+    neat.DefaultSpeciesSet,
+    neat.DefaultStagnation,
+    "genome_configurations/example_13_configs/floor",
+)
+num_inputs = config.genome_config.num_inputs
+inputs = np.random.default_rng(0).uniform(-1, 1, (640, num_inputs))
+fixed_inputs = {0: 1.0, 1: 0.0, 2: 1.0}
+
+for population_size, mutations in ((300, 30), (300, 0), (9, 30), (9, 0)):
+    random.seed(0)
+    genomes = {}
+    for key in range(population_size):
+        genome = config.genome_type(key)
+        genome.configure_new(config.genome_config)
+        for _ in range(mutations):
+            genome.mutate(config.genome_config)
+        genomes[key] = genome
+    networks = [CompiledNetwork.create(genome, config) for genome in genomes.values()]
+    population = CompiledPopulation.create(genomes, config)
+    print(f"{population_size = }, {mutations = }, {len(population.packs) = }")
+
+    tStart = time.time()
+    for i in range(10):
+        for network in networks:
+            network.activate_batch(inputs)
+    tTotal = time.time() - tStart
+    print("tTotal per genome          ", tTotal)
+
+    tStart = time.time()
+    for i in range(10):
+        population.activate_batch(inputs)
+    tTotal = time.time() - tStart
+    print("tTotal population          ", tTotal)
+
+    tStart = time.time()
+    for i in range(10):
+        population.activate_batch(inputs[:, len(fixed_inputs):], fixed_inputs=fixed_inputs)
+    tTotal = time.time() - tStart
+    print("tTotal population, fixed   ", tTotal)
@@ -0,0 +1,202 @@
+import copy
+import gc
+import os
+import time
+import neat
+import numpy as np
+
+from core.caches import FeatureGridCache, PrototypeCache, PrototypeDiskCache, SpriteStore
+from core.neat_interfaces import NeatInterfaces
+
+
+PATH_TO_CONFIG = os.path.join("genome_configurations", "example_06_configs", "floor")
+
+
+def _new_genome(key: int = 1) -> neat.DefaultGenome:
+    config = neat.Config(
+        neat.DefaultGenome,
+        neat.DefaultReproduction,
+        neat.DefaultSpeciesSet,
+        neat.DefaultStagnation,
+        PATH_TO_CONFIG,
+    )
+    genome = config.genome_type(key)
+    genome.configure_new(config.genome_config)
+    return genome
+
+
+class TestGenomeContentHash:
+
+    def test_clone_with_different_key_and_fitness_has_same_hash(self):
+        genome = _new_genome()
+        clone = copy.deepcopy(genome)
+        clone.key = 99
+        clone.fitness = 1.0
+        assert NeatInterfaces.genome_content_hash(genome) == NeatInterfaces.genome_content_hash(clone)
+
+    def test_changed_weight_changes_hash(self):
+        genome = _new_genome()
+        changed = copy.deepcopy(genome)
+        next(iter(changed.connections.values())).weight += 1e-9
+        assert NeatInterfaces.genome_content_hash(genome) != NeatInterfaces.genome_content_hash(changed)
+
+    def test_weights_of_disabled_connections_are_ignored(self):
+        genome = _new_genome()
+        connection = next(iter(genome.connections.values()))
+        connection.enabled = False
+        changed = copy.deepcopy(genome)
+        changed.connections[connection.key].weight += 1.0
+        assert NeatInterfaces.genome_content_hash(genome) == NeatInterfaces.genome_content_hash(changed)
+
+
+class TestPrototypeCache:
+
+    def test_counts_hits_and_misses(self):
+        cache = PrototypeCache()
+        assert cache.get("a") is None
+        cache.put("a", (None, {(0,): (np.zeros(2), np.zeros(2))}))
+        assert cache.get("a") is not None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = PrototypeCache(max_entries=2)
+        cache.put("a", (None, {}))
+        cache.put("b", (None, {}))
+        cache.get("a")
+        cache.put("c", (None, {}))
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+
+    def test_cached_arrays_are_read_only(self):
+        cache = PrototypeCache()
+        rgb = np.zeros((2, 2, 3))
+        cache.put("a", (None, {(0,): (rgb, np.zeros((2, 2)))}))
+        assert not rgb.flags.writeable
+
+    def test_function_names_change_when_the_code_changes(self):
+        names = []
+        for source in (
+            "def rgb(x):\n    return x * 2\n",
+            "def rgb(x):\n    return x * 2\n",
+            "def rgb(x):\n    return x * 3\n",
+            "def rgb(x):\n    return [y * 2 for y in x]\n",
+            "def rgb(x):\n    return [y * 3 for y in x]\n",
+        ):
+            namespace = {"__name__": "__main__"}
+            exec(source, namespace)
+            names.append(PrototypeCache.function_name(namespace["rgb"]))
+        assert names[0] == names[1]
+        assert len(set(names)) == 4
+        assert all(name.startswith("__main__.rgb@") for name in names)
+
+    def test_function_names_change_when_the_defaults_change(self):
+        names = []
+        for source in (
+            "def rgb(x, alpha=255):\n    return x\n",
+            "def rgb(x, alpha=128):\n    return x\n",
+            "def rgb(x, *, alpha=128):\n    return x\n",
+            "def rgb(x, *, alpha=64):\n    return x\n",
+        ):
+            namespace = {"__name__": "__main__"}
+            exec(source, namespace)
+            names.append(PrototypeCache.function_name(namespace["rgb"]))
+        assert len(set(names)) == 4
+
+
+def _disk_key(name: str) -> tuple:
+    return (name, "generator", ((0, 0, 0, 255),), (2, 3), ((0, 0), (1, 0), (1, 1)))
+
+
+class TestPrototypeDiskCache:
+
+    def test_stored_blocks_are_read_back_memory_mapped_in_another_session(self, tmp_path):
+        rgbas = np.arange(2 * 2 * 3 * 4, dtype=np.uint8).reshape((2, 2, 3, 4))
+        PrototypeDiskCache(str(tmp_path)).put(_disk_key("a"), rgbas, {(0, 0): 1, (1, 0): 0, (1, 1): 1})
+        cache = PrototypeDiskCache(str(tmp_path))
+        stored_rgbas, rows = cache.get(_disk_key("a"))
+        assert isinstance(stored_rgbas, np.memmap)
+        np.testing.assert_array_equal(stored_rgbas, rgbas)
+        assert rows == {(0, 0): 1, (1, 0): 0, (1, 1): 1}
+        assert cache.get(_disk_key("b")) is None
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    def test_entries_of_another_format_version_are_not_read(self, tmp_path, monkeypatch):
+        rgbas = np.zeros((1, 2, 3, 4), dtype=np.uint8)
+        PrototypeDiskCache(str(tmp_path)).put(_disk_key("a"), rgbas, {(0, 0): 0, (1, 0): 0, (1, 1): 0})
+        monkeypatch.setattr(PrototypeDiskCache, "format_version", PrototypeDiskCache.format_version + 1)
+        assert PrototypeDiskCache(str(tmp_path)).get(_disk_key("a")) is None
+
+    def test_least_recently_used_entries_are_evicted_beyond_the_budget(self, tmp_path):
+        rgbas = np.zeros((1, 2, 3, 4), dtype=np.uint8)
+        rows = {(0, 0): 0, (1, 0): 0, (1, 1): 0}
+        cache = PrototypeDiskCache(str(tmp_path), max_bytes=10 ** 6)
+        for name in ("a", "b"):
+            cache.put(_disk_key(name), rgbas, rows)
+            time.sleep(0.01)
+        cache.get(_disk_key("a"))
+        entry_bytes = sum(os.path.getsize(os.path.join(tmp_path, name)) for name in os.listdir(tmp_path)) // 2
+        cache.max_bytes = 2 * entry_bytes
+        cache.put(_disk_key("c"), rgbas, rows)
+        assert len(cache) == 2
+        assert cache.get(_disk_key("b")) is None
+        assert cache.get(_disk_key("a")) is not None
+
+
+class TestSpriteStore:
+
+    def test_identical_sprites_share_one_read_only_copy(self):
+        store = SpriteStore()
+        block = np.zeros((3, 2, 2, 4), dtype=np.uint8)
+        block[2] = 7
+        interned = [store.intern(rgba) for rgba in block]
+        assert interned[0][1] is interned[1][1]
+        assert interned[0][0] != interned[2][0]
+        assert interned[0][1].base is None and not interned[0][1].flags.writeable
+        assert len(store) == 2
+        assert store.references == {interned[0][0]: 2, interned[2][0]: 1}
+
+    def test_sprites_are_dropped_once_their_owners_are_collected(self):
+        class _Owner:
+            pass
+
+        store = SpriteStore()
+        owners = [_Owner(), _Owner()]
+        for i in range(2):
+            digest, _ = store.intern(np.ones((2, 2, 4), dtype=np.uint8))
+            store.track(owners[i], (digest,))
+        del owners[0]
+        gc.collect()
+        assert store.references == {digest: 1}
+        del owners[0]
+        gc.collect()
+        assert len(store) == 0
+
+
+def _counting_features(sprite_dimensions, tile_type=None):
+    _counting_features.calls += 1
+    return np.arange(sprite_dimensions[0] * sprite_dimensions[1] * 2).reshape(-1, 2)
+
+
+_counting_features.calls = 0
+
+
+class TestFeatureGridCache:
+
+    def test_features_are_built_once_and_read_only(self):
+        cache = FeatureGridCache()
+        calls = _counting_features.calls
+        first = cache.features(_counting_features, (4, 3), "floor")
+        second = cache.features(_counting_features, (4, 3), "floor")
+        assert first is second
+        assert _counting_features.calls == calls + 1
+        assert not first.flags.writeable
+        assert cache.features(_counting_features, (4, 3), "wall") is not first
+
+    def test_network_inputs_prepend_nn_input_to_every_row(self):
+        cache = FeatureGridCache()
+        result = cache.network_inputs(_counting_features, (1, 0, 1), (2, 2), "floor")
+        np.testing.assert_array_equal(result, [[1, 0, 1, 0, 1], [1, 0, 1, 2, 3], [1, 0, 1, 4, 5], [1, 0, 1, 6, 7]])
+        assert cache.network_inputs(_counting_features, (1, 0, 1), (2, 2), "floor") is result
+        assert not result.flags.writeable
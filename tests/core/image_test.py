@@ -1,8 +1,18 @@
+import pickle
 import pytest
 import numpy as np
+import pygame
 from numpy.testing import assert_array_equal
+from PIL import Image
 
-from core.image import ImageConvert, ImageIO
+from core.caches import SpriteStore
+from core.image import ImageConvert, ImageIO, MakeSurface, SurfaceCache
+from core.tiles import ContextRGBAs
+
+
+def _level_map_rgba(rows: int, columns: int, seed: int = 0) -> np.ndarray:
+    colours = np.array([[0, 0, 0, 0], [0, 0, 0, 255], [255, 255, 255, 255]], dtype=np.uint8)
+    return colours[np.random.default_rng(seed).integers(0, 3, (rows, columns))]
 
 
 class TestImageConvert:
@@ -37,6 +47,14 @@ class TestImageConvert:
             [-1, -1, -1, -1, -1],
         ])
         assert_array_equal(result, expected)
+        assert result.dtype == np.int8
+
+    def test_grid_from_rgba_lists_unknown_colours_and_positions(self):
+        image_array = ImageIO.rgba_png_to_array("tests/data/black_white_and_blank_5x5.png")
+        image_array[1, 2] = (255, 0, 0, 255)
+        image_array[3, 4] = (255, 0, 0, 255)
+        with pytest.raises(ValueError, match=r"#FF0000FF at \(1, 2\), \(3, 4\)"):
+            ImageConvert.grid_from_rgba(image_array)
 
     @pytest.mark.parametrize(
         "given, expected",
@@ -79,3 +97,132 @@ class TestImageConvert:
         result = ImageConvert.matrix_to_rgb_palette_and_alphas(matrix, palette)
         assert_array_equal(result[0], expected_rgba)
         assert_array_equal(result[1], expected_alphas)
+
+    def test_nudged_nearest_palette_rgbs_matches_per_pixel_nudging(self):
+        palette = ((57, 50, 36, 255), (116, 105, 91, 255), (134, 152, 148, 255), (129, 139, 141, 255))
+
+        def _per_pixel(nn_3_floats):
+            rgb_from_nn = np.array(nn_3_floats) * 255
+            rgb_distances = [np.linalg.norm(np.array(rgba[0: 3]) - rgb_from_nn) for rgba in palette]
+            origin = np.array(palette[np.argmin(rgb_distances)][0: 3])
+            direction_vector = rgb_from_nn - origin
+            distance = np.linalg.norm(direction_vector)
+            return np.round(origin + direction_vector / distance * distance * 0.2)
+
+        nn_outputs = np.random.default_rng(0).uniform(0, 1, (500, 3))
+        expected = np.array([_per_pixel(pixel) for pixel in nn_outputs])
+        result = ImageConvert.nudged_nearest_palette_rgbs(nn_outputs, palette)
+        assert result.dtype == np.uint8
+        assert_array_equal(result, expected)
+        assert_array_equal(ImageConvert.nudged_nearest_palette_rgbs(np.reshape(nn_outputs, (5, 10, 10, 3)), palette),
+                           np.reshape(expected, (5, 10, 10, 3)))
+
+    def test_nudged_nearest_palette_rgbs_returns_palette_colour_for_exact_match(self):
+        palette = ((0, 0, 0, 255), (255, 0, 255, 255))
+        result = ImageConvert.nudged_nearest_palette_rgbs(np.array([[1.0, 0.0, 1.0], [0.0, 0.0, 0.0]]), palette)
+        assert_array_equal(result, [[255, 0, 255], [0, 0, 0]])
+
+    def test_nearest_palette_indices_match_exhaustive_search(self):
+        palette = ((57, 50, 36, 255), (116, 105, 91, 255), (134, 152, 148, 255), (129, 139, 141, 255), (5, 0, 0, 0))
+        rgbs = np.vstack([
+            np.random.default_rng(1).uniform(-20, 275, (20000, 3)),
+            [[31, 25, 18], [131.5, 145.5, 144.5], [np.nan, 0, 0]],  # Equally distant from two colours, and NaN.
+        ])
+        distances = [[np.linalg.norm(np.array(rgba[0: 3]) - rgb) for rgba in palette] for rgb in rgbs]
+        assert_array_equal(ImageConvert.nearest_palette_indices(rgbs, palette), np.argmin(distances, axis=1))
+
+    def test_palette_lookup_table_is_built_once_per_palette(self):
+        rgb_palette = ((0, 0, 0), (255, 255, 255))
+        table = ImageConvert.palette_lookup_table(rgb_palette)
+        assert ImageConvert.palette_lookup_table(rgb_palette) is table
+        assert table.dtype == np.uint8
+        assert not table.flags.writeable
+
+    def test_matrix_to_rgb_palette_and_alphas_matches_scalar_binning_outside_range(self):
+        palette = ((10, 20, 30, 0), (40, 50, 60, 100), (70, 80, 90, 255))
+        matrix = np.array([[-0.5, 0.0, 1.0 / 3], [1.0, 7.0, np.nan]])
+        rgb, alphas = ImageConvert.matrix_to_rgb_palette_and_alphas(matrix, palette)
+        for (irow, icol), value in np.ndenumerate(matrix):
+            expected = ImageConvert.continuous_value_to_discrete_palette(value, palette)
+            assert tuple(rgb[irow, icol]) == expected[0: 3]
+            assert alphas[irow, icol] == expected[3]
+        assert rgb.dtype == np.uint8 and alphas.dtype == np.uint8
+
+
+class TestImageIO:
+
+    @pytest.mark.parametrize("rows_per_strip", (1, 7, 64, 1000))
+    def test_level_grid_from_png_matches_whole_image_decoding(self, tmp_path, rows_per_strip):
+        path = str(tmp_path / "level.png")
+        Image.fromarray(_level_map_rgba(53, 41), "RGBA").save(path)
+        expected = ImageConvert.grid_from_rgba(ImageIO.rgba_png_to_array(path))
+        result = ImageIO.level_grid_from_png(path, rows_per_strip=rows_per_strip)
+        assert result.dtype == np.int8
+        assert_array_equal(result, expected)
+
+    def test_level_grid_from_palette_png_written_to_npy_file(self, tmp_path):
+        path = str(tmp_path / "level.png")
+        image = Image.fromarray(_level_map_rgba(30, 20, seed=1), "RGBA")
+        image.quantize(3).save(path, bits=8)
+        expected = ImageConvert.grid_from_rgba(np.asarray(Image.open(path).convert("RGBA")))
+        ImageIO.level_grid_from_png(path, str(tmp_path / "level.npy"), rows_per_strip=8)
+        assert_array_equal(np.load(str(tmp_path / "level.npy")), expected)
+
+    def test_unknown_colours_are_reported_at_their_rows_and_the_npy_file_is_deleted(self, tmp_path):
+        path = str(tmp_path / "level.png")
+        rgba = _level_map_rgba(30, 20, seed=2)
+        rgba[19, 3] = (255, 0, 0, 255)
+        Image.fromarray(rgba, "RGBA").save(path)
+        with pytest.raises(ValueError, match=r"#FF0000FF at \(19, 3\)"):
+            ImageIO.level_grid_from_png(path, str(tmp_path / "level.npy"), rows_per_strip=8)
+        assert not (tmp_path / "level.npy").exists()
+
+
+class TestMakeSurface:
+
+    def test_surfaces_hold_the_given_rgb_and_alpha_values(self):
+        rgba = np.random.default_rng(12).integers(0, 256, (5, 3, 4), dtype=np.uint8)
+        for surface in (
+            MakeSurface.from_rgba_array(rgba),
+            MakeSurface.from_rgb_and_alpha_arrays(rgba[..., 0:3].astype(np.int64), rgba[..., 3].astype(float)),
+        ):
+            assert surface.get_size() == (5, 3)
+            assert_array_equal(pygame.surfarray.array3d(surface), rgba[..., 0:3])
+            assert_array_equal(pygame.surfarray.array_alpha(surface), rgba[..., 3])
+
+
+class TestSurfaceCache:
+
+    def test_surfaces_are_made_once_and_shared_by_nn_inputs_with_the_same_arrays(self, monkeypatch):
+        made = []
+
+        def _surface(rgb_array, alpha_array):
+            made.append(rgb_array)
+            return pygame.surface.Surface(np.shape(alpha_array))
+
+        monkeypatch.setattr(MakeSurface, "from_rgb_and_alpha_arrays", _surface)
+        shared = (np.zeros((4, 2, 3), dtype=np.uint8), np.zeros((4, 2), dtype=np.uint8))
+        arrays = {(0,): shared, (1,): shared, (2,): (np.ones((4, 2, 3), dtype=np.uint8), np.zeros((4, 2)))}
+        cache = SurfaceCache(arrays)
+        first = cache.surface((0,))
+        assert cache.surface((1,)) is first
+        assert cache.surface((2,)) is not first
+        assert cache.surface((0,)) is first
+        assert len(made) == 2
+        unpickled = pickle.loads(pickle.dumps(cache))
+        assert len(unpickled) == 0
+        assert unpickled.inputs_to_rgbs_and_alphas.keys() == arrays.keys()
+
+    def test_surfaces_of_identical_sprites_are_shared_through_a_sprite_store(self):
+        sprite_store = SpriteStore()
+        rgbas = np.random.default_rng(13).integers(0, 256, (2, 4, 2, 4), dtype=np.uint8)
+        first = ContextRGBAs(rgbas, {(0,): 0, (1,): 1}, sprite_store)
+        second = ContextRGBAs(rgbas[::-1], {(0,): 0, (1,): 1}, sprite_store)
+        first_cache, second_cache = SurfaceCache(first, sprite_store), SurfaceCache(second, sprite_store)
+        assert first_cache.surface((0,)) is second_cache.surface((1,))
+        assert first_cache.surface((1,)) is second_cache.surface((0,))
+        assert first_cache.surface((0,)) is not first_cache.surface((1,))
+        assert len(sprite_store.surfaces) == 2
+        assert_array_equal(pygame.surfarray.array_alpha(first_cache.surface((1,))), rgbas[1, ..., 3])
+        del first, second, first_cache, second_cache
+        assert len(sprite_store.surfaces) == 0
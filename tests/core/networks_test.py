@@ -0,0 +1,240 @@
+import os
+import random
+import pytest
+import numpy as np
+import neat
+from numpy.testing import assert_allclose
+
+from core.networks import CompiledNetwork, CompiledPopulation, NetworkAnalysis
+
+
+PATH_TO_CONFIG = os.path.join("genome_configurations", "example_13_configs", "floor")
+
+
+def _make_config() -> neat.Config:
+    return neat.Config(
+        neat.DefaultGenome,
+        neat.DefaultReproduction,
+        neat.DefaultSpeciesSet,
+        neat.DefaultStagnation,
+        PATH_TO_CONFIG,
+    )
+
+
+def _mutated_genomes(config: neat.Config, count: int, mutations: int, seed: int = 0):
+    """Make genomes with hidden nodes and disabled connections by mutating freshly initialised genomes."""
+    random.seed(seed)
+    genomes = []
+    for key in range(count):
+        genome = config.genome_type(key)
+        genome.configure_new(config.genome_config)
+        for _ in range(mutations):
+            genome.mutate(config.genome_config)
+        genomes.append(genome)
+    return genomes
+
+
+@pytest.fixture(scope="module")
+def config():
+    return _make_config()
+
+
+class TestCompiledNetwork:
+
+    @pytest.mark.parametrize("mutations", (0, 5, 30))
+    def test_activate_batch_matches_feed_forward_network(self, config, mutations):
+        rng = np.random.default_rng(1)
+        inputs = rng.uniform(-1, 1, (50, config.genome_config.num_inputs))
+        for genome in _mutated_genomes(config, 10, mutations):
+            reference = neat.nn.FeedForwardNetwork.create(genome, config)
+            compiled = CompiledNetwork.create(genome, config)
+            expected = np.array([reference.activate(tuple(row)) for row in inputs])
+            assert_allclose(compiled.activate_batch(inputs), expected, rtol=1e-12, atol=1e-12)
+
+    def test_activate_matches_activate_batch(self, config):
+        genome = _mutated_genomes(config, 1, 10)[0]
+        compiled = CompiledNetwork.create(genome, config)
+        inputs = tuple(np.linspace(0, 1, config.genome_config.num_inputs))
+        assert compiled.activate(inputs) == list(compiled.activate_batch(np.array([inputs]))[0])
+
+    def test_outputs_without_connections_are_zero(self, config):
+        genome = _mutated_genomes(config, 1, 0)[0]
+        for connection in genome.connections.values():
+            connection.enabled = False
+        compiled = CompiledNetwork.create(genome, config)
+        result = compiled.activate_batch(np.ones((4, config.genome_config.num_inputs)))
+        assert_allclose(result, np.zeros((4, config.genome_config.num_outputs)))
+
+    def test_wrong_number_of_inputs_raises(self, config):
+        compiled = CompiledNetwork.create(_mutated_genomes(config, 1, 0)[0], config)
+        with pytest.raises(RuntimeError):
+            compiled.activate_batch(np.ones((4, 2)))
+
+    @pytest.mark.parametrize("mutations", (0, 5, 30))
+    def test_specialised_network_matches_full_network(self, config, mutations):
+        rng = np.random.default_rng(6)
+        num_inputs = config.genome_config.num_inputs
+        free = rng.uniform(-1, 1, (40, num_inputs - 3))
+        for genome in _mutated_genomes(config, 10, mutations, seed=7):
+            compiled = CompiledNetwork.create(genome, config)
+            for context in ((0, 0, 0), (1, 0, 1), (1, 1, 1)):
+                specialised = compiled.specialise(dict(enumerate(context)))
+                assert len(specialised.input_nodes) == num_inputs - 3
+                full_inputs = np.hstack([np.tile(context, (len(free), 1)), free])
+                assert_allclose(specialised.activate_batch(free), compiled.activate_batch(full_inputs),
+                                rtol=1e-12, atol=1e-12)
+
+    @pytest.mark.parametrize("mutations", (0, 10, 30))
+    def test_specialised_network_with_mixed_aggregations_in_a_layer_matches_neat(self, config, mutations):
+        rng = np.random.default_rng(12)
+        num_inputs = config.genome_config.num_inputs
+        free = rng.uniform(-1, 1, (20, num_inputs - 2))
+        for genome in _mutated_genomes(config, 10, mutations, seed=13):
+            for i, key in enumerate(sorted(genome.nodes)):
+                genome.nodes[key].aggregation = ("sum", "product", "sum", "max")[i % 4]
+            reference = neat.nn.FeedForwardNetwork.create(genome, config)
+            specialised = CompiledNetwork.create(genome, config).specialise({0: 0.7, 1: -0.4})
+            expected = np.array([reference.activate((0.7, -0.4) + tuple(row)) for row in free])
+            assert_allclose(specialised.activate_batch(free), expected, rtol=1e-12, atol=1e-12)
+
+    def test_specialise_does_not_count_sources_kept_for_other_aggregations_twice(self, config):
+        genome = _mutated_genomes(config, 1, 0)[0]
+        output_keys = config.genome_config.output_keys
+        # The sum node has weights [2, 1] and the product node weights [3, 1].
+        weights = {(-1, output_keys[0]): 2.0, (-2, output_keys[0]): 1.0, (-1, output_keys[1]): 3.0}
+        for (i, o), connection in genome.connections.items():
+            connection.enabled = i in (-1, -2) and o in output_keys[:2]
+            connection.weight = weights.get((i, o), 1.0)
+        for key, aggregation in zip(output_keys[:2], ("sum", "product")):
+            node = genome.nodes[key]
+            node.aggregation, node.activation, node.bias, node.response = aggregation, "identity", 0.0, 1.0
+        specialised = CompiledNetwork.create(genome, config).specialise({0: 5.0})
+        free = np.zeros((1, config.genome_config.num_inputs - 1))
+        free[0, 0] = 7.0
+        assert_allclose(specialised.activate_batch(free)[0, :2], [17.0, 105.0])
+
+    def test_specialise_removes_connections_from_fixed_inputs(self, config):
+        genome = _mutated_genomes(config, 1, 0)[0]
+        compiled = CompiledNetwork.create(genome, config)
+        specialised = compiled.specialise({0: 1.0, 1: 0.0, 2: 1.0})
+        assert sum(layer.connected.sum() for layer in specialised.layers) == (
+            sum(layer.connected.sum() for layer in compiled.layers) - 3 * config.genome_config.num_outputs
+        )
+
+    def test_nodes_depending_only_on_fixed_inputs_become_constants(self, config):
+        genome = _mutated_genomes(config, 1, 0)[0]
+        for (i, o), connection in genome.connections.items():
+            if i < -1:
+                connection.enabled = False
+        for node in genome.nodes.values():
+            node.aggregation = "max"
+        compiled = CompiledNetwork.create(genome, config)
+        specialised = compiled.specialise({0: 0.5})
+        assert specialised.layers == ()
+        free = np.ones((3, config.genome_config.num_inputs - 1))
+        assert_allclose(specialised.activate_batch(free), compiled.activate_batch(np.hstack([[[0.5]] * 3, free])))
+
+    def test_specialised_networks_are_built_once_per_fixed_inputs(self, config):
+        compiled = CompiledNetwork.create(_mutated_genomes(config, 1, 20)[0], config)
+        specialised = compiled.specialise({0: 1, 1: 0, 2: 1})
+        assert compiled.specialise({2: 1.0, 0: 1.0, 1: 0.0}) is specialised
+        assert compiled.specialise({0: 0, 1: 0, 2: 1}) is not specialised
+
+    @pytest.mark.parametrize("mutations", (0, 10, 40))
+    def test_activate_separable_matches_activate_batch(self, config, mutations):
+        rng = np.random.default_rng(10)
+        width, height = 6, 4
+        num_inputs = config.genome_config.num_inputs
+        shapes = [((width, 1), (1, height), (width, height))[i % 3] for i in range(num_inputs)]
+        axis_inputs = [rng.uniform(-1, 1, shape) for shape in shapes]
+        grid_inputs = np.stack([np.broadcast_to(value, (width, height)) for value in axis_inputs], axis=-1)
+        for genome in _mutated_genomes(config, 10, mutations, seed=11):
+            compiled = CompiledNetwork.create(genome, config)
+            expected = compiled.activate_batch(np.reshape(grid_inputs, (-1, num_inputs)))
+            result = compiled.activate_separable(axis_inputs)
+            assert result.shape == (width, height, config.genome_config.num_outputs)
+            assert_allclose(np.reshape(result, (-1, config.genome_config.num_outputs)), expected,
+                            rtol=1e-12, atol=1e-12)
+
+    def test_activate_separable_keeps_single_axis_shape(self, config):
+        genome = _mutated_genomes(config, 1, 20)[0]
+        compiled = CompiledNetwork.create(genome, config)
+        axis_inputs = [np.linspace(0, 1, 5)[:, np.newaxis]] * config.genome_config.num_inputs
+        assert compiled.activate_separable(axis_inputs).shape == (5, 1, config.genome_config.num_outputs)
+
+
+class TestCompiledPopulation:
+
+    def test_activate_batch_matches_individual_networks(self, config):
+        genomes = {genome.key: genome for genome in _mutated_genomes(config, 12, 20)}
+        population = CompiledPopulation.create(genomes, config)
+        inputs = np.random.default_rng(2).uniform(-1, 1, (30, config.genome_config.num_inputs))
+        result = population.activate_batch(inputs)
+        assert result.shape == (12, 30, config.genome_config.num_outputs)
+        for g, genome_id in enumerate(population.genome_ids):
+            expected = CompiledNetwork.create(genomes[genome_id], config).activate_batch(inputs)
+            assert_allclose(result[g], expected, rtol=1e-12, atol=1e-12)
+
+    def test_activate_batch_with_inputs_per_genome_and_small_chunks(self, config):
+        genomes = {genome.key: genome for genome in _mutated_genomes(config, 5, 20)}
+        population = CompiledPopulation.create(genomes, config)
+        inputs = np.random.default_rng(3).uniform(-1, 1, (5, 7, config.genome_config.num_inputs))
+        result = population.activate_batch(inputs, max_values=1)
+        for g, genome_id in enumerate(population.genome_ids):
+            expected = CompiledNetwork.create(genomes[genome_id], config).activate_batch(inputs[g])
+            assert_allclose(result[g], expected, rtol=1e-12, atol=1e-12)
+
+    def test_genomes_are_only_packed_with_genomes_of_the_same_shape(self, config):
+        genomes = {genome.key: genome for genome in _mutated_genomes(config, 40, 30, seed=10)}
+        population = CompiledPopulation.create(genomes, config)
+        assert len(population.packs) > 1
+        assert sorted(sum(population.groups, ())) == sorted(population.packed_ids)
+        for group, pack in zip(population.groups, population.packs):
+            for genome_id in group:
+                widths = [len(layer.node_keys) for layer in population.networks[genome_id].layers]
+                assert widths == [width for _, width in pack.layer_slots]
+
+    def test_genomes_with_other_aggregations_are_evaluated_separately(self, config):
+        genomes = {genome.key: genome for genome in _mutated_genomes(config, 4, 10)}
+        for node in genomes[2].nodes.values():
+            node.aggregation = "max"
+        population = CompiledPopulation.create(genomes, config)
+        assert population.unpacked_ids == (2,)
+        inputs = np.random.default_rng(4).uniform(-1, 1, (6, config.genome_config.num_inputs))
+        reference = neat.nn.FeedForwardNetwork.create(genomes[2], config)
+        expected = np.array([reference.activate(tuple(row)) for row in inputs])
+        assert_allclose(population.activate_batch(inputs)[population.genome_ids.index(2)], expected, rtol=1e-12)
+
+    def test_fixed_inputs_match_full_inputs(self, config):
+        genomes = {genome.key: genome for genome in _mutated_genomes(config, 8, 20, seed=8)}
+        for node in genomes[3].nodes.values():
+            node.aggregation = "mean"
+        population = CompiledPopulation.create(genomes, config)
+        free = np.random.default_rng(9).uniform(-1, 1, (25, config.genome_config.num_inputs - 3))
+        full_inputs = np.hstack([np.tile((1, 0, 1), (len(free), 1)), free])
+        assert_allclose(
+            population.activate_batch(free, fixed_inputs={0: 1, 1: 0, 2: 1}), population.activate_batch(full_inputs),
+            rtol=1e-12, atol=1e-12,
+        )
+
+
+class TestNetworkAnalysis:
+
+    def test_inputs_without_paths_to_outputs_are_excluded(self, config):
+        genome = _mutated_genomes(config, 1, 0)[0]
+        for (i, o), connection in genome.connections.items():
+            if i in (-1, -2):
+                connection.enabled = False
+        result = NetworkAnalysis.inputs_affecting_outputs(genome, config)
+        assert result == tuple(range(2, config.genome_config.num_inputs))
+
+    def test_changing_excluded_inputs_does_not_change_outputs(self, config):
+        rng = np.random.default_rng(5)
+        for genome in _mutated_genomes(config, 20, 30, seed=6):
+            used = NetworkAnalysis.inputs_affecting_outputs(genome, config)
+            network = CompiledNetwork.create(genome, config)
+            inputs = rng.uniform(-1, 1, (10, config.genome_config.num_inputs))
+            perturbed = np.copy(inputs)
+            unused = [i for i in range(config.genome_config.num_inputs) if i not in used]
+            perturbed[:, unused] = rng.uniform(-1, 1, (10, len(unused)))
+            assert_allclose(network.activate_batch(perturbed), network.activate_batch(inputs))
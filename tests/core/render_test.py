@@ -1,7 +1,9 @@
 import pytest
+import numpy as np
+import pygame
 from numpy.testing import assert_array_equal
 
-from core.render import MapGridToScreen
+from core.render import MapGridToScreen, PrepareForRendering, Render, Renderable, RenderQueue
 
 
 class TestMapGridToScreen:
@@ -39,3 +41,124 @@ class TestMapGridToScreen:
             top_left_position_of_grid=(100, 100),
         )
         assert_array_equal(result, expected)
+
+
+class TestPrepareForRendering:
+
+    def test_nn_inputs_for_grid_match_the_sprites_looked_up_when_drawing(self):
+        grid = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]])
+        looked_up = {"floor": set(), "wall": set(), "roof": set()}
+
+        class _Recorder(dict):
+            def __init__(self, tile_type):
+                self.tile_type = tile_type
+
+            def __getitem__(self, nn_input):
+                looked_up[self.tile_type].add(tuple(int(value) for value in nn_input))
+
+        class _Prototype:
+            def __init__(self, tile_type):
+                self.inputs_to_rgbs_and_alphas = _Recorder(tile_type)
+                self.surfaces = None
+
+        renderables = PrepareForRendering.collect_renderables_for_grid(
+            grid=grid,
+            tile_prototypes={tile_type: _Prototype(tile_type) for tile_type in looked_up},
+            top_left_position_of_grid=(0, 0),
+            cell_dimensions=(8, 4),
+            wall_dimensions=(8, 8),
+            roof_dimensions=(8, 4),
+        )
+        for renderable in renderables:
+            renderable.array_getter()
+        assert PrepareForRendering.nn_inputs_for_grid(grid) == looked_up
+        assert looked_up["floor"] == {(1, 1, 1)}
+
+
+def _renderables(count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [
+        Renderable(None, (index, 0), (int(rng.integers(0, 2)), int(rng.integers(0, 10))))
+        for index in range(count)
+    ]
+
+
+class TestRenderQueue:
+
+    def test_iterates_in_the_same_order_as_order_by_priority(self):
+        renderables = _renderables(200)
+        assert list(RenderQueue(renderables)) == Render.order_by_priority(renderables)
+
+    def test_insert_and_remove_keep_the_order(self):
+        renderables = _renderables(100, seed=1)
+        queue = RenderQueue(renderables[:50])
+        for renderable in renderables[50:]:
+            queue.insert(renderable)
+        for renderable in renderables[::3]:
+            queue.remove(renderable)
+        remaining = [renderable for index, renderable in enumerate(renderables) if index % 3]
+        assert list(queue) == Render.order_by_priority(remaining)
+        assert len(queue) == len(remaining)
+
+    def test_removing_a_missing_renderable_raises(self):
+        queue = RenderQueue(_renderables(3))
+        with pytest.raises(ValueError):
+            queue.remove(Renderable(None, (0, 0), (5, 5)))
+
+    def test_merge_matches_sorting_the_combined_sources(self):
+        renderables = _renderables(150, seed=2)
+        sources = [RenderQueue(renderables[:60]), RenderQueue(renderables[60:100]), RenderQueue(renderables[100:])]
+        assert list(RenderQueue.merge(*sources)) == Render.order_by_priority(renderables)
+
+    def test_blit_commands_are_reused_until_the_queue_changes(self):
+        surface = pygame.Surface((2, 2))
+        renderables = [Renderable(None, (index, 0), (0, index), lambda: surface) for index in range(3)]
+        queue = RenderQueue(renderables[:2])
+        commands = queue.blit_commands()
+        assert commands == [(surface, (0, 0)), (surface, (1, 0))]
+        assert queue.blit_commands() is commands
+        queue.insert(renderables[2])
+        assert queue.blit_commands() == [(surface, (0, 0)), (surface, (1, 0)), (surface, (2, 0))]
+
+
+class TestRender:
+
+    def test_on_screen_draws_later_priorities_over_earlier_ones(self):
+        colours = {priority: pygame.Surface((4, 4)) for priority in ((0, 4), (0, 6), (1, 5))}
+        for index, surface in enumerate(colours.values()):
+            surface.fill((50 * (index + 1), 0, 0))
+        renderables = [
+            Renderable(None, (priority[1], 0), priority, (lambda surface=surface: surface))
+            for priority, surface in colours.items()
+        ]
+        for sources in (
+            (renderables[::-1],),
+            (RenderQueue(renderables),),
+            (RenderQueue(renderables[:1]), RenderQueue(renderables[1:])),
+        ):
+            screen = pygame.Surface((12, 4))
+            Render.on_screen(screen, *sources)
+            assert_array_equal(pygame.surfarray.array3d(screen)[:, 0, 0], [0] * 4 + [50] + [150] * 4 + [100] + [0] * 2)
+
+    def test_composite_draws_like_the_renderables_it_holds(self):
+        rng = np.random.default_rng(3)
+        sprites = []
+        for _ in range(6):
+            sprite = pygame.Surface((4, 3), pygame.SRCALPHA)
+            pygame.surfarray.pixels3d(sprite)[...] = rng.integers(0, 256, (4, 3, 3))
+            pygame.surfarray.pixels_alpha(sprite)[...] = rng.choice((0, 255), (4, 3))
+            sprites.append(sprite)
+        renderables = [
+            Renderable(None, (3 + 2 * index, 5 + index % 2), (index % 2, index), (lambda sprite=sprite: sprite))
+            for index, sprite in enumerate(sprites)
+        ]
+        composite = Render.composite(renderables)
+        assert composite.position == (3, 5)
+        assert composite.priority == (1, 5)
+        expected, result = pygame.Surface((20, 12)), pygame.Surface((20, 12))
+        Render.on_screen(expected, renderables)
+        Render.on_screen(result, [composite])
+        assert_array_equal(pygame.surfarray.array3d(result), pygame.surfarray.array3d(expected))
+
+    def test_composite_of_nothing_is_none(self):
+        assert Render.composite(()) is None
@@ -0,0 +1,416 @@
+import copy
+import gc
+import os
+import pickle
+import random
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import neat
+from numpy.testing import assert_array_equal
+
+from core.caches import PrototypeCache, PrototypeDiskCache, SpriteStore
+from core.image import ImageConvert
+from core.neat_interfaces import NeatInterfaces
+from core.networks import CompiledNetwork
+from core.tiles import ContextRGBAs, LazyContextArrays, PixelImageGenerator, SequenceImageGenerator, TilePrototypeMaker
+
+
+PATH_TO_CONFIG_FILE_DIRECTORY = os.path.join("genome_configurations", "example_06_configs")
+
+
+def _xy_features(sprite_dimensions, tile_type=None) -> np.ndarray:
+    x, y = np.meshgrid(
+        (np.arange(sprite_dimensions[0]) + 1) / sprite_dimensions[0],
+        (np.arange(sprite_dimensions[1]) + 1) / sprite_dimensions[1],
+        indexing="ij",
+    )
+    return np.stack([x.ravel(), y.ravel()], axis=1)
+
+
+def _palette_image(nn_outputs, palette, tile_type=None):
+    return ImageConvert.matrix_to_rgb_palette_and_alphas(nn_outputs[:, :, 0], palette)
+
+
+def _xy_axis_features(sprite_dimensions, tile_type=None):
+    return (
+        ((np.arange(sprite_dimensions[0]) + 1) / sprite_dimensions[0])[:, np.newaxis],
+        ((np.arange(sprite_dimensions[1]) + 1) / sprite_dimensions[1])[np.newaxis, :],
+    )
+
+
+XY_GENERATOR = PixelImageGenerator(pixel_features=_xy_features, image_from_outputs=_palette_image)
+
+
+def _wall_row_by_row(tile_type=None):
+    return tile_type == "wall"
+
+
+ROWS_OR_COLUMNS_GENERATOR = SequenceImageGenerator(row_by_row=_wall_row_by_row, image_from_outputs=_palette_image)
+
+
+def _populations_configs(generations: int = 3, seed: int = 0, config_directory: str = PATH_TO_CONFIG_FILE_DIRECTORY):
+    """Make populations for every tile type and advance them a few generations so that genomes differ in shape."""
+    random.seed(seed)
+    out = {}
+    for tile_type in ("floor", "wall", "roof"):
+        config = neat.Config(
+            neat.DefaultGenome,
+            neat.DefaultReproduction,
+            neat.DefaultSpeciesSet,
+            neat.DefaultStagnation,
+            os.path.join(config_directory, tile_type),
+        )
+        population = neat.Population(config)
+        for _ in range(generations):
+            for genome in population.population.values():
+                genome.fitness = random.random()
+            NeatInterfaces.advance_to_next_generation(population)
+        out[tile_type] = (population, config)
+    return out
+
+
+@pytest.fixture(scope="module")
+def populations_configs():
+    return _populations_configs()
+
+
+def _assert_same_prototypes(first, second):
+    assert first.keys() == second.keys()
+    for tile_type in first:
+        assert first[tile_type].keys() == second[tile_type].keys()
+        for genome_id, prototype in first[tile_type].items():
+            other = second[tile_type][genome_id]
+            assert prototype.inputs_to_rgbs_and_alphas.keys() == other.inputs_to_rgbs_and_alphas.keys()
+            for nn_input, (rgb, alpha) in prototype.inputs_to_rgbs_and_alphas.items():
+                assert_array_equal(rgb, other.inputs_to_rgbs_and_alphas[nn_input][0])
+                assert_array_equal(alpha, other.inputs_to_rgbs_and_alphas[nn_input][1])
+
+
+class TestPixelImageGenerator:
+
+    def test_axis_features_give_the_same_images(self, populations_configs):
+        population, config = populations_configs["floor"]
+        separable_generator = XY_GENERATOR._replace(axis_features=_xy_axis_features, specialise_min_pixels=0)
+        for genome in population.population.values():
+            network = CompiledNetwork.create(genome, config)
+            for nn_input in ((0, 0, 0), (1, 0, 1)):
+                rgb, alpha = XY_GENERATOR.image_from_network(network, nn_input, (8, 5), ((0, 0, 0, 255), (9, 9, 9, 0)))
+                separable_rgb, separable_alpha = separable_generator.image_from_network(
+                    network, nn_input, (8, 5), ((0, 0, 0, 255), (9, 9, 9, 0))
+                )
+                assert_array_equal(rgb, separable_rgb)
+                assert_array_equal(alpha, separable_alpha)
+
+
+class TestTilePrototypeMaker:
+
+    def test_batched_population_matches_per_genome_generation(self, populations_configs):
+        per_genome = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            image_generating_function=XY_GENERATOR.image_from_network,
+            neural_network_factory=CompiledNetwork.create,
+        ).prototype_populations()
+        batched = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+        ).prototype_populations()
+        _assert_same_prototypes(per_genome, batched)
+
+    def test_batched_population_of_large_sprites_is_evaluated_axis_by_axis(self, populations_configs, monkeypatch):
+        separable_calls = []
+        activate_separable = CompiledNetwork.activate_separable
+
+        def _activate_separable(network, inputs):
+            separable_calls.append(network)
+            return activate_separable(network, inputs)
+
+        monkeypatch.setattr(CompiledNetwork, "activate_separable", _activate_separable)
+        expected = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+        ).prototype_populations()
+        assert not separable_calls
+        separable = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR._replace(axis_features=_xy_axis_features, specialise_min_pixels=0),
+        ).prototype_populations()
+        assert separable_calls
+        _assert_same_prototypes(expected, separable)
+
+    def test_prototype_cache_reuses_arrays_of_unchanged_genomes(self, populations_configs):
+        cache = PrototypeCache()
+        maker = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            prototype_cache=cache,
+        )
+        first = maker.prototype_populations()
+        misses = cache.misses
+        second = maker.prototype_populations()
+        assert cache.misses == misses
+        assert cache.hits >= sum(len(population.population) for population, _ in populations_configs.values())
+        for tile_type, genomes_prototypes in first.items():
+            for genome_id, prototype in genomes_prototypes.items():
+                assert second[tile_type][genome_id].inputs_to_rgbs_and_alphas is prototype.inputs_to_rgbs_and_alphas
+
+    def test_cache_keys_tell_generators_with_different_axis_features_apart(self, populations_configs):
+        names = [
+            TilePrototypeMaker(
+                tiles_types_to_populations_configs=populations_configs, pixel_image_generator=generator,
+            )._image_function_name()
+            for generator in (XY_GENERATOR, XY_GENERATOR._replace(axis_features=_xy_axis_features))
+        ]
+        assert names[0] != names[1]
+
+    def test_prototype_cache_keeps_tile_types_apart(self, populations_configs):
+        populations_configs = copy.deepcopy(populations_configs)
+        floors, _ = populations_configs["floor"]
+        roofs, _ = populations_configs["roof"]
+        floor_id, roof_id = next(iter(floors.population)), next(iter(roofs.population))
+        roofs.population[roof_id] = copy.deepcopy(floors.population[floor_id])
+        roofs.population[roof_id].key = roof_id
+
+        def _image_per_tile_type(nn_outputs, palette, tile_type=None):
+            return _palette_image(nn_outputs, palette[::-1] if tile_type == "roof" else palette)
+
+        palette = ((10, 20, 50, 255), (20, 10, 100, 255), (50, 10, 200, 255))
+        made = {}
+        for prototype_cache in (None, PrototypeCache()):
+            made[prototype_cache is None] = TilePrototypeMaker(
+                tiles_types_to_populations_configs=populations_configs,
+                pixel_image_generator=PixelImageGenerator(_xy_features, _image_per_tile_type),
+                sprite_palettes={"floor": palette, "wall": palette, "roof": palette},
+                prototype_cache=prototype_cache,
+            ).prototype_populations()
+        _assert_same_prototypes(made[True], made[False])
+        assert made[False]["roof"][roof_id].inputs_to_rgbs_and_alphas is not (
+            made[False]["floor"][floor_id].inputs_to_rgbs_and_alphas
+        )
+
+    def test_collapsed_contexts_match_full_rendering_and_share_arrays(self, populations_configs):
+        populations_configs = copy.deepcopy(populations_configs)
+        population, _ = populations_configs["floor"]
+        genome = next(iter(population.population.values()))
+        for (i, o), connection in genome.connections.items():
+            if i in (-1, -2, -3):
+                connection.enabled = False
+        full = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+        ).prototype_populations()
+        collapsed = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            collapse_duplicate_contexts=True,
+        ).prototype_populations()
+        _assert_same_prototypes(full, collapsed)
+        arrays = collapsed["floor"][genome.key].inputs_to_rgbs_and_alphas.values()
+        assert len({id(rgb_and_alpha) for rgb_and_alpha in arrays}) == 1
+
+    def test_sequences_advanced_together_match_per_genome_generation(self):
+        # Networks take the NN input and the previous row (walls) or column (floors and roofs) of a sprite.
+        populations_configs = _populations_configs(
+            generations=2, config_directory=os.path.join("genome_configurations", "example_08_configs")
+        )
+        per_genome = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            image_generating_function=ROWS_OR_COLUMNS_GENERATOR.image_from_network,
+        ).prototype_populations()
+        batched = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            sequence_image_generator=ROWS_OR_COLUMNS_GENERATOR,
+        ).prototype_populations()
+        _assert_same_prototypes(per_genome, batched)
+
+    def test_lazy_contexts_render_only_looked_up_nn_inputs(self, populations_configs):
+        eager = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+        ).prototype_populations()
+        lazy = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            lazy_contexts=True,
+        ).prototype_populations()
+        arrays = next(iter(lazy["floor"].values())).inputs_to_rgbs_and_alphas
+        assert isinstance(arrays, LazyContextArrays)
+        assert arrays.rendered == {}
+        arrays[(1, 0, 1)]
+        assert set(arrays.rendered) == {(1, 0, 1)}
+        _assert_same_prototypes(eager, lazy)
+
+    @pytest.mark.parametrize("generator_name", ("pixel_image_generator", "image_generating_function"))
+    def test_prewarm_renders_requested_nn_inputs_of_lazy_prototypes(self, populations_configs, generator_name):
+        generator = XY_GENERATOR if generator_name == "pixel_image_generator" else XY_GENERATOR.image_from_network
+        maker_kwargs = dict(tiles_types_to_populations_configs=populations_configs, **{generator_name: generator})
+        if generator_name == "image_generating_function":
+            maker_kwargs["neural_network_factory"] = CompiledNetwork.create
+        eager = TilePrototypeMaker(**maker_kwargs).prototype_populations()
+        maker = TilePrototypeMaker(lazy_contexts=True, **maker_kwargs)
+        lazy = maker.prototype_populations()
+        maker.prewarm(lazy, {"wall": {(0, 1), (1, 1)}})
+        for genome_id, prototype in lazy["wall"].items():
+            arrays = prototype.inputs_to_rgbs_and_alphas
+            assert set(arrays.rendered) == {(0, 1), (1, 1)}
+            for nn_input in arrays.rendered:
+                assert_array_equal(arrays[nn_input][0], eager["wall"][genome_id].inputs_to_rgbs_and_alphas[nn_input][0])
+                assert not arrays[nn_input][0].flags.writeable
+        assert all(prototype.inputs_to_rgbs_and_alphas.rendered == {} for prototype in lazy["roof"].values())
+
+    def test_pickled_lazy_prototypes_hold_every_nn_input(self, populations_configs):
+        lazy = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            lazy_contexts=True,
+        ).prototype_populations()
+        arrays = next(iter(lazy["roof"].values())).inputs_to_rgbs_and_alphas
+        unpickled = pickle.loads(pickle.dumps(arrays))
+        assert type(unpickled) is dict
+        assert unpickled.keys() == arrays.keys()
+
+    @pytest.mark.parametrize("generator_name", ("pixel_image_generator", "image_generating_function"))
+    def test_executor_matches_serial_generation(self, populations_configs, generator_name):
+        if generator_name == "pixel_image_generator":
+            maker_kwargs = dict(pixel_image_generator=XY_GENERATOR)
+        else:
+            maker_kwargs = dict(
+                image_generating_function=f"{__name__}:XY_GENERATOR.image_from_network",
+                neural_network_factory=CompiledNetwork.create,
+            )
+        serial = TilePrototypeMaker(tiles_types_to_populations_configs=populations_configs, **maker_kwargs)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            parallel = TilePrototypeMaker(
+                tiles_types_to_populations_configs=populations_configs,
+                executor=executor,
+                executor_chunk_size=3,
+                **maker_kwargs,
+            ).prototype_populations()
+        _assert_same_prototypes(serial.prototype_populations(), parallel)
+
+    def test_rendered_sprites_are_packed_into_contiguous_uint8_blocks(self, populations_configs):
+        prototypes = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            collapse_duplicate_contexts=True,
+        ).prototype_populations()
+        for genomes_prototypes in prototypes.values():
+            for prototype in genomes_prototypes.values():
+                arrays = prototype.inputs_to_rgbs_and_alphas
+                assert isinstance(arrays, ContextRGBAs)
+                assert arrays.rgbas.dtype == np.uint8 and arrays.rgbas.flags.c_contiguous
+                assert len(arrays.rgbas) == len(set(arrays.rows.values()))
+
+    def test_disk_cache_gives_later_sessions_the_same_prototypes_without_rendering(self, populations_configs, tmp_path):
+        first = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            disk_cache=PrototypeDiskCache(str(tmp_path)),
+        ).prototype_populations()
+        disk_cache = PrototypeDiskCache(str(tmp_path))
+        second = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            disk_cache=disk_cache,
+        ).prototype_populations()
+        assert disk_cache.misses == 0
+        assert disk_cache.hits == sum(len(population.population) for population, _ in populations_configs.values())
+        _assert_same_prototypes(first, second)
+
+    def test_prewarmed_lazy_prototypes_are_stored_on_disk(self, populations_configs, tmp_path):
+        disk_cache = PrototypeDiskCache(str(tmp_path))
+        maker = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            lazy_contexts=True,
+            disk_cache=disk_cache,
+        )
+        lazy = maker.prototype_populations()
+        maker.prewarm(lazy, {"wall": maker.nn_inputs["wall"], "floor": [(0, 0, 0)]})
+        assert len(disk_cache) == len(lazy["wall"])
+        _assert_same_prototypes({"wall": lazy["wall"]}, {"wall": maker.prototype_populations()["wall"]})
+
+    def test_iter_prototypes_follows_the_given_order_and_matches_prototype_populations(self, populations_configs):
+        maker = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+        )
+        floor_ids = sorted(populations_configs["floor"][0].population)
+        order = [("roof", max(populations_configs["roof"][0].population)), ("floor", floor_ids[-1])]
+        streamed = list(maker.iter_prototypes(order=order, chunk_size=2))
+        assert [(tile_type, genome_id) for tile_type, genome_id, _ in streamed[:2]] == order
+        assert [(tile_type, genome_id) for tile_type, genome_id, _ in streamed[2:5]] == [
+            ("floor", floor_ids[0]), ("wall", min(populations_configs["wall"][0].population)),
+            ("roof", min(populations_configs["roof"][0].population)),
+        ]
+        assert len(streamed) == sum(len(population.population) for population, _ in populations_configs.values())
+        prototypes = {}
+        for tile_type, genome_id, prototype in streamed:
+            prototypes.setdefault(tile_type, {})[genome_id] = prototype
+        _assert_same_prototypes(maker.prototype_populations(), prototypes)
+
+    @pytest.mark.parametrize("lazy_contexts", (False, True))
+    def test_sprite_store_keeps_one_copy_of_identical_sprites(self, populations_configs, lazy_contexts):
+        populations_configs = copy.deepcopy(populations_configs)
+        population, _ = populations_configs["wall"]
+        first, second = sorted(population.population)[:2]
+        population.population[second] = copy.deepcopy(population.population[first])
+        population.population[second].key = second
+        store = SpriteStore()
+        maker = TilePrototypeMaker(
+            tiles_types_to_populations_configs=populations_configs,
+            pixel_image_generator=XY_GENERATOR,
+            lazy_contexts=lazy_contexts,
+            sprite_store=store,
+        )
+        deduplicated = maker.prototype_populations()
+        _assert_same_prototypes(
+            TilePrototypeMaker(
+                tiles_types_to_populations_configs=populations_configs, pixel_image_generator=XY_GENERATOR
+            ).prototype_populations(),
+            deduplicated,
+        )
+        walls = deduplicated["wall"]
+        for nn_input in walls[first].inputs_to_rgbs_and_alphas:
+            rgb, _ = walls[first].inputs_to_rgbs_and_alphas[nn_input]
+            assert rgb.base is walls[second].inputs_to_rgbs_and_alphas[nn_input][0].base
+            assert walls[first].surfaces.surface(nn_input) is walls[second].surfaces.surface(nn_input)
+        assert 0 < len(store) < sum(len(genomes_prototypes) * 8 for genomes_prototypes in deduplicated.values())
+        del deduplicated, walls, rgb
+        gc.collect()
+        assert len(store) == 0
+
+
+class TestContextRGBAs:
+
+    def test_pack_shares_rows_of_shared_arrays_and_keeps_values(self):
+        rgb = np.arange(24).reshape((2, 4, 3))
+        alpha = np.full((2, 4), 255)
+        shared = (rgb, alpha)
+        arrays = {(0, 0): shared, (1, 0): shared, (1, 1): (rgb + 1, alpha - 255)}
+        packed = ContextRGBAs.pack(arrays)
+        assert isinstance(packed, ContextRGBAs)
+        assert packed.rgbas.shape == (2, 2, 4, 4)
+        assert packed[(0, 0)] is packed[(1, 0)]
+        for nn_input, (expected_rgb, expected_alpha) in arrays.items():
+            assert_array_equal(packed[nn_input][0], expected_rgb)
+            assert_array_equal(packed[nn_input][1], expected_alpha)
+        assert_array_equal(packed.rgba((1, 1))[..., 3], 0)
+        unpickled = pickle.loads(pickle.dumps(packed))
+        assert unpickled.rows == packed.rows
+        assert_array_equal(unpickled.rgbas, packed.rgbas)
+
+    @pytest.mark.parametrize("rgb", (np.full((2, 4, 3), np.nan), np.full((2, 4, 3), 0.5), np.full((2, 4, 3), 256)))
+    def test_pack_keeps_arrays_uint8_can_not_represent(self, rgb):
+        arrays = {(0, 0): (rgb, np.zeros((2, 4)))}
+        assert ContextRGBAs.pack(arrays) is arrays
+
+
+class TestSequenceImageGenerator:
+
+    def test_step_inputs_follow_nn_input_and_previous_outputs(self):
+        generator = ROWS_OR_COLUMNS_GENERATOR._replace(step_features=lambda step, sprite_dimensions, tile_type: [step])
+        nn_inputs = np.array([[[0, 1], [1, 1]]], dtype=float)
+        previous_outputs = np.full((1, 2, 3), 0.5)
+        result = generator.step_inputs(nn_inputs, previous_outputs, 7, (3, 4), "wall")
+        assert_array_equal(result, [[[0, 1, 0.5, 0.5, 0.5, 7], [1, 1, 0.5, 0.5, 0.5, 7]]])
@@ -0,0 +1,111 @@
+import importlib
+import os
+import sys
+from types import SimpleNamespace
+import numpy as np
+import pygame
+import pytest
+from numpy.testing import assert_array_equal
+
+from core.tiles import TilePrototype
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def example_13(monkeypatch):
+    """Import a fresh copy of the example."""
+    monkeypatch.syspath_prepend(ROOT)
+    monkeypatch.delitem(sys.modules, "example_13_more_pixel_info", raising=False)
+    return importlib.import_module("example_13_more_pixel_info")
+
+
+def _sprite(value: int):
+    rgb = np.full((4, 3, 3), value, dtype=np.uint8)
+    rgb[0, 0] = (value, 0, 255 - value)
+    return rgb, np.full((4, 3), 255, dtype=np.uint8)
+
+
+def _button(state: bool, inputs_to_sprites):
+    prototype = TilePrototype("floor", (4, 3), 0, None, None, inputs_to_sprites)
+    return SimpleNamespace(state=state, prototypes={"floor": prototype})
+
+
+class TestImport:
+
+    def test_importing_makes_no_directories(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.syspath_prepend(ROOT)
+        monkeypatch.delitem(sys.modules, "example_13_more_pixel_info", raising=False)
+        importlib.import_module("example_13_more_pixel_info")
+        assert os.listdir(tmp_path) == []
+
+
+class TestExportSelection:
+
+    def test_files_hold_the_sprites_of_the_last_selected_button_using_them(self, example_13, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        x, y, z = _sprite(10), _sprite(90), _sprite(170)
+        buttons = [
+            _button(True, {(0, 0, 0): x, (1, 0, 0): x}),
+            _button(False, {(0, 0, 0): z, (1, 0, 0): z}),
+            _button(True, {(0, 0, 0): y, (1, 0, 0): x, (1, 1, 0): x}),
+        ]
+        example_13._export_selection(SimpleNamespace(buttons=buttons))
+        (timestamp,) = os.listdir(os.path.join(tmp_path, example_13.EXPORT_DIRECTORY))
+        export_directory = os.path.join(tmp_path, example_13.EXPORT_DIRECTORY, timestamp)
+        expected = {"floor_0_0_0.png": y, "floor_1_0_0.png": x, "floor_1_1_0.png": x}
+        assert sorted(name for name in os.listdir(export_directory) if name.endswith(".png")) == sorted(expected)
+        for name, (rgb, alpha) in expected.items():
+            surface = pygame.image.load(os.path.join(export_directory, name))
+            assert_array_equal(pygame.surfarray.array3d(surface), rgb)
+            assert_array_equal(pygame.surfarray.array_alpha(surface), alpha)
+
+
+class TestMain:
+
+    def test_clicking_a_button_updates_only_its_rect_on_the_display(self, example_13, tmp_path, monkeypatch):
+        monkeypatch.setattr(
+            example_13, "PATH_TO_CONFIG_FILE_DIRECTORY", os.path.join(ROOT, example_13.PATH_TO_CONFIG_FILE_DIRECTORY)
+        )
+        monkeypatch.setattr(example_13, "PROTOTYPE_DISK_CACHE_DIRECTORY", str(tmp_path))
+        monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+        # Buttons are 810 by 90 pixels and stacked from (15, 15), so this is inside the second one.
+        monkeypatch.setattr(pygame.mouse, "get_pos", lambda: (50, 150))
+        frames = iter((
+            [],
+            [pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1)],
+            [],
+            [pygame.event.Event(pygame.QUIT)],
+        ))
+        monkeypatch.setattr(pygame.event, "get", lambda: next(frames))
+        flips, updates = [], []
+        monkeypatch.setattr(pygame.display, "flip", lambda: flips.append(True))
+        monkeypatch.setattr(pygame.display, "update", lambda rects: updates.append(list(rects)))
+        example_13.main()
+        assert flips == [True]
+        assert updates == [[pygame.Rect(15, 105, 810, 90)]]
+
+    def test_the_display_is_made_before_the_first_buttons(self, example_13, tmp_path, monkeypatch):
+        monkeypatch.setattr(
+            example_13, "PATH_TO_CONFIG_FILE_DIRECTORY", os.path.join(ROOT, example_13.PATH_TO_CONFIG_FILE_DIRECTORY)
+        )
+        monkeypatch.setattr(example_13, "PROTOTYPE_DISK_CACHE_DIRECTORY", str(tmp_path))
+        monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+        monkeypatch.setattr(pygame.event, "get", lambda: [pygame.event.Event(pygame.QUIT)])
+        calls = []
+        set_mode, button_array = pygame.display.set_mode, example_13.ToggleableIllustratedButtonArray
+
+        def _set_mode(*args, **kwargs):
+            calls.append("set_mode")
+            return set_mode(*args, **kwargs)
+
+        def _button_array(*args, **kwargs):
+            calls.append("buttons")
+            return button_array(*args, **kwargs)
+
+        monkeypatch.setattr(pygame.display, "set_mode", _set_mode)
+        monkeypatch.setattr(example_13, "ToggleableIllustratedButtonArray", _button_array)
+        example_13.main()
+        assert calls[0: 2] == ["set_mode", "buttons"]
@@ -0,0 +1,106 @@
+import itertools
+import numpy as np
+import pygame
+from numpy.testing import assert_array_equal
+
+from core.render import Render
+from core.tiles import TilePrototype
+from ui.buttons import ToggleableIllustratedButtonArray
+from ui.dirty_rects import DirtyRects
+
+
+SPRITE_DIMENSIONS = {"floor": (4, 2), "wall": (4, 1), "roof": (4, 2)}
+CONTEXT_LENGTHS = {"floor": 3, "wall": 2, "roof": 3}
+
+
+def _prototype(tile_type: str, genome_id: int, value: int) -> TilePrototype:
+    """A prototype drawing the same opaque sprite, of one colour, for every NN input."""
+    width, height = SPRITE_DIMENSIONS[tile_type]
+    rgb_and_alpha = (np.full((width, height, 3), value, dtype=np.uint8), np.full((width, height), 255, dtype=np.uint8))
+    return TilePrototype(
+        tile_type, (width, height), genome_id, None, None,
+        {nn_input: rgb_and_alpha for nn_input in itertools.product((0, 1), repeat=CONTEXT_LENGTHS[tile_type])},
+    )
+
+
+def _button_array(tiles_genomes_prototypes, tiles_genome_ids=None, dirty_rects=None):
+    return ToggleableIllustratedButtonArray(
+        tile_grid=np.array([[0, 1, 0], [0, 0, 1]]),
+        rows_columns=(3, 1),
+        cell_dimensions=(4, 2),
+        button_dimensions=(20, 10),
+        top_left_position_of_grid=(5, 5),
+        sprite_dimensions=SPRITE_DIMENSIONS,
+        button_inner_boarder=(2, 4),
+        tiles_genomes_prototypes=tiles_genomes_prototypes,
+        tiles_genome_ids=tiles_genome_ids,
+        dirty_rects=dirty_rects,
+    )
+
+
+TILES_GENOME_IDS = {"floor": (12, 10, 11), "wall": (22, 21, 20), "roof": (30, 32, 31)}
+
+
+class TestToggleableIllustratedButtonArray:
+
+    def test_added_prototypes_fill_their_own_button_keeping_order_and_states(self):
+        buttons_array = _button_array({}, TILES_GENOME_IDS)
+        assert buttons_array.prototype_order() == (
+            ("floor", 10), ("wall", 20), ("roof", 30),
+            ("floor", 11), ("wall", 21), ("roof", 31),
+            ("floor", 12), ("wall", 22), ("roof", 32),
+        )
+        buttons_array.toggle(buttons_array.buttons[0])
+        buttons_array.toggle(buttons_array.buttons[2])
+        for tile_type, genome_id in buttons_array.prototype_order()[3:6]:
+            buttons_array.add_prototype(tile_type, genome_id, _prototype(tile_type, genome_id, 100))
+        assert [button.button_id for button in buttons_array.buttons] == [0, 1, 2]
+        assert [button.state for button in buttons_array.buttons] == [True, False, True]
+        assert [len(button.renderables) > 0 for button in buttons_array.buttons] == [False, True, False]
+        assert {tile: prototype.genome_id for tile, prototype in buttons_array.buttons[1].prototypes.items()} == {
+            "floor": 11, "wall": 21, "roof": 31,
+        }
+        for tile_type, genome_id in buttons_array.prototype_order()[:3]:
+            buttons_array.add_prototype(tile_type, genome_id, _prototype(tile_type, genome_id, 50))
+        assert [button.state for button in buttons_array.buttons] == [True, False, True]
+        assert [len(button.renderables) > 0 for button in buttons_array.buttons] == [True, True, False]
+        assert buttons_array.buttons[0].rect.bottom == buttons_array.buttons[1].rect.top
+
+    def test_buttons_are_drawn_from_thumbnails_that_are_rebuilt_when_a_prototype_changes(self):
+        tiles_genomes_prototypes = {
+            tile_type: {genome_id: _prototype(tile_type, genome_id, 40 + genome_id) for genome_id in genome_ids}
+            for tile_type, genome_ids in TILES_GENOME_IDS.items()
+        }
+        buttons_array = _button_array(tiles_genomes_prototypes)
+        assert list(buttons_array.collect_renderables()) == [button.thumbnail for button in buttons_array.buttons]
+
+        def _drawn(renderables):
+            screen = pygame.Surface((40, 50))
+            Render.on_screen(screen, renderables)
+            return pygame.surfarray.array3d(screen)
+
+        sprites = [renderable for button in buttons_array.buttons for renderable in button.renderables]
+        assert_array_equal(_drawn(buttons_array.collect_renderables()), _drawn(sprites))
+
+        before = buttons_array.buttons[1].thumbnail
+        buttons_array.add_prototype("roof", 31, _prototype("roof", 31, 200))
+        after = buttons_array.buttons[1].thumbnail
+        assert after is not before
+        assert buttons_array.buttons[0].thumbnail in buttons_array.collect_renderables()
+        assert list(buttons_array.collect_renderables()).count(after) == 1
+        assert before not in buttons_array.collect_renderables()
+        assert np.any(pygame.surfarray.array3d(after.surface_getter()) == 200)
+        sprites = [renderable for button in buttons_array.buttons for renderable in button.renderables]
+        assert_array_equal(_drawn(buttons_array.collect_renderables()), _drawn(sprites))
+
+    def test_toggling_or_filling_a_button_marks_only_its_rect(self):
+        dirty_rects = DirtyRects()
+        buttons_array = _button_array({}, TILES_GENOME_IDS, dirty_rects)
+        assert dirty_rects.rects == [button.rect for button in buttons_array.buttons]
+        dirty_rects.rects = []
+        buttons_array.toggle(buttons_array.buttons[1])
+        assert dirty_rects.rects == [buttons_array.buttons[1].rect]
+        dirty_rects.rects = []
+        for tile_type, genome_id in buttons_array.prototype_order()[6:]:
+            buttons_array.add_prototype(tile_type, genome_id, _prototype(tile_type, genome_id, 100))
+        assert dirty_rects.rects == [buttons_array.buttons[2].rect]
@@ -0,0 +1,46 @@
+import numpy as np
+import pygame
+from numpy.testing import assert_array_equal
+
+from ui.dirty_rects import DirtyRects
+
+
+class TestDirtyRects:
+
+    def test_overlapping_rects_are_merged(self):
+        dirty_rects = DirtyRects()
+        assert not dirty_rects
+        dirty_rects.mark((0, 0, 10, 10))
+        dirty_rects.mark((20, 0, 10, 10))
+        dirty_rects.mark((40, 0, 10, 10))
+        dirty_rects.mark((5, 5, 20, 2))
+        assert sorted(map(tuple, dirty_rects.rects)) == [(0, 0, 30, 10), (40, 0, 10, 10)]
+        assert dirty_rects
+
+    def test_redraw_repaints_and_updates_only_the_marked_rects(self, monkeypatch):
+        updated = []
+        monkeypatch.setattr(pygame.display, "update", lambda rects: updated.extend(rects))
+        screen = pygame.Surface((8, 4))
+        screen.fill((1, 1, 1))
+        dirty_rects = DirtyRects()
+        dirty_rects.mark((2, 0, 3, 4))
+        dirty_rects.redraw(screen, (5, 5, 5), lambda surface: surface.fill((9, 9, 9), (0, 0, 8, 2)))
+        assert updated == [pygame.Rect(2, 0, 3, 4)]
+        assert_array_equal(pygame.surfarray.array3d(screen)[:, :, 0], np.array([
+            [1, 1, 1, 1], [1, 1, 1, 1], [9, 9, 5, 5], [9, 9, 5, 5], [9, 9, 5, 5], [1, 1, 1, 1], [1, 1, 1, 1],
+            [1, 1, 1, 1],
+        ]))
+        assert not dirty_rects
+        assert screen.get_clip() == screen.get_rect()
+
+    def test_marking_everything_redraws_the_whole_screen(self, monkeypatch):
+        flips = []
+        monkeypatch.setattr(pygame.display, "flip", lambda: flips.append(True))
+        screen = pygame.Surface((3, 3))
+        dirty_rects = DirtyRects()
+        dirty_rects.mark((0, 0, 1, 1))
+        dirty_rects.mark_everything()
+        dirty_rects.redraw(screen, (7, 7, 7), lambda surface: None)
+        assert flips == [True]
+        assert_array_equal(pygame.surfarray.array3d(screen), np.full((3, 3, 3), 7))
+        assert not dirty_rects
@@ -1,17 +1,19 @@
-from typing import Tuple, Iterable, Dict
+from typing import Tuple, Iterable, Dict, Optional
 import pygame
 import numpy as np
 from dataclasses import dataclass
 
-from core.render import Renderable, MapGridToScreen, PrepareForRendering
+from core.render import Renderable, RenderQueue, Render, MapGridToScreen, PrepareForRendering
 from core.tiles import TilePrototype
+from ui.dirty_rects import DirtyRects
 
 
 class ToggleableIllustratedButton:
     """A button that can be toggled and also displays an image that can be generated from a tile grid.
 
     Rather than holding the image surface directly this object hold instructions for which image to draw in the form of
-    an iterable of tuples of Renderable objects.
+    an iterable of tuples of Renderable objects.  Since the image does not change, the renderables are also drawn
+    once onto a thumbnail, a single Renderable that is drawn in their place.
 
     Created to display sprites to the user while they pick which ones they like.
     """
@@ -25,6 +27,7 @@ class ToggleableIllustratedButton:
         renderables: Iterable[Renderable],
         tile_types_to_genome_ids: Dict[str, int],
         initial_state: bool = False,
+        thumbnail: Optional[Renderable] = None,
     ):
         self.button_id = button_id
         self.top_left = top_left
@@ -34,10 +37,16 @@ class ToggleableIllustratedButton:
         self.renderables = renderables
         self.rect = pygame.Rect(top_left, dimensions)
         self.tile_types_to_genome_ids = tile_types_to_genome_ids
+        self.thumbnail = thumbnail
 
 
 class ToggleableIllustratedButtonArray:
-    """Show more than one tile set in a single window."""
+    """Show more than one tile set in a single window.
+
+    Buttons can be filled in progressively: given tiles_genome_ids, the array can start with only some (or none) of
+    the prototypes, and add_prototype draws a button's tile set as soon as it has a prototype for every tile type.
+    Buttons that are created, redrawn or toggled are marked in dirty_rects so that only they need redrawing on screen.
+    """
 
     def __init__(
         self,
@@ -50,6 +59,8 @@ class ToggleableIllustratedButtonArray:
         sprite_dimensions: Dict[str, Tuple[int, int]],  # Sprite id -> sprite width and height
         button_inner_boarder: Tuple[int, int],  # Used to create space between the image in the button boarder.
         tiles_genomes_prototypes: Dict[str, Dict[int, TilePrototype]],
+        tiles_genome_ids: Dict[str, Iterable[int]] = None,  # Defaults to the genome ids of tiles_genomes_prototypes.
+        dirty_rects: DirtyRects = None,
     ) -> None:
         self.tile_grid = tile_grid
         self.rows_columns = rows_columns
@@ -58,64 +69,102 @@ class ToggleableIllustratedButtonArray:
         self.top_left_position_of_grid = top_left_position_of_grid
         self.sprite_dimensions = sprite_dimensions
         self.button_inner_boarder = button_inner_boarder
-        self.tiles_genomes_prototypes = tiles_genomes_prototypes
+        self.tiles_genomes_prototypes = {
+            tile: dict(ids_prototypes) for tile, ids_prototypes in tiles_genomes_prototypes.items()
+        }
+        if tiles_genome_ids is None:
+            tiles_genome_ids = tiles_genomes_prototypes
+        self.tiles_genome_ids = {tile: sorted(genome_ids) for tile, genome_ids in tiles_genome_ids.items()}
+        self.dirty_rects = DirtyRects() if dirty_rects is None else dirty_rects
         self.buttons = self._make_buttons()
-
-    def _gather_prototypes_by_genome_id(
-        tiles_genomes_prototypes: Dict[str, Dict[int, TilePrototype]], index: int,
-    ) -> Dict[str, TilePrototype]:
-        out = {}
-        for tile, ids_prototypes in tiles_genomes_prototypes.items():
-            # Aribitrarily associate genomes with tile types based on their ordered incices.
-            genome_id = sorted(ids_prototypes.keys())[index]
-            out[tile] = ids_prototypes[genome_id]
-        return out
+        for button in self.buttons:
+            self._mark_dirty(button)
+        self.render_queue = RenderQueue(button.thumbnail for button in self.buttons if button.thumbnail is not None)
+
+    def _make_button(self, button_index: int, initial_state: bool = False) -> ToggleableIllustratedButton:
+        """Create a button, drawing nothing on it until there is a prototype for each of its genomes."""
+        irow, icol = divmod(button_index, self.rows_columns[1])
+        top_left_position_of_button = MapGridToScreen.top_left_of_cell(
+            grid_cell=(irow, icol),
+            cell_dimensions=self.button_dimensions,
+            top_left_position_of_grid=self.top_left_position_of_grid,
+        )
+        # TODO: Here we are assuming that there is an incidental one to one mapping between buttons and genomes.
+        # This may not be the case in the future and an explicit mapping may be needed.
+        # Aribitrarily associate genomes with tile types based on their ordered incices.
+        tile_types_to_genome_ids = {
+            tile: genome_ids[button_index] for tile, genome_ids in self.tiles_genome_ids.items()
+        }
+        prototypes: Dict[str, TilePrototype] = {
+            tile: self.tiles_genomes_prototypes[tile][genome_id]
+            for tile, genome_id in tile_types_to_genome_ids.items()
+            if genome_id in self.tiles_genomes_prototypes.get(tile, {})
+        }
+        button_renderables: Iterable[Renderable] = ()
+        if len(prototypes) == len(tile_types_to_genome_ids):
+            button_renderables = PrepareForRendering.collect_renderables_for_grid(
+                grid=self.tile_grid,
+                tile_prototypes=prototypes,
+                top_left_position_of_grid=(
+                    tuple(np.array(top_left_position_of_button) + np.array(self.button_inner_boarder))
+                ),
+                cell_dimensions=self.cell_dimensions,
+                wall_dimensions=self.sprite_dimensions["wall"],
+                roof_dimensions=self.sprite_dimensions["roof"],
+            )
+        return ToggleableIllustratedButton(
+            button_id=button_index,
+            top_left=top_left_position_of_button,
+            dimensions=self.button_dimensions,
+            prototypes=prototypes,
+            renderables=button_renderables,
+            tile_types_to_genome_ids=tile_types_to_genome_ids,
+            initial_state=initial_state,
+            thumbnail=Render.composite(button_renderables),
+        )
 
     def _make_buttons(self) -> Iterable[ToggleableIllustratedButton]:
         """Create button objects that can then be used to draw buttons on the screen and detect clicks."""
-        buttons = []
-        button_index = 0
-        for irow in range(self.rows_columns[0]):
-            for icol in range(self.rows_columns[1]):
-                top_left_position_of_button = MapGridToScreen.top_left_of_cell(
-                    grid_cell=(irow, icol),
-                    cell_dimensions=self.button_dimensions,
-                    top_left_position_of_grid=self.top_left_position_of_grid,
-                )
-                # TODO: Here we are assuming that there is an incidental one to one mapping between buttons and genomes.
-                # This may not be the case in the future and an explicit mapping may be needed.
-                prototypes: Dict[str, TilePrototype] = ToggleableIllustratedButtonArray._gather_prototypes_by_genome_id(
-                    self.tiles_genomes_prototypes, button_index
-                )
-                button_renderables: Iterable[Renderable] = PrepareForRendering.collect_renderables_for_grid(
-                    grid=self.tile_grid,
-                    tile_prototypes=prototypes,
-                    top_left_position_of_grid=(
-                        tuple(np.array(top_left_position_of_button) + np.array(self.button_inner_boarder))
-                    ),
-                    cell_dimensions=self.cell_dimensions,
-                    wall_dimensions=self.sprite_dimensions["wall"],
-                    roof_dimensions=self.sprite_dimensions["roof"],
-                )
-                buttons.append(
-                    ToggleableIllustratedButton(
-                        button_id=button_index,
-                        top_left=top_left_position_of_button,
-                        dimensions=self.button_dimensions,
-                        prototypes=prototypes,
-                        renderables=button_renderables,
-                        tile_types_to_genome_ids={tile: prototype.genome_id for tile, prototype in prototypes.items()}
-                    )
-                )
-                button_index += 1
-        return tuple(buttons)
-
-    def collect_renderables(self) -> Iterable[Tuple[str, np.array, Tuple[int, int]]]:
-        """Gather Renderable objects from many buttons into a single tuple."""
-        renderables = []
+        return tuple(
+            self._make_button(button_index) for button_index in range(self.rows_columns[0] * self.rows_columns[1])
+        )
+
+    def _mark_dirty(self, button: ToggleableIllustratedButton) -> None:
+        self.dirty_rects.mark(button.rect)
+        if button.thumbnail is not None:
+            # Sprites may stick out of the button.
+            self.dirty_rects.mark(pygame.Rect(button.thumbnail.position, button.thumbnail.surface_getter().get_size()))
+
+    def toggle(self, button: ToggleableIllustratedButton) -> None:
+        """Toggle the state of a button, marking it for its boarder to be redrawn."""
+        button.state = not button.state
+        self.dirty_rects.mark(button.rect)
+
+    def prototype_order(self) -> Iterable[Tuple[str, int]]:
+        """The (tile_type, genome_id) pairs of every button, button by button, e.g. to make prototypes in that order."""
+        return tuple(
+            (tile, genome_id) for button in self.buttons for tile, genome_id in button.tile_types_to_genome_ids.items()
+        )
+
+    def add_prototype(self, tile_type: str, genome_id: int, prototype: TilePrototype) -> None:
+        """Add a prototype and redraw the button it belongs to, keeping the button's state."""
+        self.tiles_genomes_prototypes.setdefault(tile_type, {})[genome_id] = prototype
+        buttons = list(self.buttons)
         for button in self.buttons:
-            renderables += button.renderables
-        return tuple(renderables)
+            if button.tile_types_to_genome_ids.get(tile_type) == genome_id:
+                redrawn_button = self._make_button(button.button_id, button.state)
+                if button.thumbnail is not None:
+                    self.render_queue.remove(button.thumbnail)
+                if redrawn_button.thumbnail is not None:
+                    self.render_queue.insert(redrawn_button.thumbnail)
+                buttons[button.button_id] = redrawn_button
+                self._mark_dirty(button)
+                self._mark_dirty(redrawn_button)
+        self.buttons = tuple(buttons)
+
+    def collect_renderables(self) -> RenderQueue:
+        """Gather the thumbnails of the buttons, already in the order they are to be drawn in."""
+        return self.render_queue
 
     def draw_button_boarders(self, screen):
         for button in self.buttons:
@@ -0,0 +1,56 @@
+from typing import Callable, List, Tuple, Union
+import pygame
+
+
+class DirtyRects:
+    """Track the regions of the screen that have changed so that only those are redrawn and sent to the display.
+
+    Rather than filling the screen, drawing everything and flipping the display every frame, changes such as toggling
+    a button mark the rects they affect, and redraw repaints and updates only those rects (if there are any).
+    """
+
+    def __init__(self) -> None:
+        self.rects: List[pygame.Rect] = []
+        self.everything = False
+
+    def __bool__(self) -> bool:
+        return self.everything or bool(self.rects)
+
+    def mark(self, rect: Union[pygame.Rect, Tuple[int, int, int, int]]) -> None:
+        """Mark a region as needing to be redrawn, merging it with any marked regions it overlaps."""
+        rect = pygame.Rect(rect)
+        overlapping = rect.collidelistall(self.rects)
+        while overlapping:
+            # Merging can make the rect overlap regions it did not overlap before.
+            rect.unionall_ip([self.rects[index] for index in overlapping])
+            self.rects = [other for index, other in enumerate(self.rects) if index not in overlapping]
+            overlapping = rect.collidelistall(self.rects)
+        self.rects.append(rect)
+
+    def mark_everything(self) -> None:
+        """Mark the whole screen, e.g. when it is first shown or everything on it has been replaced."""
+        self.everything = True
+
+    def redraw(
+        self,
+        screen: pygame.surface.Surface,
+        background_colour: Tuple[int, int, int],
+        draw: Callable[[pygame.surface.Surface], None],
+    ) -> None:
+        """Fill the marked regions with the background, draw over them and update only them on the display.
+
+        The draw function draws the whole scene but is clipped to each marked region in turn.
+        """
+        if self.everything:
+            screen.fill(background_colour)
+            draw(screen)
+            pygame.display.flip()
+        else:
+            for rect in self.rects:
+                screen.set_clip(rect)
+                screen.fill(background_colour)
+                draw(screen)
+            screen.set_clip(None)
+            pygame.display.update(self.rects)
+        self.rects = []
+        self.everything = False